@@ -0,0 +1,109 @@
+"""
+acquisition.py
+
+Background analog acquisition for the temperature sensors.
+
+pymata4 calls back every time an analog pin reports a new value.  Those values
+are kept in a small rolling window per pin, so reading the latest filtered value
+is just a look at memory instead of a round of analog_read's and sleeps.
+"""
+
+import logging
+import threading
+from collections import deque
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.acquisition")
+
+class AnalogStream():
+    """
+    Keeps a rolling window of the most recent raw readings for each analog pin.
+
+    <int> window => How many readings to keep for each pin
+    <int> differential => How much a pin has to change before pymata4 reports it
+    """
+    def __init__(self, window=10, differential=1):
+        self.LOGGER = logging.getLogger("__main__.acquisition.AnalogStream")
+        self.window = window
+        self.differential = differential
+
+        self.__windows = {}
+        self.__lastReport = {}
+        self.__lock = threading.Lock()
+
+        self.LOGGER.debug("Created AnalogStream with a window of {}".format(window))
+
+    @property
+    def pins(self):
+        return list(self.__windows)
+
+    def addPin(self, pin):
+        with self.__lock:
+            if pin not in self.__windows:
+                self.__windows[pin] = deque(maxlen=self.window)
+                self.__lastReport[pin] = None
+
+    def attach(self, board, pin):
+        """
+        Set the pin up as an analog input that reports into this stream
+        """
+        self.addPin(pin)
+        board.set_pin_mode_analog_input(pin, callback=self.callback, differential=self.differential)
+
+    def callback(self, data):
+        """
+        Called by pymata4 from its reporting thread.
+        data => [pinType, pinNumber, value, timeStamp]
+        """
+        pin, value = data[1], data[2]
+        # A zero is what the board reports when the sensor is not there
+        if not value:
+            return
+        with self.__lock:
+            if pin in self.__windows:
+                self.__windows[pin].append(value)
+                self.__lastReport[pin] = clock.CLOCK.monotonic()
+
+    def prime(self, board):
+        """
+        pymata4 only reports on change, so a steady temperature may never call back.
+        Seed every empty window with whatever value the board last saw.
+        """
+        for pin in self.pins:
+            with self.__lock:
+                empty = not self.__windows[pin]
+            if empty:
+                value, timeStamp = board.analog_read(pin)
+                self.callback([None, pin, value, timeStamp])
+
+    def latest(self, pin):
+        """
+        Returns the filtered (averaged) raw value for the pin, or None if nothing
+        has been reported yet
+        """
+        with self.__lock:
+            readings = tuple(self.__windows.get(pin, ()))
+        if not readings:
+            return None
+        return sum(readings) / len(readings)
+
+    def age(self, pin):
+        """
+        Seconds since the pin last reported, or None if it never has
+        """
+        lastReport = self.__lastReport.get(pin)
+        if lastReport is None:
+            return None
+        return clock.CLOCK.monotonic() - lastReport
+
+    def snapshot(self):
+        """
+        Returns a {pin: filteredValue} dictionary of every pin at once
+        """
+        with self.__lock:
+            windows = {pin: tuple(readings) for pin, readings in self.__windows.items()}
+        return {pin: (sum(r) / len(r) if r else None) for pin, r in windows.items()}
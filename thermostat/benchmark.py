@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+Time every phase of a control loop pass against local stand ins.
+
+The real hvac, occupancy, weather and hvactools code runs.  The board is a
+boards.SimulatedBoard, the weather comes from an HTTP server on localhost and
+the pings go to a fake responder that answers after a fixed round trip.
+
+For each phase it reports p50/p99 latency and the peak bytes allocated, plus
+passes per second for the whole loop, each the best of a few runs.  The results
+are compared against a stored baseline and the script exits with 1 if the p50s,
+the allocations or the passes per second got worse by more than the tolerance.
+The p99 of a few hundred passes of something that takes microseconds is mostly
+scheduler noise, so it is reported but not checked.
+
+Re-record the baseline with --save whenever a change makes a timed path do more.
+
+    ./benchmark.py                 compare against the baseline
+    ./benchmark.py --save          store this run as the new baseline
+    ./benchmark.py --passes 500 --runs 5 --tolerance .5
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+try:
+    import boards
+except ModuleNotFoundError:
+    import thermostat.boards as boards
+try:
+    import constants
+except ModuleNotFoundError:
+    import thermostat.constants as constants
+try:
+    import hvac as hvacModule
+except ModuleNotFoundError:
+    import thermostat.hvac as hvacModule
+try:
+    import hvactools
+except ModuleNotFoundError:
+    import thermostat.hvactools as hvactools
+try:
+    import occupancy
+except ModuleNotFoundError:
+    import thermostat.occupancy as occupancy
+try:
+    import prober
+except ModuleNotFoundError:
+    import thermostat.prober as prober
+try:
+    import relays
+except ModuleNotFoundError:
+    import thermostat.relays as relays
+try:
+    import weather
+except ModuleNotFoundError:
+    import thermostat.weather as weather
+
+LOGGER = logging.getLogger("__main__.benchmark")
+
+BASELINE = Path(__file__).with_name("benchmark_baseline.json")
+
+PHASES = ["updateSensors", "getTemp", "tempModifier", "weather", "wifi", "turnOn", "turnOff", "loop"]
+# Passes run under tracemalloc after the timed ones
+ALLOCATION_PASSES = 100
+
+FORECAST = {
+    "currently": {"temperature": 41.2},
+    "daily": {"data": [{"temperatureHigh": 48.0, "temperatureLow": 22.5}]}
+    }
+
+class WeatherHandler(http.server.BaseHTTPRequestHandler):
+    body = json.dumps(FORECAST).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeProber(prober.ICMPProber):
+    """
+    Answers for the hosts in "home" after one round trip, never for the rest
+    """
+    def __init__(self, home, rtt=.002):
+        prober.ICMPProber.__init__(self)
+        self.home = set(home)
+        self.rtt = rtt
+
+    def probe(self, hostnames, timeout=None):
+        hostnames = list(hostnames)
+        time.sleep(self.rtt)
+        return {h for h in hostnames if h in self.home}
+
+class FastPulser(relays.PulseScheduler):
+    """
+    The real scheduler with zero length pulses, so the benchmark times what the
+    loop pays for a relay change without a backlog of quarter second pulses
+    """
+    def pulse(self, pin, hold=.25, settle=.25, group=None, callback=None):
+        return relays.PulseScheduler.pulse(self, pin, 0, 0, group, callback)
+
+    def pulseMany(self, pulses, hold=.25):
+        return relays.PulseScheduler.pulseMany(self, [(pin, 0, group) for pin, settle, group in pulses], 0)
+
+def percentile(values, share):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+class Benchmark():
+    def __init__(self, passes=300):
+        self.passes = passes
+        self.settings = hvactools.updateSettings(None, constants.DEFAULTCONFIG)
+        self.times = {phase: [] for phase in PHASES}
+        self.allocations = {phase: 0 for phase in PHASES}
+
+    def setup(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), WeatherHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/forecast".format(self.server.server_port)
+
+        hvacPins = self.settings["HVAC"]
+        relayPins = {"HEAT": tuple(hvacPins["HEAT_PINS"]), "COOL": tuple(hvacPins["AC_PINS"]), "VENT": tuple(hvacPins["VENT_PINS"])}
+        self.board = boards.SimulatedBoard(relayPins, seed=1)
+        self.hvac = hvacModule.setup(self.settings["SENSORS"], self.settings["SENSOR_GROUPS"], hvacPins, aggregation=self.settings.get("SENSOR_AGGREGATION"), board=self.board, pulser=False)
+        self.hvac.pulser = FastPulser(self.board)
+        self.hvac.thermostat.compileSchedules(self.settings["TEMP_SETTINGS"])
+        self.hvac.thermostat.state = "HEAT"
+
+        self.weather = weather.WeatherForecast(url, timeout=2)
+        people = {"PERSON_ONE": ["phone-one", "laptop-one"], "PERSON_TWO": ["phone-two"]}
+        self.wifi = occupancy.WiFi(people)
+        self.oldProber = prober.PROBER
+        prober.PROBER = FakeProber(["phone-one" + constants.DOMAINNAME])
+
+    def teardown(self):
+        prober.PROBER = self.oldProber
+        self.hvac.pulser.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def timed(self, phase, function, *args):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter_ns()
+        result = function(*args)
+        self.times[phase].append(time.perf_counter_ns() - started)
+        if tracing:
+            self.allocations[phase] = max(self.allocations[phase], tracemalloc.get_traced_memory()[1] - before)
+        return result
+
+    def onePass(self, i):
+        thermostat = self.hvac.thermostat
+        started = time.perf_counter_ns()
+        self.board.tick()
+        self.timed("updateSensors", thermostat.updateSensors, self.board)
+        self.timed("getTemp", thermostat.getTemp, "HOUSE")
+        self.timed("tempModifier", thermostat.updateModifier, self.wifi.occupied)
+        # The network refreshes are due far less often in real life, but time them every tenth pass
+        if i % 10 == 0:
+            self.timed("weather", self.weather.update, self.weather.url)
+            self.timed("wifi", self.wifi.update, self.wifi.peopleDict)
+        if i % 2 == 0:
+            self.timed("turnOn", self.hvac.turnOn, "HEAT")
+        else:
+            self.timed("turnOff", self.hvac.turnOff, "HEAT")
+        self.times["loop"].append(time.perf_counter_ns() - started)
+
+    def run(self):
+        self.setup()
+        try:
+            # Warm up, then time, then one more round just for allocations
+            for i in range(10):
+                self.onePass(i)
+            self.times = {phase: [] for phase in PHASES}
+            started = time.perf_counter()
+            for i in range(self.passes):
+                self.onePass(i)
+            elapsed = time.perf_counter() - started
+            times = self.times
+            self.times = {phase: [] for phase in PHASES}
+            # The weather server runs in this process, so its thread shows up in
+            # the weather peak now and then.  Enough passes catch the worst of it
+            # every run, instead of only sometimes.
+            tracemalloc.start()
+            for i in range(ALLOCATION_PASSES):
+                self.onePass(i)
+            tracemalloc.stop()
+            self.times = times
+        finally:
+            self.teardown()
+        return self.results(elapsed)
+
+    def results(self, elapsed):
+        results = {"passesPerSecond": round(self.passes / elapsed, 1), "phases": {}}
+        for phase, values in self.times.items():
+            results["phases"][phase] = {
+                "p50us": round(percentile(values, .5) / 1000, 1),
+                "p99us": round(percentile(values, .99) / 1000, 1),
+                "allocBytes": self.allocations[phase]
+                }
+        return results
+
+def best(runs):
+    """
+    Combine the results of several runs, keeping the best of each number
+    """
+    results = {"passesPerSecond": max(run["passesPerSecond"] for run in runs), "phases": {}}
+    for phase in runs[0]["phases"]:
+        results["phases"][phase] = {key: min(run["phases"][phase][key] for run in runs) for key in ("p50us", "p99us", "allocBytes")}
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of the numbers that got worse than the baseline by more than tolerance
+    """
+    regressions = []
+    if results["passesPerSecond"] < baseline["passesPerSecond"] * (1 - tolerance):
+        regressions.append("passesPerSecond {} < baseline {}".format(results["passesPerSecond"], baseline["passesPerSecond"]))
+    for phase, numbers in results["phases"].items():
+        base = baseline["phases"].get(phase)
+        if not base:
+            continue
+        # Ignore anything that is too quick to time reliably
+        if numbers["p50us"] > max(base["p50us"] * (1 + tolerance), base["p50us"] + 20):
+            regressions.append("{} p50us {} > baseline {}".format(phase, numbers["p50us"], base["p50us"]))
+        if numbers["allocBytes"] > max(base["allocBytes"] * (1 + tolerance), base["allocBytes"] + 1024):
+            regressions.append("{} allocBytes {} > baseline {}".format(phase, numbers["allocBytes"], base["allocBytes"]))
+    return regressions
+
+def report(results, baseline=None):
+    print("{:<15}{:>12}{:>12}{:>14}".format("phase", "p50 us", "p99 us", "alloc bytes"))
+    for phase, numbers in results["phases"].items():
+        line = "{:<15}{:>12}{:>12}{:>14}".format(phase, numbers["p50us"], numbers["p99us"], numbers["allocBytes"])
+        if baseline and phase in baseline["phases"]:
+            line += "   (baseline p50 {})".format(baseline["phases"][phase]["p50us"])
+        print(line)
+    print("passes per second {}".format(results["passesPerSecond"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the thermostat control loop")
+    parser.add_argument("--passes", type=int, default=300)
+    parser.add_argument("--runs", type=int, default=3, help="Keep the best of this many runs")
+    parser.add_argument("--tolerance", type=float, default=.5, help="How much worse than the baseline is allowed (.5 => 50%%)")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args()
+
+    results = best([Benchmark(args.passes).run() for run in range(max(1, args.runs))])
+
+    if args.save:
+        with open(args.baseline, "w") as bFile:
+            json.dump(results, bFile, indent=4)
+        report(results)
+        print("Baseline saved to {}".format(args.baseline))
+        sys.exit(0)
+
+    try:
+        with open(args.baseline, "r") as bFile:
+            baseline = json.load(bFile)
+    except FileNotFoundError:
+        baseline = None
+    report(results, baseline)
+    if baseline is None:
+        print("No baseline at {}.  Run with --save to make one".format(args.baseline))
+        sys.exit(0)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION  {}".format(regression))
+    sys.exit(1 if regressions else 0)
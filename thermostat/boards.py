@@ -0,0 +1,301 @@
+"""
+boards.py
+
+The boards the thermostat can talk to.
+
+Board is the part of the pymata4 interface the thermostat uses.  A real
+pymata4.Pymata4 already fits it, so openBoard() just hands one back.
+SimulatedBoard is an in process stand in that models the house, so the whole
+thermostat can run without an Arduino (and, with a clock.VirtualClock, much
+faster than real time).
+
+BoardPool puts several boards behind one Board.  Each board gets a pin offset,
+so pin 103 is pin 3 on the board with offset 100, and the rest of the
+thermostat keeps using plain pin numbers.
+"""
+
+import concurrent.futures
+import logging
+import math
+import random
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.boards")
+
+class Board():
+    """
+    What the thermostat needs from a board
+    """
+    def set_pin_mode_analog_input(self, pin_number, callback=None, differential=1):
+        raise NotImplementedError
+
+    def set_pin_mode_digital_output(self, pin_number):
+        raise NotImplementedError
+
+    def analog_read(self, pin):
+        """
+        Returns (value, timeStamp)
+        """
+        raise NotImplementedError
+
+    def digital_write(self, pin, value):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+def openBoard(**kwargs):
+    """
+    Open a real Firmata board.  kwargs go straight to pymata4.Pymata4
+    (com_port, arduino_instance_id, ...)
+    """
+    from pymata4 import pymata4
+    return pymata4.Pymata4(**kwargs)
+
+class BoardPool(Board):
+    """
+    <dict> boards => {pinOffset: board}.  Every pin from pinOffset up to the next
+        offset belongs to that board.
+    """
+    def __init__(self, boards):
+        self.LOGGER = logging.getLogger("__main__.boards.BoardPool")
+        self.boards = dict(sorted(boards.items()))
+        self.offsets = sorted(self.boards, reverse=True)
+        self.__located = {}
+        # One worker per board, so each serial port is only ever used by one thread at a time
+        self.__workers = {offset: concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="board{}".format(offset)) for offset in self.boards}
+
+        self.LOGGER.debug("Created BoardPool with offsets {}".format(list(self.boards)))
+
+    def locate(self, pin):
+        """
+        Returns (pinOffset, board, localPin)
+        """
+        located = self.__located.get(pin)
+        if located is None:
+            for offset in self.offsets:
+                if pin >= offset:
+                    located = (offset, self.boards[offset], pin - offset)
+                    break
+            else:
+                raise ValueError("Pin {} is not on any board".format(pin))
+            self.__located[pin] = located
+        return located
+
+    def set_pin_mode_analog_input(self, pin_number, callback=None, differential=1):
+        offset, board, local = self.locate(pin_number)
+        report = callback
+        if callback and offset:
+            # The board reports its own pin number, give the callback the pool's
+            def report(data):
+                callback([data[0], data[1] + offset] + list(data[2:]))
+        board.set_pin_mode_analog_input(local, callback=report, differential=differential)
+
+    def set_pin_mode_digital_output(self, pin_number):
+        offset, board, local = self.locate(pin_number)
+        board.set_pin_mode_digital_output(local)
+
+    def analog_read(self, pin):
+        offset, board, local = self.locate(pin)
+        return board.analog_read(local)
+
+    def digital_write(self, pin, value):
+        offset, board, local = self.locate(pin)
+        board.digital_write(local, value)
+
+    def forEachPin(self, pins, function):
+        """
+        Call function(pin) for every pin.  Pins on the same board are done one
+        after another, the boards are done at the same time.
+        Returns {pin: result}
+        """
+        byBoard = {}
+        for pin in pins:
+            byBoard.setdefault(self.locate(pin)[0], []).append(pin)
+        if len(byBoard) == 1:
+            return {pin: function(pin) for pin in pins}
+        futures = {offset: self.__workers[offset].submit(lambda boardPins: [(pin, function(pin)) for pin in boardPins], boardPins) for offset, boardPins in byBoard.items()}
+        results = {}
+        for future in futures.values():
+            results.update(future.result())
+        return results
+
+    def shutdown(self):
+        for worker in self.__workers.values():
+            worker.shutdown(wait=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.boards)) as closer:
+            for future in [closer.submit(board.shutdown) for board in self.boards.values()]:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.LOGGER.error("Could not shut down a board  {}".format(e))
+
+def forEachPin(board, pins, function):
+    """
+    Call function(pin) for every pin, in parallel across the boards of a BoardPool.
+    Returns {pin: result}
+    """
+    if isinstance(board, BoardPool):
+        return board.forEachPin(pins, function)
+    return {pin: function(pin) for pin in pins}
+
+def openPool(boardSettings, opener=openBoard):
+    """
+    Open every board in SETTINGS["BOARDS"] at the same time.  With one board at
+    offset 0 that board is returned as it is.
+    boardSettings => {name: {"PIN_OFFSET": 0, "COM_PORT": None, "INSTANCE_ID": None}}
+    """
+    def open(settings):
+        kwargs = {}
+        if settings.get("COM_PORT"):
+            kwargs["com_port"] = settings["COM_PORT"]
+        if settings.get("INSTANCE_ID") is not None:
+            kwargs["arduino_instance_id"] = settings["INSTANCE_ID"]
+        return opener(**kwargs)
+
+    if not boardSettings:
+        return opener()
+    offsets = {}
+    for name, settings in boardSettings.items():
+        offset = int(settings.get("PIN_OFFSET") or 0)
+        if offset in offsets.values():
+            raise ValueError("Board {} has the same PIN_OFFSET as another board".format(name))
+        offsets[name] = offset
+    if len(boardSettings) == 1 and not list(offsets.values())[0]:
+        return open(list(boardSettings.values())[0])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(boardSettings)) as opening:
+        futures = {name: opening.submit(open, settings) for name, settings in boardSettings.items()}
+    opened = {}
+    failed = None
+    for name, future in futures.items():
+        try:
+            opened[offsets[name]] = future.result()
+        except Exception as e:
+            LOGGER.error("Could not open board {}  {}".format(name, e))
+            failed = e
+    if failed:
+        # Do not leave the boards that did open holding their serial ports
+        for board in opened.values():
+            board.shutdown()
+        raise failed
+    LOGGER.info("Opened boards {}".format(sorted(boardSettings)))
+    return BoardPool(opened)
+
+class SimulatedBoard(Board):
+    """
+    A house on a board.
+
+    The house has one indoor temp with thermal mass.  It leaks heat to the
+    outdoors and gains it from whichever relays are latched on.  Every sensor pin
+    reads that temp through an LM35 (10mV per degree C on a 5V 10 bit ADC), with
+    its own small offset and noise.
+
+    <dict> relayPins => {"HEAT": (onPin, offPin), "COOL": (...), "VENT": (...)}
+    <float> indoorC => Starting indoor temp
+    <float> outdoorMeanC, outdoorSwingC => The outdoor temp follows a daily sine wave
+        that is coldest at 5 in the morning
+    <float> leak => How fast (per hour) the house moves toward the outdoor temp
+    <float> heatRate, coolRate => Degrees C per hour from the heater / AC
+    <float> noise => Standard deviation of the sensor noise in raw ADC counts
+    """
+    def __init__(self, relayPins, indoorC=18.0, outdoorMeanC=2.0, outdoorSwingC=6.0, leak=.08, heatRate=4.0, coolRate=3.0, noise=.3, seed=None):
+        self.LOGGER = logging.getLogger("__main__.boards.SimulatedBoard")
+        self.relayPins = relayPins
+        self.indoorC = indoorC
+        self.outdoorMeanC = outdoorMeanC
+        self.outdoorSwingC = outdoorSwingC
+        self.leak = leak
+        self.heatRate = heatRate
+        self.coolRate = coolRate
+        self.noise = noise
+        self.random = random.Random(seed)
+
+        self.relays = {componant: "OFF" for componant in relayPins}
+        self.pins = {}
+        self.analogPins = {}
+        self.actuations = 0
+        self.__last = clock.CLOCK.monotonic()
+
+        self.LOGGER.debug("Created SimulatedBoard")
+
+    @property
+    def outdoorC(self):
+        now = clock.CLOCK.now()
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        return self.outdoorMeanC - self.outdoorSwingC * math.cos((hour - 5) / 24 * 2 * math.pi)
+
+    def advance(self):
+        """
+        Move the house forward to the current clock time
+        """
+        now = clock.CLOCK.monotonic()
+        hours = (now - self.__last) / 3600
+        self.__last = now
+        if hours <= 0:
+            return
+        # Small steps so a long jump does not overshoot
+        steps = max(1, int(hours * 60))
+        dt = hours / steps
+        for step in range(steps):
+            rate = self.leak * (self.outdoorC - self.indoorC)
+            if self.relays.get("HEAT") == "ON":
+                rate += self.heatRate
+            if self.relays.get("COOL") == "ON":
+                rate -= self.coolRate
+            self.indoorC += rate * dt
+
+    def rawValue(self, pin):
+        offset = self.analogPins[pin]["offset"]
+        return max(0, int(round((self.indoorC + offset) / 0.48828125 + self.random.gauss(0, self.noise))))
+
+    def set_pin_mode_analog_input(self, pin_number, callback=None, differential=1):
+        self.analogPins[pin_number] = {
+            "callback": callback,
+            "differential": differential,
+            # Every sensor is a little off from the others
+            "offset": self.random.uniform(-.3, .3),
+            "value": None
+            }
+
+    def set_pin_mode_digital_output(self, pin_number):
+        self.pins[pin_number] = 0
+
+    def analog_read(self, pin):
+        self.advance()
+        if pin not in self.analogPins:
+            return 0, clock.CLOCK.time()
+        value = self.rawValue(pin)
+        self.analogPins[pin]["value"] = value
+        return value, clock.CLOCK.time()
+
+    def digital_write(self, pin, value):
+        self.advance()
+        self.pins[pin] = value
+        if not value:
+            return
+        # A pulse on a latching relay's pin flips it
+        for componant, (onPin, offPin) in self.relayPins.items():
+            if pin == onPin:
+                self.relays[componant] = "ON"
+                self.actuations += 1
+            elif pin == offPin:
+                self.relays[componant] = "OFF"
+                self.actuations += 1
+
+    def tick(self):
+        """
+        Move the house forward and report any analog pin that changed enough,
+        the way pymata4 does from its reporting thread
+        """
+        self.advance()
+        for pin, analogPin in self.analogPins.items():
+            value = self.rawValue(pin)
+            last = analogPin["value"]
+            if last is None or abs(value - last) >= analogPin["differential"]:
+                analogPin["value"] = value
+                if analogPin["callback"]:
+                    analogPin["callback"]([2, pin, value, clock.CLOCK.time()])
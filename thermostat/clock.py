@@ -0,0 +1,72 @@
+"""
+clock.py
+
+All of the thermostat's timing goes through clock.CLOCK, so a simulation can swap
+the real clock for a VirtualClock and run a day in a fraction of a second.
+
+Always look it up as clock.CLOCK (not "from clock import CLOCK") so a swap is
+seen everywhere.
+"""
+
+import datetime
+import time
+
+class SystemClock():
+    """
+    The real time
+    """
+    def now(self):
+        return datetime.datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class VirtualClock():
+    """
+    A clock that only moves when it is told to.  sleep() just moves it forward.
+
+    start => The datetime the clock starts at
+    """
+    def __init__(self, start=None):
+        if start is None:
+            start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start = start
+        self.__elapsed = 0.0
+        self.__epoch = start.timestamp()
+
+    @property
+    def elapsed(self):
+        return self.__elapsed
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.__elapsed)
+
+    def time(self):
+        return self.__epoch + self.__elapsed
+
+    def monotonic(self):
+        return self.__elapsed
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.__elapsed += seconds
+
+CLOCK = SystemClock()
+
+def setClock(newClock):
+    """
+    Swap the clock everything uses.  Returns the old one.
+    """
+    global CLOCK
+    oldClock = CLOCK
+    CLOCK = newClock
+    return oldClock
@@ -0,0 +1,192 @@
+"""
+configwatch.py
+
+Watches the settings files and hands over the new settings when they change.
+
+On Linux it uses inotify on the folders the files are in (editors usually write
+a new file and rename it over the old one).  Anywhere inotify is not available it
+falls back to checking the modification times every few seconds.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger("__main__.configwatch")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct("iIII")
+
+def diffSettings(old, new):
+    """
+    Returns the top level settings that are different, with TEMP_SETTINGS
+    broken down to the state that changed, ie {"WIFI", "TEMP_SETTINGS.HEAT"}
+    """
+    changed = set()
+    for key in set(old) | set(new):
+        if old.get(key) == new.get(key):
+            continue
+        if isinstance(old.get(key), dict) and isinstance(new.get(key), dict) and key == "TEMP_SETTINGS":
+            for subKey in set(old[key]) | set(new[key]):
+                if old[key].get(subKey) != new[key].get(subKey):
+                    changed.add("{}.{}".format(key, subKey))
+        else:
+            changed.add(key)
+    return changed
+
+class Inotify():
+    """
+    Just enough of inotify, through ctypes
+    """
+    def __init__(self):
+        libcName = ctypes.util.find_library("c")
+        if not libcName:
+            raise OSError("No libc to get inotify from")
+        self.libc = ctypes.CDLL(libcName, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, folder, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MODIFY):
+        wd = self.libc.inotify_add_watch(self.fd, str(folder).encode(), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(folder))
+        return wd
+
+    def read(self, timeout):
+        """
+        Returns the names of the files that had events, waiting at most timeout seconds
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            names.append(data[offset:offset + length].rstrip(b"\x00").decode(errors="replace"))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class ConfigWatcher():
+    """
+    <list> paths => The settings files to watch
+    <function> load => Loads and returns the full settings.  It may raise, or
+        return None, if the files are broken; the change is ignored then.
+    <function> onChange => Called with (newSettings, changedKeys) from the watcher thread.
+        If it returns False the new settings were turned down, and the next
+        change is compared to the running ones again.
+    <float> interval => Seconds between checks when polling
+    <float> settle => Wait this long after a change so a half written file is not read
+    """
+    def __init__(self, paths, load, onChange, settings=None, interval=2, settle=.2):
+        self.LOGGER = logging.getLogger("__main__.configwatch.ConfigWatcher")
+        self.paths = [Path(p) for p in paths]
+        self.load = load
+        self.onChange = onChange
+        self.interval = interval
+        self.settle = settle
+        self.settings = settings
+
+        self.__running = False
+        self.__thread = None
+        self.__mtimes = self.mtimes()
+
+    def mtimes(self):
+        times = {}
+        for path in self.paths:
+            try:
+                times[path] = path.stat().st_mtime_ns
+            except OSError:
+                times[path] = None
+        return times
+
+    def start(self):
+        if self.settings is None:
+            self.settings = self.load()
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="ConfigWatcher", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread:
+            self.__thread.join()
+
+    def check(self):
+        """
+        Reload the settings and report what changed.  Returns the changed keys.
+        """
+        self.__mtimes = self.mtimes()
+        try:
+            newSettings = self.load()
+        except Exception as e:
+            newSettings = None
+            self.LOGGER.error("Could not load the changed settings  {}".format(e))
+        if not newSettings:
+            self.LOGGER.error("Changed settings did not load.  Keeping the running settings")
+            return set()
+        changed = diffSettings(self.settings or {}, newSettings)
+        if changed:
+            self.LOGGER.info("Settings changed  {}".format(sorted(changed)))
+            accepted = True
+            try:
+                accepted = self.onChange(newSettings, changed) is not False
+            except Exception as e:
+                self.LOGGER.error("Could not apply the changed settings  {}".format(e))
+            if accepted:
+                self.settings = newSettings
+        return changed
+
+    def __run(self):
+        inotify = None
+        names = {path.name for path in self.paths}
+        try:
+            inotify = Inotify()
+            for folder in {path.parent for path in self.paths}:
+                if folder.exists():
+                    inotify.watch(folder)
+            self.LOGGER.debug("Watching {} with inotify".format([str(p) for p in self.paths]))
+        except Exception as e:
+            self.LOGGER.debug("No inotify, polling the settings instead  {}".format(e))
+            if inotify:
+                inotify.close()
+            inotify = None
+        try:
+            while self.__running:
+                if inotify:
+                    if not names.intersection(inotify.read(1)):
+                        continue
+                else:
+                    time.sleep(self.interval)
+                    if self.mtimes() == self.__mtimes:
+                        continue
+                time.sleep(self.settle)
+                if inotify:
+                    # Drain whatever else the editor did while we waited
+                    inotify.read(0)
+                self.check()
+        finally:
+            if inotify:
+                inotify.close()
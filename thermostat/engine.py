@@ -0,0 +1,677 @@
+"""
+engine.py
+
+The asyncio runtime for the thermostat.
+
+Each job runs in its own task so nothing waits on anything it does not need:
+
+    acquire  => reads the sensors once and publishes the temp of every zone
+    weather  => refreshes the forecast
+    occupancy => refreshes who is home
+    control  => decides what the HVAC of every zone should be doing, starting
+                early when the zone's thermal model says it has to
+    actuate  => flips the relays, for every zone from the one queue
+
+Blocking pymata4 calls run in a single hardware thread so the board is only ever
+used from one place.  Network calls (weather, pings) run in the default executor.
+The tasks only talk to each other through LatestValue channels and the actuation
+queue, so the heating decision never waits behind a network call.
+
+Nothing spins.  The control task sleeps until a zone's temp crosses a whole
+degree, the forecast or occupancy changes, the settings or a mode change, or
+the next deadline comes up (the next minute of the schedule, or a relay timer
+running out).  The weather and occupancy tasks sleep until they are due.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import hvactools
+except ModuleNotFoundError:
+    import thermostat.hvactools as hvactools
+try:
+    import metrics
+except ModuleNotFoundError:
+    import thermostat.metrics as metrics
+try:
+    import runconfig
+except ModuleNotFoundError:
+    import thermostat.runconfig as runconfig
+try:
+    import thermal
+except ModuleNotFoundError:
+    import thermostat.thermal as thermal
+try:
+    import zones as zonesModule
+except ModuleNotFoundError:
+    import thermostat.zones as zonesModule
+
+LOGGER = logging.getLogger("__main__.engine")
+
+# Settings that only take effect when the thermostat is restarted.  Changing
+# them live would mean reconnecting the board or cycling the relays.
+RESTART_SETTINGS = {"BOARDS", "HVAC", "SENSORS", "SENSOR_GROUPS", "MQTT", "USER_DIR", "USER_CONFIG", "STATUS_FILE", "RELAY_JOURNAL", "METRICS", "LOGGING", "MIN_VERSION"}
+
+LOOP_SECONDS = metrics.histogram("thermostat_loop_seconds", "How long one pass of a task takes", ["task"])
+STATE = metrics.gauge("thermostat_state", "1 for the state the thermostat is in", ["zone", "state"])
+DESIRED_TEMP = metrics.gauge("thermostat_desired_temp", "The temp the thermostat is aiming for", ["zone"])
+HOUSE_TEMP = metrics.gauge("thermostat_house_temp", "The last temp the control loop saw", ["zone"])
+TARGET_TEMP = metrics.gauge("thermostat_target_temp", "The temp being controlled to, ahead of the schedule when recovering early", ["zone"])
+
+class LatestValue():
+    """
+    A channel that only keeps the newest value.  Readers never see a backlog,
+    they either take what is there or wait for the next one.
+    """
+    def __init__(self, value=None):
+        self.__value = value
+        self.__version = 0
+        self.__changed = asyncio.Event()
+
+    @property
+    def value(self):
+        return self.__value
+
+    @property
+    def version(self):
+        return self.__version
+
+    def set(self, value):
+        self.__value = value
+        self.__version += 1
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+    async def wait(self, version=None):
+        """
+        Wait until there is a value newer than version, then return (value, version)
+        """
+        if version is None:
+            version = self.__version
+        while self.__version == version:
+            await self.__changed.wait()
+        return self.__value, self.__version
+
+class ControlEngine():
+    """
+    <HVAC> hvac => from hvac.setup
+    <WeatherForecast> weather
+    <WiFi> wifi
+    <dict> settings => The loaded SETTINGS
+    <float> period => How often, in seconds, the sensors are read and the control decision is made
+    <MQTTClient> mqtt => Where to publish the temps and occupancy, or None
+    <StatusWriter> status => Where to write the status snapshot for the UI, or None
+    <list> zones => from zones.setup, or None for just the HOUSE zone on hvac
+    <Config> config => settings already checked by runconfig.compile, or None to check them here
+    """
+    def __init__(self, hvac, weather, wifi, settings, period=1, mqtt=None, status=None, zones=None, config=None):
+        self.LOGGER = logging.getLogger("__main__.engine.ControlEngine")
+        self.hvac = hvac
+        self.weather = weather
+        self.wifi = wifi
+        self.settings = settings
+        # What the loop reads.  Raises runconfig.ConfigError if the settings are not valid.
+        self.config = config if config else runconfig.compile(settings)
+        self.period = period
+        self.mqtt = mqtt
+        self.status = status
+        # The first zone is the default one, controlled by hvac
+        self.zones = zones if zones else [zonesModule.Zone(zonesModule.DEFAULT_ZONE, "HOUSE", hvac, tempSettings=settings["TEMP_SETTINGS"])]
+        self.zoneNames = {zone.name: zone for zone in self.zones}
+
+        self.houseTemp = None
+        self.forecast = None
+        self.occupied = None
+        self.actions = None
+
+        # zone name => (what the plan was worked out from, the temp to control to)
+        self.targets = {}
+        self.lookahead = 0
+        # relay => its delay before MIN_CYCLE_MINUTES was applied
+        self.relayDelays = {}
+        # Zones already turned off for MANUAL, so the relays are only pulsed once
+        self.manualZones = set()
+        # Set for anything outside the channels that should wake the control task
+        self.wakeups = None
+
+        if not hvac.thermostat.schedules:
+            hvac.thermostat.compileSchedules(settings["TEMP_SETTINGS"])
+        self.applyTempLimits(self.config.tempSettings)
+        self.applyModelSettings(self.config.model)
+        hvac.thermostat.configureHealth(**self.config.sensorHealth.settings())
+
+        # Read when the metrics are, so the loop does not pay for them
+        for zone in self.zones:
+            for state in zone.thermostat.validStates:
+                STATE.labels(zone.name, state).setFunction(lambda zone=zone, state=state: 1 if zone.thermostat.state == state else 0)
+            DESIRED_TEMP.labels(zone.name).setFunction(lambda zone=zone: zone.thermostat.desiredTemp)
+            HOUSE_TEMP.labels(zone.name).setFunction(lambda zone=zone: zone.houseTemp.value if zone.houseTemp else None)
+            TARGET_TEMP.labels(zone.name).setFunction(lambda zone=zone: self.targets[zone.name][1] if zone.name in self.targets else None)
+
+        for zone in self.zones:
+            zone.thermostat.onChange = self.wake
+
+        # Save what the models learned every hour, so a restart does not lose it
+        self.modelSaver = hvactools.TimedObject(60)
+        self.modelSaver.lastCheck = clock.CLOCK.now()
+
+        self.__hardware = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="hardware")
+        self.__pending = set()
+        self.__loop = None
+        self.__stopped = None
+
+        self.LOGGER.debug("Created ControlEngine")
+
+    def prepare(self):
+        """
+        Make the channels the tasks talk through
+        """
+        for zone in self.zones:
+            zone.houseTemp = LatestValue()
+        # The default zone's temp is the house temp
+        self.houseTemp = self.zones[0].houseTemp
+        self.forecast = LatestValue(self.weather.forecast)
+        self.occupied = LatestValue(self.wifi.occupied)
+        self.wakeups = LatestValue()
+        self.actions = asyncio.Queue()
+
+    async def run(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stopped = asyncio.Event()
+        self.prepare()
+
+        tasks = [
+            asyncio.create_task(self.acquire(), name="acquire"),
+            asyncio.create_task(self.refreshWeather(), name="weather"),
+            asyncio.create_task(self.refreshOccupancy(), name="occupancy"),
+            asyncio.create_task(self.control(), name="control"),
+            asyncio.create_task(self.actuate(), name="actuate"),
+            ]
+        await self.__stopped.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__hardware.shutdown(wait=True)
+        self.LOGGER.info("Control engine stopped")
+
+    def stop(self):
+        """
+        Safe to call from a signal handler or any other thread
+        """
+        if self.__loop and self.__stopped:
+            self.__loop.call_soon_threadsafe(self.__stopped.set)
+
+    def publish(self, topic, message):
+        """
+        Only queues the message, MQTTClient sends it in the background
+        """
+        if self.mqtt:
+            self.mqtt.publish(topic, message)
+
+    def writeStatus(self):
+        """
+        Write everything the UI shows into the status snapshot.  Only reads
+        what is already in memory.
+        """
+        if not self.status:
+            return
+        hvac = self.hvac
+        thermostat = hvac.thermostat
+        forecast = self.forecast.value if self.forecast else self.weather.forecast
+        outsideTemp = forecastHigh = forecastLow = None
+        try:
+            outsideTemp = forecast["currently"]["temperature"]
+            forecastHigh = forecast["daily"]["data"][0]["temperatureHigh"]
+            forecastLow = forecast["daily"]["data"][0]["temperatureLow"]
+        except (TypeError, KeyError, IndexError):
+            pass
+        self.status.write(
+            houseTemp=self.houseTemp.value if self.houseTemp else None,
+            outsideTemp=outsideTemp,
+            forecastHigh=forecastHigh,
+            forecastLow=forecastLow,
+            desiredTemp=thermostat.desiredTemp,
+            tempModifier=thermostat.tempModifier,
+            weatherUpdated=self.weather.lastCheck,
+            occupancyUpdated=self.wifi.lastCheck,
+            state=thermostat.state,
+            mode=thermostat.mode,
+            heater=hvac.heater.state,
+            ac=hvac.ac.state,
+            vent=hvac.vent.state,
+            occupied=self.occupied.value if self.occupied else self.wifi.occupied,
+            peopleHome=len(self.wifi.home or ()),
+            groups={group: thermostat.getTemp(group) for group in thermostat.sensorGroups}
+            )
+
+    def wake(self, reason=None):
+        """
+        Have the control task make its decision again now.  Safe to call from any thread.
+        """
+        if not self.wakeups:
+            return
+        if self.__loop and self.__loop.is_running():
+            self.__loop.call_soon_threadsafe(self.wakeups.set, reason)
+        else:
+            self.wakeups.set(reason)
+
+    async def idle(self, seconds, channels):
+        """
+        Sleep for seconds, or until one of the channels has moved past its version
+        channels => [(LatestValue, version)]
+        """
+        waiters = [asyncio.ensure_future(channel.wait(version)) for channel, version in channels]
+        try:
+            await asyncio.wait(waiters, timeout=max(seconds, self.period), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    def nextDeadline(self, now=None):
+        """
+        Seconds until the decision could come out differently with nothing else
+        changing.  That is the next minute of the schedule, or the soonest of the
+        thermostat and relay timers that is still running.
+        """
+        if now is None:
+            now = clock.CLOCK.now()
+        deadlines = [60 - now.second - now.microsecond / 1e6]
+        for zone in self.zones:
+            for timed in (zone.thermostat, zone.hvac.heater, zone.hvac.ac):
+                left = timed.secondsLeft(now)
+                if left > 0:
+                    deadlines.append(left)
+        return min(deadlines)
+
+    async def onHardware(self, function, *args):
+        return await self.__loop.run_in_executor(self.__hardware, function, *args)
+
+    async def onNetwork(self, function, *args):
+        return await self.__loop.run_in_executor(None, function, *args)
+
+    #########################################
+    # Settings
+    #########################################
+
+    def reloadSettings(self, settings, changed):
+        """
+        Called by configwatch.ConfigWatcher from its own thread.  The change is
+        applied on the event loop, between control passes, so a pass sees either
+        all of the old settings or all of the new ones.  Settings that do not
+        pass runconfig.compile are not applied at all, and False is returned.
+        """
+        try:
+            config = runconfig.compile(settings)
+        except runconfig.ConfigError as e:
+            self.LOGGER.error("Not applying the changed settings.  {}".format(e))
+            return False
+        if self.__loop and not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self.applySettings, settings, changed, config)
+        else:
+            self.applySettings(settings, changed, config)
+        return True
+
+    def applyTempLimits(self, tempSettings):
+        """
+        tempSettings => runconfig.TempSettings
+        """
+        thermostat = self.hvac.thermostat
+        if tempSettings.minTemp is not None:
+            thermostat.minTemp = tempSettings.minTemp
+        if tempSettings.maxTemp is not None:
+            thermostat.maxTemp = tempSettings.maxTemp
+
+    def applyModelSettings(self, model):
+        """
+        model => runconfig.ModelConfig
+        """
+        self.lookahead = model.lookaheadMinutes or 0
+        # The relays stay on (or off) at least this long, however the temp moves.
+        # Without MIN_CYCLE_MINUTES each relay keeps the delay it was made with.
+        for zone in self.zones:
+            for relay in (zone.hvac.heater, zone.hvac.ac):
+                ownDelay = self.relayDelays.setdefault(relay, relay.delay)
+                relay.delay = ownDelay if model.minCycleMinutes is None else max(ownDelay, model.minCycleMinutes)
+        self.targets.clear()
+
+    def applySettings(self, settings, changed, config=None):
+        """
+        Apply only the parts of settings that changed to the running objects
+        changed => The keys from configwatch.diffSettings
+        config => settings compiled by runconfig.compile, or None to compile them here
+        """
+        if config is None:
+            config = runconfig.compile(settings)
+        self.config = config
+        thermostat = self.hvac.thermostat
+        tempSettings = settings["TEMP_SETTINGS"]
+        states = {key.split(".", 1)[1] for key in changed if key.startswith("TEMP_SETTINGS.")}
+        if "TEMP_SETTINGS" in changed:
+            thermostat.compileSchedules(tempSettings)
+        elif states:
+            thermostat.compileSchedules(tempSettings, states)
+        if "TEMP_SETTINGS" in changed or {"MIN_TEMP", "MAX_TEMP"} & states:
+            self.applyTempLimits(config.tempSettings)
+        if "TEMP_SETTINGS" in changed or "DEFAULT_TEMP" in states:
+            thermostat.defaultTemp = config.tempSettings.defaultTemp
+        self.zones[0].tempSettings = tempSettings
+
+        # The other zones either have their own TEMP_SETTINGS or follow the top level ones
+        zoneSettings = settings.get("ZONES") or {}
+        for zone in self.zones[1:]:
+            own = (zoneSettings.get(zone.name) or {}).get("TEMP_SETTINGS")
+            if own and "ZONES" in changed and own != zone.tempSettings:
+                zone.compile(own)
+            elif not own and (states or "TEMP_SETTINGS" in changed):
+                zone.compile(tempSettings)
+        if "ZONES" in changed:
+            self.LOGGER.warning("ZONES changed.  New zones, removed zones and pin changes are used after a restart")
+
+        if "SENSOR_AGGREGATION" in changed:
+            thermostat.aggregation = settings.get("SENSOR_AGGREGATION") or {}
+            thermostat.buildIndex()
+
+        if "SENSOR_HEALTH" in changed:
+            thermostat.configureHealth(**config.sensorHealth.settings())
+
+        if "WIFI" in changed:
+            self.wifi.peopleDict = config.wifi.people
+            # Find out who is home by the new list on the next pass
+            self.wifi.lastCheck = None
+
+        if "PRESENCE" in changed and self.wifi.presence:
+            self.wifi.presence.presentTTL = config.presence.presentTTL
+            self.wifi.presence.absentTTL = config.presence.absentTTL
+            self.wifi.presence.table.path = config.presence.neighborTable
+
+        if "MODEL" in changed:
+            self.applyModelSettings(config.model)
+
+        if "WEATHER" in changed and config.weather.url:
+            self.weather.url = config.weather.url
+
+        for key in sorted(changed & RESTART_SETTINGS):
+            self.LOGGER.warning("{} changed.  It will be used after a restart".format(key))
+
+        self.settings = settings
+        self.LOGGER.info("Applied settings changes {}".format(sorted(changed - RESTART_SETTINGS)))
+        self.wake("settings")
+
+    #########################################
+    # Tasks
+    #########################################
+
+    async def acquire(self):
+        while True:
+            started = time.perf_counter()
+            try:
+                # One read of the sensors for every zone
+                await self.onHardware(self.hvac.thermostat.updateSensors, self.hvac.board)
+                for zone in self.zones:
+                    zoneTemp = zone.temp()
+                    # Only a whole degree change is news, the control task sleeps through the rest
+                    if zoneTemp is not None and round(zoneTemp) != zone.houseTemp.value:
+                        zone.houseTemp.set(round(zoneTemp))
+                        LOGGER.debug("{} temp is {}".format(zone.name, round(zoneTemp)))
+                        self.publish(zone.topic, round(zoneTemp))
+            except Exception as e:
+                self.LOGGER.error("Could not read the sensors  {}".format(e))
+            LOOP_SECONDS.labels("acquire").observe(time.perf_counter() - started)
+            await asyncio.sleep(self.period)
+
+    async def refreshWeather(self):
+        while True:
+            version = self.wakeups.version
+            # Check the weather every "delay" minutes
+            if self.weather.shouldUpdate():
+                await self.onNetwork(self.weather.update, self.weather.url)
+                if self.weather.forecast:
+                    self.forecast.set(self.weather.forecast)
+                    LOGGER.info("Temp outside is {}".format(self.weather.forecast["currently"]["temperature"]))
+                    self.publish("ziggy/climate/temp/outside", self.weather.forecast["currently"]["temperature"])
+            # A settings change may have moved the URL or the delay
+            await self.idle(self.weather.secondsLeft(), [(self.wakeups, version)])
+
+    async def refreshOccupancy(self):
+        while True:
+            version = self.wakeups.version
+            # Only check every so often => WIFI.delay
+            if self.wifi.shouldUpdate():
+                await self.onNetwork(self.wifi.update, self.config.wifi.people)
+                if self.wifi.occupied != self.occupied.value:
+                    self.occupied.set(self.wifi.occupied)
+                LOGGER.info("People home {}".format(self.wifi.home))
+                self.publish("ziggy/occupancy/people", str(self.wifi.home))
+            await self.idle(self.wifi.secondsLeft(), [(self.wakeups, version)])
+
+    async def control(self):
+        while True:
+            # Anything that changes after this is picked up by the next pass
+            channels = [(zone.houseTemp, zone.houseTemp.version) for zone in self.zones]
+            channels += [(channel, channel.version) for channel in (self.forecast, self.occupied, self.wakeups)]
+            started = time.perf_counter()
+            try:
+                self.decide()
+            except Exception as e:
+                self.LOGGER.error("Control decision failed  {}".format(e))
+            try:
+                self.writeStatus()
+            except Exception as e:
+                self.LOGGER.error("Could not write the status  {}".format(e))
+            if self.modelSaver.shouldUpdate():
+                self.modelSaver.lastCheck = clock.CLOCK.now()
+                for zone in self.zones:
+                    try:
+                        # Off the loop, but finished before the next one starts
+                        await self.onNetwork(zone.model.save)
+                    except Exception as e:
+                        self.LOGGER.error("Could not save the thermal model for {}  {}".format(zone.name, e))
+            LOOP_SECONDS.labels("control").observe(time.perf_counter() - started)
+            await self.idle(self.nextDeadline(), channels)
+
+    def takeActions(self, first=None):
+        """
+        Take every queued action off the queue.
+        Returns {zoneName: [(componant, "ON" | "OFF")]}, with only the last
+        command for each relay, and the actions that were taken.
+        """
+        actions = [first] if first else []
+        while not self.actions.empty():
+            actions.append(self.actions.get_nowait())
+        batches = {}
+        for zoneName, method, componant in actions:
+            componants = ["HEAT", "COOL", "VENT"] if componant == "ALL" else [componant]
+            batch = batches.setdefault(zoneName, {})
+            for name in componants:
+                # A later command for the same relay replaces the earlier one
+                batch.pop(name, None)
+                batch[name] = method
+        return {zoneName: list(batch.items()) for zoneName, batch in batches.items()}, actions
+
+    def finishActions(self, actions):
+        for action in actions:
+            self.__pending.discard(action)
+            self.actions.task_done()
+
+    async def actuate(self):
+        while True:
+            # Everything that was queued together goes to the board together
+            batches, actions = self.takeActions(await self.actions.get())
+            try:
+                for zoneName, changes in batches.items():
+                    try:
+                        await self.onHardware(self.zoneNames[zoneName].hvac.actuate, changes)
+                    except Exception as e:
+                        self.LOGGER.error("Could not move the {} relays {}  {}".format(zoneName, changes, e))
+            finally:
+                self.finishActions(actions)
+
+    def drain(self):
+        """
+        Carry out every queued relay change right here, without the event loop.
+        Used when stepping the engine by hand (see simulate.py).
+        """
+        batches, actions = self.takeActions()
+        try:
+            for zoneName, changes in batches.items():
+                self.zoneNames[zoneName].hvac.actuate(changes)
+        finally:
+            self.finishActions(actions)
+
+    #########################################
+    # Control logic
+    #########################################
+
+    def command(self, method, componant, zone=None):
+        """
+        Queue a relay change, unless the same change is already waiting
+        zone => The Zone, None for the default one
+        """
+        action = ((zone or self.zones[0]).name, method, componant)
+        if action not in self.__pending:
+            self.__pending.add(action)
+            self.actions.put_nowait(action)
+
+    def updateState(self, zone):
+        """
+        Set the state of the thermostat every "delay" minutes default => 1440 (one day)
+        """
+        thermostat = zone.thermostat
+        if thermostat.shouldUpdate():
+            forecast = self.forecast.value
+            try:
+                thermostat.update((forecast["daily"]["data"][0]["temperatureHigh"], forecast["daily"]["data"][0]["temperatureLow"], hvactools.checkTimeOfYear()))
+            except TypeError as e:
+                self.LOGGER.error("Error updating thermostat  {}".format(e))
+                # BUG:  Hack for if the weather fails
+                thermostat.update((thermostat.maxTemp, thermostat.minTemp, hvactools.checkTimeOfYear()))
+            LOGGER.info("Thermostat mode updated to {}".format(thermostat.state))
+
+    def updateDesiredTemp(self, zone):
+        thermostat = zone.thermostat
+        if thermostat.state != "OFF":
+            # One table lookup, only redone when the minute or occupancy changes
+            modifier = thermostat.updateModifier(self.occupied.value)
+            thermostat.desiredTemp = thermostat.schedules[thermostat.state].defaultTemp + modifier
+        else:
+            thermostat.desiredTemp = thermostat.defaultTemp if thermostat.defaultTemp is not None else self.config.tempSettings.defaultTemp
+
+    def decide(self):
+        """
+        One pass of the thermostat logic for every zone that has a temp.  Only
+        ever reads the latest values, never waits for them.
+        """
+        outsideTemp = self.outsideTemp()
+        for zone in self.zones:
+            if zone.houseTemp.value is not None:
+                hvac = zone.hvac
+                zone.model.observe(zone.temp(), outsideTemp, hvac.heater.state == "ON", hvac.ac.state == "ON")
+                self.decideZone(zone)
+
+    def outsideTemp(self):
+        try:
+            return self.forecast.value["currently"]["temperature"]
+        except (TypeError, KeyError):
+            return None
+
+    def targetTemp(self, zone, houseTemp):
+        """
+        The temp to control the zone to right now.  That is the desired temp,
+        unless the model says heating (or cooling) has to start now to reach a
+        later scheduled temp on time.  Worked out again at most once a minute.
+        """
+        thermostat = zone.thermostat
+        if thermostat.state not in ("HEAT", "COOL") or not self.lookahead or not zone.model.ready:
+            self.targets.pop(zone.name, None)
+            return thermostat.desiredTemp
+        now = clock.CLOCK.now()
+        outsideTemp = self.outsideTemp()
+        key = (thermostat.state, thermostat.desiredTemp, now.replace(second=0, microsecond=0), self.occupied.value, houseTemp, outsideTemp, zone.model.samples)
+        last = self.targets.get(zone.name)
+        if last and last[0] == key:
+            return last[1]
+
+        heating = thermostat.state == "HEAT"
+        target = thermostat.desiredTemp
+        plan = thermal.recoveryPlan(zone.model, thermostat.schedules[thermostat.state], houseTemp, outsideTemp, self.occupied.value, heating, now, self.lookahead)
+        if plan:
+            early, minutes = plan
+            target = max(target, early) if heating else min(target, early)
+            if target != thermostat.desiredTemp and (not last or last[1] != target):
+                LOGGER.info("{} is starting early to reach {} in {} minutes".format(zone.name, target, minutes))
+        self.targets[zone.name] = (key, target)
+        return target
+
+    def decideZone(self, zone):
+        hvac = zone.hvac
+        thermostat = hvac.thermostat
+
+        if thermostat.mode == "MANUAL":
+            # Turn everything off once, then leave the relays alone until the mode changes
+            if zone.name not in self.manualZones:
+                self.manualZones.add(zone.name)
+                self.command("OFF", "ALL", zone)
+            return
+        self.manualZones.discard(zone.name)
+
+        houseTemp = zone.houseTemp.value
+        self.updateState(zone)
+        self.updateDesiredTemp(zone)
+        targetTemp = self.targetTemp(zone, houseTemp)
+
+        # Check if the HVAC should turn on or off
+        # House is hot
+        if houseTemp > targetTemp:
+            LOGGER.debug("House is HOT")
+
+            if thermostat.state == "HEAT" and hvac.heater.state == "ON":
+                LOGGER.debug("Heater is on")
+                # I put the heater/vent/ac on a timer so it does not go on and off
+                # if there is a glitch in the temp sensors
+                if hvac.heater.shouldUpdate():
+                    LOGGER.debug("Been on for a while")
+                    hvac.heater.update()
+
+                    self.command("OFF", "HEAT", zone)
+                    LOGGER.info("House temp is {}".format(houseTemp))
+
+            elif thermostat.state == "COOL" and hvac.ac.state == "OFF":
+                if hvac.ac.shouldUpdate():
+                    hvac.ac.update()
+
+                    self.command("ON", "COOL", zone)
+                    LOGGER.info("House temp is {}".format(houseTemp))
+
+            else:
+                LOGGER.debug("House is hot, but to early to update, so, WE GOOD")
+        # House is cold
+        elif houseTemp < targetTemp:
+            LOGGER.debug("House is cold")
+            if thermostat.state == "HEAT" and hvac.heater.state == "OFF":
+                LOGGER.debug("Heater is off")
+                if hvac.heater.shouldUpdate():
+                    LOGGER.debug("been off for a while")
+                    hvac.heater.update()
+
+                    self.command("ON", "HEAT", zone)
+                    LOGGER.info("House temp is {}".format(houseTemp))
+
+            elif thermostat.state == "COOL" and hvac.ac.state == "ON":
+                if hvac.ac.shouldUpdate():
+                    hvac.ac.update()
+
+                    self.command("OFF", "COOL", zone)
+                    LOGGER.info("House temp is {}".format(houseTemp))
+
+            else:
+                LOGGER.debug("House is cold, but too early to update, so, WE GOOD IN CHILL")
+
+        else:
+            LOGGER.debug("House temp is the same. Heater state is {}".format(hvac.heater.state))
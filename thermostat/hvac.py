@@ -1,8 +1,9 @@
 import logging
-import datetime
 import sys
 import time
 
+import numpy
+
 try:
     import sensors
 except ModuleNotFoundError:
@@ -11,8 +12,54 @@ try:
     import hvactools
 except ModuleNotFoundError:
     import thermostat.hvactools as hvactools
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import tracepoints
+except ModuleNotFoundError:
+    import thermostat.tracepoints as tracepoints
+try:
+    import acquisition
+except ModuleNotFoundError:
+    import thermostat.acquisition as acquisition
+try:
+    import relays
+except ModuleNotFoundError:
+    import thermostat.relays as relays
+try:
+    import timeseries
+except ModuleNotFoundError:
+    import thermostat.timeseries as timeseries
+try:
+    import schedule
+except ModuleNotFoundError:
+    import thermostat.schedule as schedule
+try:
+    import boards
+except ModuleNotFoundError:
+    import thermostat.boards as boards
+try:
+    import metrics
+except ModuleNotFoundError:
+    import thermostat.metrics as metrics
+try:
+    import sensorhealth
+except ModuleNotFoundError:
+    import thermostat.sensorhealth as sensorhealth
+
+TRACE = tracepoints.tracepoint("hvac")
 
-from pymata4 import pymata4
+ANALOG_READ_SECONDS = metrics.histogram("thermostat_analog_read_seconds", "How long board.analog_read takes", ["pin"])
+ACTUATIONS = metrics.counter("thermostat_relay_actuations", "Relay changes sent to the board", ["componant", "state"])
+SENSOR_HEALTHY = metrics.gauge("thermostat_sensor_healthy", "1 while the sensor is used, 0 while it is quarantined", ["sensor"])
+SKIPPED_ACTUATIONS = metrics.counter("thermostat_relay_actuations_skipped", "Relay changes not sent because the relay was already there", ["componant", "state"])
+
+# How long each relay is left alone after a pulse
+RELAY_SETTLE = {"HEAT": .25, "COOL": .25, "VENT": 1}
+# componant => the HVAC attribute with its relay
+RELAYS = {"HEAT": "heater", "COOL": "ac", "VENT": "vent"}
 
 class HVAC:
     def __init__(self):
@@ -27,12 +74,17 @@ class HVAC:
         self._ac = None
 
         self.board = None
+        # When set, relay pulses are timed in the background instead of sleeping
+        self.pulser = None
+        # Where every relay was last pulsed to, shared by every zone on the board
+        self.journal = relays.RelayJournal()
 
         self.LOGGER.debug("Created HVAC object")
 
     @property
     def thermostat(self):
-        self.LOGGER.debug("Getting Thermostat")
+        if TRACE.enabled:
+            TRACE("hvac.thermostat")
         return self.__thermostat
 
     @thermostat.setter
@@ -46,7 +98,8 @@ class HVAC:
 
     @property
     def heater(self):
-        self.LOGGER.debug("Getting Heater")
+        if TRACE.enabled:
+            TRACE("hvac.heater")
         return self.__heater
 
     @heater.setter
@@ -56,7 +109,8 @@ class HVAC:
 
     @property
     def vent(self):
-        self.LOGGER.debug("Getting vent")
+        if TRACE.enabled:
+            TRACE("hvac.vent")
         return self.__vent
 
     @vent.setter
@@ -66,7 +120,8 @@ class HVAC:
 
     @property
     def ac(self):
-        self.LOGGER.debug("Getting ac")
+        if TRACE.enabled:
+            TRACE("hvac.ac")
         return self.__ac
 
     @ac.setter
@@ -76,7 +131,8 @@ class HVAC:
 
     @property
     def state(self):
-        self.LOGGER.debug("HVAC state is {}".format(self.__state))
+        if TRACE.enabled:
+            TRACE("hvac.state", state=self.__state)
         return self.__state
 
     @state.setter
@@ -85,105 +141,142 @@ class HVAC:
             self.__state = newState
         else:
             self.__state = self.__state
-        self.LOGGER.debug("HVAC state changed to {}".format(newState))
-
-    def turnOn(self, componant):
-
-        if componant.upper() == "HEAT":
-            # Give the latching relay power on signal
-            self.board.digital_write(self.heater.controlPins[0], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.heater.controlPins[0], 0)
-            time.sleep(.25)
-
-            self.heater.state = "ON"
-
-        elif componant.upper() == "COOL":
-            self.board.digital_write(self.ac.controlPins[0], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.ac.controlPins[0], 0)
-            time.sleep(.25)
-
-            self.ac.state = "ON"
-
-        elif componant.upper() == "VENT":
-            self.board.digital_write(self.vent.controlPins[0], 1)
-            time.sleep(.25)
-            self.board.digital_write(self.vent.controlPins[0], 0)
-            time.sleep(1)
-
-            self.vent.state = "ON"
-
+        if TRACE.enabled:
+            TRACE("hvac.state.set", state=newState)
+
+    def pulse(self, pin, settle=.25, group=None, callback=None):
+        """
+        Give a latching relay a short pulse on one of its pins.
+        Returns a future if the pulse was queued, or None if it was done right here.
+        """
+        if self.pulser:
+            return self.pulser.pulse(pin, .25, settle, group, callback)
+        # Give the latching relay power
+        self.board.digital_write(pin, 1)
+        clock.CLOCK.sleep(.25)
+        # I am using latching relays, so I will remove the power to it
+        self.board.digital_write(pin, 0)
+        clock.CLOCK.sleep(settle)
+        if callback:
+            callback(None)
+
+    def relay(self, componant):
+        """
+        The Heater, AirConditioner or Vent for "HEAT", "COOL" or "VENT", or None
+        """
+        name = RELAYS.get(componant.upper())
+        return getattr(self, name) if name else None
+
+    def actuate(self, changes, callback=None, force=False):
+        """
+        Move several relays at once.
+        changes => [(componant, "ON" | "OFF")], componant is HEAT, COOL or VENT
+        force => Pulse the relays even if the journal says they are already there
+
+        A relay the journal says is already where it is asked to be is left alone.
+        The rest are pulsed together, in one batch of board writes.
+        A position is only recorded once its relay has settled, so a command sent
+        again while its pulse is still going is pulsed again.  The scheduler
+        runs pulses on the same relay one after the other, so that only costs a pulse.
+        Returns the componants that were pulsed.
+        """
+        pulses = []
+        for componant, position in changes:
+            componant = componant.upper()
+            relay = self.relay(componant)
+            if not force and self.journal.get(relay.controlPins) == position:
+                relay.state = position
+                SKIPPED_ACTUATIONS.labels(componant, position).inc()
+                self.LOGGER.debug("{} is already {}".format(componant, position.lower()))
+                continue
+            # The on pin is first in controlPins, the off pin second
+            pin = relay.controlPins[0] if position == "ON" else relay.controlPins[1]
+            pulses.append((componant, position, relay, pin))
+
+        if not pulses:
+            if callback:
+                callback(None)
+            return []
+        if self.pulser and len(pulses) == 1:
+            componant, position, relay, pin = pulses[0]
+
+            def settled(future):
+                self.settled(pulses, [future])
+                if callback:
+                    callback(future)
+
+            self.pulser.pulse(pin, .25, RELAY_SETTLE[componant], relay.controlPins, settled)
+        elif self.pulser:
+            futures = self.pulser.pulseMany([(pin, RELAY_SETTLE[componant], relay.controlPins) for componant, position, relay, pin in pulses])
+
+            def settledAll(combined):
+                self.settled(pulses, futures)
+                if callback:
+                    callback(combined)
+
+            relays.whenAll(futures, settledAll)
         else:
+            # Give every latching relay that changes power, then take it away from all of them together
+            try:
+                try:
+                    for componant, position, relay, pin in pulses:
+                        self.board.digital_write(pin, 1)
+                    clock.CLOCK.sleep(.25)
+                finally:
+                    for componant, position, relay, pin in pulses:
+                        self.board.digital_write(pin, 0)
+            except Exception:
+                # Some of them may have moved, so the journal can not say where any of them are
+                for componant, position, relay, pin in pulses:
+                    self.journal.forget(relay.controlPins)
+                raise
+            clock.CLOCK.sleep(max(RELAY_SETTLE[componant] for componant, position, relay, pin in pulses))
+            self.settled(pulses)
+            if callback:
+                callback(None)
+
+        for componant, position, relay, pin in pulses:
+            ACTUATIONS.labels(componant, position).inc()
+        if self.LOGGER.isEnabledFor(logging.INFO):
+            self.LOGGER.info("Turned {}".format(", ".join("{} {}".format(componant, position.lower()) for componant, position, relay, pin in pulses)))
+        return [componant for componant, position, relay, pin in pulses]
+
+    def settled(self, pulses, futures=None):
+        """
+        Keep track of where the relays went once their pulses are done.
+        Only a pulse that was written is recorded.  A relay whose pulse failed is
+        forgotten by the journal, so the next command pulses it again.
+        pulses => [(componant, position, relay, pin)] from actuate
+        futures => The pulser's future for each pulse, None when they were written directly
+        """
+        moved = {}
+        for index, (componant, position, relay, pin) in enumerate(pulses):
+            error = futures[index].exception() if futures else None
+            if error:
+                self.LOGGER.error("Could not turn {} {}  {}".format(componant, position.lower(), error))
+                self.journal.forget(relay.controlPins)
+                continue
+            relay.state = position
+            moved[relay.controlPins] = position
+        if moved:
+            self.journal.record(moved)
+
+    def turnOn(self, componant, callback=None, force=False):
+        if self.relay(componant) is None:
             self.LOGGER.error("Cannot turn on {}. Not a valid object".format(componant))
             return
-
-        self.LOGGER.info("Turned {} on".format(componant))
+        self.actuate([(componant, "ON")], callback, force)
         return True
 
-    def turnOff(self, componant):
-
+    def turnOff(self, componant, callback=None, force=False):
         if componant.upper() == "ALL":
-            self.board.digital_write(self.heater.controlPins[1], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.heater.controlPins[1], 0)
-            time.sleep(.25)
-
-            self.heater.state = "OFF"
-
-            self.board.digital_write(self.ac.controlPins[1], 1)
-            # self.board.digital_write(self.vent.controlPin[1], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.ac.controlPins[1], 0)
-            time.sleep(.25)
-
-            self.ac.state = "OFF"
-
-            self.board.digital_write(self.vent.controlPins[1], 1)
-            time.sleep(.25)
-            self.board.digital_write(self.vent.controlPins[1], 0)
-            time.sleep(1)
-            self.LOGGER.debug("Vent state turned off")
-
-            self.vent.state = "OFF"
-
-        elif componant.upper() == "HEAT":
-            self.board.digital_write(self.heater.controlPins[1], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.heater.controlPins[1], 0)
-            time.sleep(.25)
-
-            self.heater.state = "OFF"
-
-        elif componant.upper() == "COOL":
-            self.board.digital_write(self.ac.controlPins[1], 1)
-            # self.board.digital_write(self.vent.controlPin[1], 1)
-            time.sleep(.25)
-            # I am using latching relays, so I will remove the power to it
-            self.board.digital_write(self.ac.controlPins[1], 0)
-            time.sleep(.25)
-
-            self.ac.state = "OFF"
-
-        elif componant.upper() == "VENT":
-            self.board.digital_write(self.vent.controlPins[1], 1)
-            time.sleep(.25)
-            self.board.digital_write(self.vent.controlPins[1], 0)
-            time.sleep(1)
-            self.LOGGER.debug("Vent state turned off")
-
-            self.vent.state = "OFF"
-
-        else:
+            # The three relays do not share pins, so they all go in one batch
+            self.actuate([("HEAT", "OFF"), ("COOL", "OFF"), ("VENT", "OFF")], callback, force)
+            return True
+        if self.relay(componant) is None:
             self.LOGGER.error("Cannot turn off {}. Not a valid object".format(componant))
             return
-
-        self.LOGGER.info("Turned {} off".format(componant))
+        self.actuate([(componant, "OFF")], callback, force)
         return True
 
 class Thermostat(hvactools.TimedObject):
@@ -200,23 +293,50 @@ class Thermostat(hvactools.TimedObject):
 
         self.tempSensors = []
         self.sensorGroups = {}
+        # sensor name => sensorhealth.SensorHealth
+        self.health = {}
+        # The SensorHealth settings new sensors get, see configureHealth
+        self.healthSettings = {}
+        # When set, the sensors are read from the background stream instead of the board
+        self.stream = None
+        # When set, every raw reading is kept in this timeseries.TimeSeriesStore
+        self.history = None
+
+        # Built by buildIndex()
+        self.sensorIndex = {}
+        self.groupIndex = {}
+        self.groupWeights = {}
+        # group => {"METHOD": "mean" | "median" | "trimmed" | "weighted", ...}
+        self.aggregation = {}
+        # Goes up every time the sensors are read, so cached temps know they are old
+        self.epoch = 0
+        self.__indexed = False
+        self.__readings = {}
+        self.__temps = {}
 
         self.__defaultTemp = None
         self.__desiredTemp = None
         self.__tempModifier = 0
+        # state => schedule.CompiledSchedule
+        self.schedules = {}
+        self.__modifierKey = None
         self.__minTemp = 65
         self.__maxTemp = 78
+        # Called with no arguments when the mode changes, so the engine can wake up for it
+        self.onChange = None
 
         self.LOGGER.debug("Created Thermostat object")
 
     @property
     def tempFormat(self):
-        self.LOGGER.debug("Getting temp format")
+        if TRACE.enabled:
+            TRACE("thermostat.tempFormat", tempFormat=self.__tempFormat)
         return self.__tempFormat
 
     @tempFormat.setter
     def tempFormat(self, tFormat):
-        self.LOGGER.debug("Setting temp format")
+        if TRACE.enabled:
+            TRACE("thermostat.tempFormat.set", tempFormat=tFormat)
         if tFormat in self.validFormats:
             self.__tempFormat = tFormat
         else:
@@ -224,23 +344,28 @@ class Thermostat(hvactools.TimedObject):
 
     @property
     def mode(self):
-        self.LOGGER.debug("Getting thermostat mode")
+        if TRACE.enabled:
+            TRACE("thermostat.mode", mode=self.__mode)
         # print("getting thermostat mode")
         return self.__mode
 
     @mode.setter
     def mode(self, tMode):
-        self.LOGGER.debug("Setting thermostat mode")
+        if TRACE.enabled:
+            TRACE("thermostat.mode.set", mode=tMode)
         # print("setting thermostat mode")
         if tMode in self.validModes and tMode != self.mode:
             self.__mode = tMode
+            if self.onChange:
+                self.onChange()
         else:
             self.LOGGER.error("{} is not a valid mode for Thermostat.mode".format(tMode))
             self.__mode = self.__mode
 
     @property
     def state(self):
-        self.LOGGER.debug("Thermostat state is {}".format(self.__state))
+        if TRACE.enabled:
+            TRACE("thermostat.state", state=self.__state)
         return self.__state
 
     @state.setter
@@ -253,7 +378,8 @@ class Thermostat(hvactools.TimedObject):
 
     @property
     def minTemp(self):
-        self.LOGGER.debug("Getting minimum temp")
+        if TRACE.enabled:
+            TRACE("thermostat.minTemp", minTemp=self.__minTemp)
         return self.__minTemp
 
     @minTemp.setter
@@ -263,7 +389,8 @@ class Thermostat(hvactools.TimedObject):
 
     @property
     def maxTemp(self):
-        self.LOGGER.debug("Getting maximum temp")
+        if TRACE.enabled:
+            TRACE("thermostat.maxTemp", maxTemp=self.__maxTemp)
         return self.__maxTemp
 
     @maxTemp.setter
@@ -273,8 +400,9 @@ class Thermostat(hvactools.TimedObject):
 
     @property
     def defaultTemp(self):
-        self.LOGGER.debug("Getting default temp setting")
-        return __defaultTemp
+        if TRACE.enabled:
+            TRACE("thermostat.defaultTemp", defaultTemp=self.__defaultTemp)
+        return self.__defaultTemp
 
     @defaultTemp.setter
     def defaultTemp(self, temp):
@@ -283,12 +411,14 @@ class Thermostat(hvactools.TimedObject):
 
     @property
     def desiredTemp(self):
-        self.LOGGER.debug("Getting desired temp of {}".format(self.__desiredTemp))
+        if TRACE.enabled:
+            TRACE("thermostat.desiredTemp", desiredTemp=self.__desiredTemp)
         return self.__desiredTemp
 
     @desiredTemp.setter
     def desiredTemp(self, dTemp):
-        self.LOGGER.debug("Setting desired temp to {}".format(dTemp))
+        if TRACE.enabled:
+            TRACE("thermostat.desiredTemp.set", desiredTemp=dTemp)
         if dTemp <= self.maxTemp and dTemp >= self.minTemp:
             self.__desiredTemp = dTemp
         if dTemp > self.maxTemp:
@@ -307,7 +437,7 @@ class Thermostat(hvactools.TimedObject):
         mod = 0
         for modifier, value in modDict.items():
             if modifier == "TIMEMODS":
-                now = datetime.datetime.now().strftime("%H%M")
+                now = clock.CLOCK.now().strftime("%H%M")
                 for time in modDict[modifier].values():
                     if now >= time[0] and now <= time[1]:
                         mod += time[2]
@@ -316,16 +446,65 @@ class Thermostat(hvactools.TimedObject):
                     mod += modDict[modifier][1]["HOME"][2]
                 else:
                     mod += modDict[modifier][1]["AWAY"][2]
-        self.LOGGER.debug("temp mod is {}".format(mod))
+        if TRACE.enabled:
+            TRACE("thermostat.tempModifier", tempModifier=mod)
         self.__tempModifier = mod
 
+    def compileSchedules(self, tempSettings, states=None):
+        """
+        tempSettings => SETTINGS["TEMP_SETTINGS"]
+        states => Only recompile these states and keep the rest, or None for all of them
+        """
+        if states is None:
+            schedules = schedule.compileSchedules(tempSettings)
+        else:
+            schedules = dict(self.schedules)
+            for state in states:
+                if isinstance(tempSettings.get(state), dict):
+                    schedules[state] = schedule.CompiledSchedule(tempSettings[state])
+                else:
+                    schedules.pop(state, None)
+        # Swap the whole table in at once, so a lookup never sees half of it
+        self.schedules = schedules
+        self.__modifierKey = None
+
+    def updateModifier(self, occupied, now=None):
+        """
+        Set tempModifier from the compiled schedule for the current state.
+        It is only worked out again when the minute, state or occupancy changes.
+        """
+        if now is None:
+            now = clock.CLOCK.now()
+        key = (self.__state, schedule.minuteOfWeek(now), bool(occupied))
+        if key == self.__modifierKey:
+            return self.__tempModifier
+        if self.__state in self.schedules:
+            self.__tempModifier = self.schedules[self.__state].modifier(occupied, now)
+        else:
+            self.__tempModifier = 0
+        self.__modifierKey = key
+        if TRACE.enabled:
+            TRACE("thermostat.tempModifier", tempModifier=self.__tempModifier)
+        return self.__tempModifier
+
     def addSensor(self, sensor):
         if sensor not in self.tempSensors:
             self.LOGGER.debug("Adding {} to tempSensors".format(sensor))
             self.tempSensors.append(sensor)
+            self.health[sensor.name] = sensorhealth.SensorHealth(sensor.name, **self.healthSettings)
+            SENSOR_HEALTHY.labels(sensor.name).setFunction(lambda health=self.health[sensor.name]: 1 if health.healthy else 0)
+            self.__indexed = False
         else:
             self.LOGGER.error("tempSensors already contains {}".format(sensor))
 
+    def configureHealth(self, **settings):
+        """
+        Change the limits every sensor is checked against, ie configureHealth(window=30, maxRate=.5)
+        """
+        self.healthSettings = settings
+        for health in self.health.values():
+            health.configure(**settings)
+
     def createSensorGroup(self, groupName):
         if groupName not in self.sensorGroups:
 
@@ -333,6 +512,7 @@ class Thermostat(hvactools.TimedObject):
         #     if name not in self.sensorGroups:
             self.LOGGER.debug("Created sensor group {}".format(groupName))
             self.sensorGroups[groupName] = []
+            self.__indexed = False
         else:
             self.LOGGER.error("{} is already a sensor group".format(groupName))
 
@@ -341,61 +521,163 @@ class Thermostat(hvactools.TimedObject):
             if sensor not in self.sensorGroups[group]:
                 self.LOGGER.debug("Adding sensor {} to group {}".format(sensor.name, group))
                 self.sensorGroups[group].append(sensor)
+                self.__indexed = False
             else:
                 self.LOGGER.error("Sensor {} is already part of the group {}".format(sensor, group))
         else:
             self.LOGGER.error("The group {} does not exist")
 
     def updateSensors(self, board):
-        for tSensor in self.tempSensors:
-            r = 10
-            tempArray = []
-            # tSum = 0
-            self.LOGGER.debug("Updating sensor {}".format(tSensor.name))
-            for reading in range(r):
-                value, timeStamp = board.analog_read(tSensor.controlPin)
-                self.LOGGER.debug(value)
+        if self.stream:
+            self.streamSensors()
+            return
+
+        def read(pin):
+            with ANALOG_READ_SECONDS.labels(pin).time():
+                return board.analog_read(pin)
+
+        averages = {}
+        r = 10
+        # Quarantined sensors are only read now and then, to see if they came back
+        active = [tSensor for tSensor in self.tempSensors if self.health[tSensor.name].due()]
+        samples = {tSensor.name: [] for tSensor in active}
+        pins = [tSensor.controlPin for tSensor in active]
+        # Every sensor is read each round, in parallel when they are on different boards
+        for reading in range(r if pins else 0):
+            values = boards.forEachPin(board, pins, read)
+            for tSensor in active:
+                value, timeStamp = values[tSensor.controlPin]
+                if TRACE.enabled:
+                    TRACE("thermostat.sample", sensor=tSensor.name, value=value)
                 if value:
-                    tempArray.append(value)
-                # tSum += value
-                time.sleep(.1)
-            try:
-                average = sum(tempArray) / len(tempArray)
-            # average = tSum / r
-                if 30 < average < 60:
-                    tSensor.tempC = average
-                else:
-                    tSensor.tempC = tSensor.tempC
-            except ZeroDivisionError as e:
-                self.LOGGER.error("Sensor {} is having an error".format(tSensor.name))
+                    samples[tSensor.name].append(value)
+                    if self.history:
+                        self.history.record(tSensor.name, value)
+            clock.CLOCK.sleep(.1)
+        now = clock.CLOCK.monotonic()
+        for tSensor in active:
+            self.LOGGER.debug("Updating sensor {}".format(tSensor.name))
+            average = self.health[tSensor.name].record(samples[tSensor.name], now)
+            if average is not None:
+                tSensor.tempC = average
+                averages[tSensor.name] = average
+        self.epoch += 1
+        self.recordGroups(averages)
+
+    def streamSensors(self):
+        """
+        Non blocking version of updateSensors.  Takes the latest filtered value
+        for every sensor from the background stream.
+        """
+        snapshot = self.stream.snapshot()
+        averages = {}
+        now = clock.CLOCK.monotonic()
+        for tSensor in self.tempSensors:
+            average = snapshot.get(tSensor.controlPin)
+            # The board only reports a pin when it changes, so a steady value is not stuck
+            average = self.health[tSensor.name].record([] if average is None else [average], now, checkStuck=False)
+            if average is not None:
+                tSensor.tempC = average
+                averages[tSensor.name] = average
+                if self.history:
+                    self.history.record(tSensor.name, average)
+        self.epoch += 1
+        self.recordGroups(averages)
+
+    def recordGroups(self, averages):
+        """
+        Keep the history of each sensor group as the mean raw value of its sensors
+        """
+        if not self.history:
+            return
+        for group, members in self.sensorGroups.items():
+            values = [averages[s.name] for s in members if s.name in averages]
+            if values:
+                self.history.record(group, sum(values) / len(values))
+
+    def buildIndex(self):
+        """
+        Build the name => sensor and group => sensor position maps that getTemp uses.
+        Called from setup, and again by getTemp if sensors were added since.
+        """
+        self.sensorIndex = {tSensor.name: i for i, tSensor in enumerate(self.tempSensors)}
+        self.groupIndex = {}
+        self.groupWeights = {}
+        for group, members in self.sensorGroups.items():
+            self.groupIndex[group] = numpy.array([self.sensorIndex[s.name] for s in members if s.name in self.sensorIndex], dtype=numpy.intp)
+            weights = self.aggregation.get(group, {}).get("WEIGHTS", {})
+            self.groupWeights[group] = numpy.array([weights.get(s.name, 1.0) for s in members if s.name in self.sensorIndex], dtype=float)
+        self.__indexed = True
+        self.__readings = {}
+        self.__temps = {}
+
+    def readings(self, tempFormat=None):
+        """
+        The latest temp of every sensor as one numpy array, in tempSensors order.
+        Sensors without a reading, or that are quarantined, are nan.  Worked out once per epoch.
+        """
+        if tempFormat is None:
+            tempFormat = self.tempFormat
+        cached = self.__readings.get(tempFormat)
+        if cached is not None and cached[0] == self.epoch:
+            return cached[1]
+        health = self.health
+        values = numpy.array([numpy.nan if t.tempC is None or not health[t.name].healthy else t.tempC for t in self.tempSensors], dtype=float)
+        if tempFormat == "F":
+            values = values * 1.8 + 32
+        self.__readings[tempFormat] = (self.epoch, values)
+        return values
+
+    def aggregate(self, group, values):
+        """
+        Combine the readings of one group with the group's METHOD
+        values => The readings of the group members, nan for no reading
+        """
+        settings = self.aggregation.get(group, {})
+        method = settings.get("METHOD", "mean").lower()
+        good = ~numpy.isnan(values)
+        if not good.any():
+            return None
+        if method == "median":
+            return float(numpy.median(values[good]))
+        if method == "trimmed":
+            # Drop the TRIM share of the highest and lowest readings
+            ordered = numpy.sort(values[good])
+            cut = int(len(ordered) * settings.get("TRIM", .2))
+            if len(ordered) - 2 * cut < 1:
+                cut = (len(ordered) - 1) // 2
+            return float(ordered[cut:len(ordered) - cut].mean())
+        if method == "weighted":
+            weights = self.groupWeights.get(group)
+            if weights is not None and len(weights) == len(values) and weights[good].sum() > 0:
+                return float(numpy.average(values[good], weights=weights[good]))
+        elif method != "mean":
+            self.LOGGER.error("{} is not a valid aggregation for group {}.  Using mean".format(method, group))
+        return float(values[good].mean())
 
     def getTemp(self, area):
-        for tSensor in self.tempSensors:
-            if area.upper() == tSensor.name:
-                if self.tempFormat == "F":
-                    return self.tempF
-                else:
-                    return self.tempC
-        self.LOGGER.debug("{} not a name of specific sensor.  Trying group names".format(area))
-        for group in self.sensorGroups:
-            if area.upper() == group:
-                tempArray = []
-                for tempSensor in self.sensorGroups[group]:
-
-                # tSum = 0
-                # for tSensor in self.sensorGroups[group]:
-                    if self.tempFormat == "F":
-                        if tempSensor.tempF:
-                            tempArray.append(tempSensor.tempF)
-                    else:
-                        if tempSensor.tempC:
-                            tempArray.append(tempSensor.tempC)
-                return (sum(tempArray) / len(tempArray))
-                #         tSum += tSensor.tempF
-                #     else:
-                #         tSum += tSensor.tempC
-                # return (tSum / len(self.sensorGroups[group]))
-        self.LOGGER.debug("{} is not in the grouped sensors either.  Skipping".format(area))
+        if not self.__indexed:
+            self.buildIndex()
+        area = area.upper()
+        tempFormat = self.tempFormat
+        key = (area, tempFormat)
+        cached = self.__temps.get(key)
+        if cached is not None and cached[0] == self.epoch:
+            return cached[1]
+
+        values = self.readings(tempFormat)
+        if area in self.sensorIndex:
+            temp = values[self.sensorIndex[area]]
+            temp = None if numpy.isnan(temp) else float(temp)
+        elif area in self.groupIndex:
+            temp = self.aggregate(area, values[self.groupIndex[area]])
+            if temp is None:
+                self.LOGGER.error("No sensor in group {} has a reading".format(area))
+        else:
+            self.LOGGER.debug("{} is not a sensor or a sensor group.  Skipping".format(area))
+            return None
+        self.__temps[key] = (self.epoch, temp)
+        return temp
 
     def update(self, conditionList):
         highTemp, lowTemp, timeOfYear = conditionList
@@ -419,7 +701,7 @@ class Thermostat(hvactools.TimedObject):
             elif highTemp == self.maxTemp and lowTemp == self.minTemp:
                 self.LOGGER.debug("no weather")
                 # Day time
-                now = datetime.datetime.now()
+                now = clock.CLOCK.now()
                 if now.month == 10:
                     self.state = "HEAT"
                 else:
@@ -439,7 +721,7 @@ class Thermostat(hvactools.TimedObject):
         elif highTemp == self.maxTemp and lowTemp == self.minTemp:
             self.LOGGER.debug("no weather again")
             # Day time
-            now = datetime.datetime.now()
+            now = clock.CLOCK.now()
             if now.hour >=7 and now.hour <= 19:
                 self.state = "COOL"
             else:
@@ -448,7 +730,7 @@ class Thermostat(hvactools.TimedObject):
         else:
             self.state = "OFF"
 
-        self.lastCheck = datetime.datetime.now()
+        self.lastCheck = clock.CLOCK.now()
 
 class Heater(hvactools.TimedObject):
     def __init__(self, delay=.25):
@@ -462,7 +744,8 @@ class Heater(hvactools.TimedObject):
 
     @property
     def controlPins(self):
-        self.LOGGER.debug("Getting heater controlPins")
+        if TRACE.enabled:
+            TRACE("heater.controlPins", pins=self.__controlPins)
         return self.__controlPins
 
     @controlPins.setter
@@ -476,22 +759,23 @@ class Heater(hvactools.TimedObject):
 
     @property
     def state(self):
-        self.LOGGER.debug("Getting heater state of {}".format(self.__state))
+        if TRACE.enabled:
+            TRACE("heater.state", state=self.__state)
         return self.__state
 
     @state.setter
     def state(self, onOff):
         if onOff in self.validStates:
             self.__state = onOff
-            self.LOGGER.debug("Set Heater to state {}".format(self.state))
         else:
             self.LOGGER.error("{} is not a valid state for heater".format(onOff))
             self.__state = self.__state
-        self.LOGGER.debug("Set heater state to {}".format(self.state))
+        if TRACE.enabled:
+            TRACE("heater.state.set", state=self.__state)
 
     def update(self):
         self.LOGGER.debug("Updating Heater")
-        self.lastCheck = datetime.datetime.now()
+        self.lastCheck = clock.CLOCK.now()
 
 class Vent(hvactools.TimedObject):
     def __init__(self, delay=2):
@@ -505,7 +789,8 @@ class Vent(hvactools.TimedObject):
 
     @property
     def controlPins(self):
-        self.LOGGER.debug("Getting vent controlPins")
+        if TRACE.enabled:
+            TRACE("vent.controlPins", pins=self.__controlPins)
         return self.__controlPins
 
     @controlPins.setter
@@ -519,19 +804,21 @@ class Vent(hvactools.TimedObject):
 
     @property
     def state(self):
-        self.LOGGER.debug("Getting vent state")
+        if TRACE.enabled:
+            TRACE("vent.state", state=self.__state)
         return self.__state
 
     @state.setter
     def state(self, onOff):
-        self.LOGGER.debug("Setting vent state")
+        if TRACE.enabled:
+            TRACE("vent.state.set", state=onOff)
         if onOff in self.validStates:
             self.__state = onOff
         else:
             self.LOGGER.error("{} is not a valid state for vent".format(onOff))
             self.__state = self.__state
     def update(self):
-        self.lastCheck = datetime.datetime.now()
+        self.lastCheck = clock.CLOCK.now()
 
 class AirConditioner(hvactools.TimedObject):
     def __init__(self, delay=2):
@@ -545,7 +832,8 @@ class AirConditioner(hvactools.TimedObject):
 
     @property
     def controlPins(self):
-        self.LOGGER.debug("Getting ac controlPins")
+        if TRACE.enabled:
+            TRACE("ac.controlPins", pins=self.__controlPins)
         return self.__controlPins
 
     @controlPins.setter
@@ -559,12 +847,14 @@ class AirConditioner(hvactools.TimedObject):
 
     @property
     def state(self):
-        self.LOGGER.debug("Getting ac state")
+        if TRACE.enabled:
+            TRACE("ac.state", state=self.__state)
         return self.__state
 
     @state.setter
     def state(self, onOff):
-        self.LOGGER.debug("Setting ac state")
+        if TRACE.enabled:
+            TRACE("ac.state.set", state=onOff)
         if onOff in self.validStates:
             self.__state = onOff
         else:
@@ -572,14 +862,19 @@ class AirConditioner(hvactools.TimedObject):
             self.__state = self.__state
 
     def update(self):
-        self.lastCheck = datetime.datetime.now()
+        self.lastCheck = clock.CLOCK.now()
 
-def setup(tempSensors, sensorGroups, hvacControlPins):
+def setup(tempSensors, sensorGroups, hvacControlPins, streaming=True, aggregation=None, board=None, pulser=True):
+    """
+    board => Any boards.Board, or a boards.BoardPool.  None opens the real pymata4 board.
+    pulser => Time the relay pulses in the background with relays.PulseScheduler
+    """
     LOGGER = logging.getLogger("__main__.hvac.setup")
     LOGGER.debug("tempSensors {}\nsensorGroups {}\nhvacControlPins {}".format(tempSensors, sensorGroups, hvacControlPins))
     hvac = HVAC()
     # Setup the thermostat
     hvac.thermostat = Thermostat()
+    hvac.thermostat.history = timeseries.TimeSeriesStore()
     # Add the sensors to the thermostat
     for sensorName, sensorData in tempSensors.items():
         hvac.thermostat.addSensor(sensors.TempSensor(sensorName, sensorData[0], sensorData[1]))
@@ -591,6 +886,10 @@ def setup(tempSensors, sensorGroups, hvacControlPins):
             for sensor in hvac.thermostat.tempSensors:
                 if sName == sensor.name:
                     hvac.thermostat.addSensorToGroup(sensor, groupName)
+    # How each group combines its sensors
+    if aggregation:
+        hvac.thermostat.aggregation = aggregation
+    hvac.thermostat.buildIndex()
     # Setup the heater
     hvac.heater = Heater()
     hvac.heater.controlPins = hvacControlPins["HEAT_PINS"]
@@ -604,12 +903,22 @@ def setup(tempSensors, sensorGroups, hvacControlPins):
     hvac.ac.controlPins = hvacControlPins["AC_PINS"]
 
     # Setup the pymata board
-    hvac.board = pymata4.Pymata4()
+    if board is None:
+        board = boards.openBoard()
+    hvac.board = board
+    if pulser:
+        hvac.pulser = relays.PulseScheduler(hvac.board)
 
     # Add all of the control and sensor pins to the board
     # Sensor pins
+    if streaming:
+        # Let the board report the sensors in the background
+        hvac.thermostat.stream = acquisition.AnalogStream()
     for tSensor in hvac.thermostat.tempSensors:
-        hvac.board.set_pin_mode_analog_input(tSensor.controlPin)
+        if hvac.thermostat.stream:
+            hvac.thermostat.stream.attach(hvac.board, tSensor.controlPin)
+        else:
+            hvac.board.set_pin_mode_analog_input(tSensor.controlPin)
         # LOGGER.debug("{}  {}".format(tSensor, tSensor.controlPin))
     # Control pins
     # Heater
@@ -625,4 +934,38 @@ def setup(tempSensors, sensorGroups, hvacControlPins):
         hvac.board.set_pin_mode_digital_output(pin)
         LOGGER.debug("ac controlPin  {}".format(pin))
 
+    if hvac.thermostat.stream:
+        # Give the board a moment to report, then fill in any pins that are steady
+        clock.CLOCK.sleep(.5)
+        hvac.thermostat.stream.prime(hvac.board)
+
+    return hvac
+
+def setupZone(hvacControlPins, primary):
+    """
+    Another set of relays, with its own Thermostat, on the board the primary HVAC
+    already has open.  The sensors stay with the primary HVAC so they are still
+    read once for every zone.
+    hvacControlPins => {"HEAT_PINS": [on, off], "VENT_PINS": [...], "AC_PINS": [...]}
+    primary => The HVAC from setup
+    """
+    LOGGER = logging.getLogger("__main__.hvac.setupZone")
+    hvac = HVAC()
+    hvac.thermostat = Thermostat()
+    hvac.board = primary.board
+    hvac.pulser = primary.pulser
+    hvac.journal = primary.journal
+
+    hvac.heater = Heater()
+    hvac.heater.controlPins = hvacControlPins["HEAT_PINS"]
+    hvac.vent = Vent()
+    hvac.vent.controlPins = hvacControlPins["VENT_PINS"]
+    hvac.ac = AirConditioner()
+    hvac.ac.controlPins = hvacControlPins["AC_PINS"]
+
+    for relay in (hvac.heater, hvac.vent, hvac.ac):
+        for pin in relay.controlPins:
+            hvac.board.set_pin_mode_digital_output(pin)
+            LOGGER.debug("zone controlPin  {}".format(pin))
+
     return hvac
@@ -7,9 +7,16 @@ import pathlib
 from pathlib import Path
 import datetime
 import time
+import threading
+import collections
 
 import paho.mqtt.client as mqtt
 
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
 LOGGER = logging.getLogger("__main__.tools")
 LOGGER.debug("Loading hvactools")
 
@@ -28,7 +35,7 @@ class TimedObject():
 
     def shouldUpdate(self):
         try:
-            if datetime.datetime.now() > self.lastCheck + datetime.timedelta(minutes=self.delay):
+            if clock.CLOCK.now() > self.lastCheck + datetime.timedelta(minutes=self.delay):
                 return True
             return False
         except TypeError as e:
@@ -36,6 +43,16 @@ class TimedObject():
                 return True
         return False
 
+    def secondsLeft(self, now=None):
+        """
+        Seconds until shouldUpdate() turns True, 0 if it already is
+        """
+        if self.lastCheck is None:
+            return 0
+        if now is None:
+            now = clock.CLOCK.now()
+        return max(0, (self.lastCheck + datetime.timedelta(minutes=self.delay) - now).total_seconds())
+
     def update():
         """
         This function should be overridden in Child class
@@ -43,28 +60,151 @@ class TimedObject():
         pass
 
 class MQTTClient():
-    def __init__(self, name=None, host="localhost", port=1883, keepalive=60, bind_address=""):
+    """
+    Publishes to an MQTT broker without ever blocking the caller.
+
+    publish() only drops the message in an outbound queue.  A background thread
+    sends it once the broker is connected.  Along the way:
+        * only the newest message for each topic is kept (last value wins)
+        * a retained message that matches what the broker already has is skipped
+        * each topic is sent at most once every minInterval seconds
+        * the queue holds at most queueSize topics, the oldest is dropped
+    paho's network loop reconnects with a backoff between minDelay and maxDelay seconds.
+    """
+    def __init__(self, name=None, host="localhost", port=1883, keepalive=60, bind_address="", user=None, password=None, queueSize=100, minInterval=1.0, minDelay=1, maxDelay=120, client=None):
+        self.LOGGER = logging.getLogger("__main__.tools.MQTTClient")
         self.name = name
-        self.client = mqtt.Client(self.name)
-        # self.client.on_connect = self.onConnect
-        self.client.connect(host, port, keepalive, bind_address)
-        # self.client.loop_start()
-        # time.sleep(1)
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.bind_address = bind_address
+        self.queueSize = queueSize
+        self.minInterval = minInterval
+
+        if client is None:
+            if hasattr(mqtt, "CallbackAPIVersion"):
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, self.name)
+            else:
+                client = mqtt.Client(self.name)
+        self.client = client
+        if user:
+            self.client.username_pw_set(user, password)
+        self.client.on_connect = self.onConnect
+        self.client.on_disconnect = self.onDisconnect
+        self.client.reconnect_delay_set(minDelay, maxDelay)
+
+        self.connected = False
+        self.dropped = 0
+        # topic => (message, qos, retain), oldest first
+        self.__pending = collections.OrderedDict()
+        # topic => the retained message the broker has
+        self.__retained = {}
+        self.__lastSent = {}
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__thread = None
 
     def onConnect(self, client, userdata, flags, rc):
         if rc == 0:
-            print("connected to mqtt")
+            self.LOGGER.info("Connected to mqtt broker {}:{}".format(self.host, self.port))
+            with self.__condition:
+                self.connected = True
+                self.__condition.notify()
+        else:
+            self.LOGGER.error("mqtt broker refused the connection  rc {}".format(rc))
+
+    def onDisconnect(self, client, userdata, rc):
+        with self.__condition:
+            self.connected = False
+        if rc != 0:
+            self.LOGGER.error("Lost the mqtt broker.  Reconnecting")
 
     def start(self):
+        """
+        Start connecting and the network loop.  Returns right away, even if the broker is down.
+        """
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="MQTTPublisher", daemon=True)
+        self.__thread.start()
+        try:
+            self.client.connect_async(self.host, self.port, self.keepalive, self.bind_address)
+        except Exception as e:
+            self.LOGGER.error("Could not start connecting to mqtt  {}".format(e))
         self.client.loop_start()
-        time.sleep(1)
 
     def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread:
+            self.__thread.join()
         self.client.loop_stop()
-        time.sleep(1)
+        try:
+            self.client.disconnect()
+        except Exception as e:
+            self.LOGGER.debug("mqtt disconnect  {}".format(e))
 
     def publish(self, topic, message, qos=1, retain=True):
-        self.client.publish(topic, message, qos, retain)
+        with self.__condition:
+            if retain and topic not in self.__pending and self.__retained.get(topic) == message:
+                # The broker already holds this value
+                return False
+            if topic in self.__pending:
+                del self.__pending[topic]
+            elif len(self.__pending) >= self.queueSize:
+                oldTopic, oldMessage = self.__pending.popitem(last=False)
+                self.dropped += 1
+                self.LOGGER.error("mqtt queue is full.  Dropped {}".format(oldTopic))
+            self.__pending[topic] = (message, qos, retain)
+            self.__condition.notify()
+        return True
+
+    def pending(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def __nextDue(self):
+        """
+        Returns (topic, waitSeconds) for the topic that can go soonest, or (None, None)
+        """
+        now = time.monotonic()
+        best, bestWait = None, None
+        for topic in self.__pending:
+            wait = self.__lastSent.get(topic, now - self.minInterval) + self.minInterval - now
+            if bestWait is None or wait < bestWait:
+                best, bestWait = topic, wait
+                if wait <= 0:
+                    break
+        return best, bestWait
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    if not self.__running:
+                        return
+                    if self.connected and self.__pending:
+                        topic, wait = self.__nextDue()
+                        if wait <= 0:
+                            break
+                        self.__condition.wait(wait)
+                    else:
+                        self.__condition.wait()
+                message, qos, retain = self.__pending.pop(topic)
+                self.__lastSent[topic] = time.monotonic()
+            try:
+                result = self.client.publish(topic, message, qos, retain)
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    raise RuntimeError("rc {}".format(result.rc))
+                if retain:
+                    with self.__condition:
+                        self.__retained[topic] = message
+            except Exception as e:
+                self.LOGGER.error("Could not publish {}  {}".format(topic, e))
+                # Put it back unless something newer came in
+                with self.__condition:
+                    if topic not in self.__pending:
+                        self.__pending[topic] = (message, qos, retain)
 
 def loadSettings(jsonFile):
     # Convert filename to python path
@@ -88,10 +228,11 @@ def updateSettings(oldSettings, newSettings):
     DICT = None
     def update(old, new):
         for setting, value in new.items():
-            if setting in old and old[setting] != new[setting]:
+            if setting not in old:
+                # Most likely a typo.  runconfig.compile checks everything below the top level.
+                LOGGER.warning("{} is not a valid setting.  It is ignored".format(setting))
+            elif old[setting] != new[setting]:
                 old[setting] = new[setting]
-            else:
-                LOGGER.debug("{} is not a valid setting".format(setting))
         return old
 
     # Check if newSettings is a json file or a dictionary
@@ -170,7 +311,7 @@ def updateSettings(oldSettings, newSettings):
 #     return False
 
 def checkTimeOfYear():
-    date = datetime.date.today()
+    date = clock.CLOCK.now().date()
     if date.month > 4 and date.month < 9:
         return "SUMMER"
     if date.month > 9 and date.month < 4:
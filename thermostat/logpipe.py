@@ -0,0 +1,165 @@
+"""
+logpipe.py
+
+Logging that never makes the control loop wait on a disk.
+
+The handlers from the logging config (config/logger.ini) are moved behind a
+queue.  Code that logs only puts the record on the queue, and one background
+thread hands it to the real handlers.
+
+DEBUG records are not written anywhere as they happen.  The last few thousand
+of them are kept in a ring in memory, and only when a WARNING or worse comes in
+is the ring written to the incident file, followed by the record that caused
+it.  The detail leading up to a problem is there when it is needed, without
+writing to the SD card the rest of the time.
+"""
+
+import atexit
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from logging.config import fileConfig
+from pathlib import Path
+
+LOGGER = logging.getLogger("__main__.logpipe")
+
+class RingHandler(logging.Handler):
+    """
+    <int> capacity => How many records to keep
+    <Path> path => Where the ring is written when a record at flushLevel or above comes in.
+        None only keeps the ring in memory.
+    <int> flushLevel => ie logging.WARNING
+    """
+    def __init__(self, capacity=2000, path=None, flushLevel=logging.WARNING):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.ring = collections.deque(maxlen=capacity)
+        self.path = Path(path) if path else None
+        self.flushLevel = flushLevel
+        self.flushes = 0
+
+    def configure(self, capacity=None, path=None, flushLevel=None):
+        """
+        Change the ring once the settings are loaded.  What is already in it is kept.
+        """
+        self.acquire()
+        try:
+            if capacity is not None:
+                self.ring = collections.deque(self.ring, maxlen=capacity)
+            if path is not None:
+                self.path = Path(path)
+            if flushLevel is not None:
+                self.flushLevel = flushLevel
+        finally:
+            self.release()
+
+    def emit(self, record):
+        self.ring.append(record)
+        if record.levelno >= self.flushLevel:
+            self.dump()
+
+    def flush(self):
+        """
+        Nothing to do.  logging.shutdown() flushes every handler at exit, and a
+        clean exit is not an incident, so the ring is only written by dump().
+        """
+
+    def dump(self):
+        """
+        Write the ring to path and empty it.  Called when a record at flushLevel or above comes in.
+        """
+        if not self.path or not self.ring:
+            return
+        self.acquire()
+        try:
+            records = list(self.ring)
+            self.ring.clear()
+            try:
+                Path.mkdir(self.path.parent, parents=True, exist_ok=True)
+                with open(self.path, "a") as iFile:
+                    iFile.write("---- {} records before {} ----\n".format(len(records) - 1, records[-1].levelname))
+                    for record in records:
+                        iFile.write(self.format(record) + "\n")
+                self.flushes += 1
+            except OSError as e:
+                # Not through logging, that would only come back here
+                sys.stderr.write("Could not write the log ring to {}  {}\n".format(self.path, e))
+        finally:
+            self.release()
+
+    def recent(self):
+        """
+        The records in the ring, oldest first
+        """
+        return list(self.ring)
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the record on the queue as it is.  The message is worked out here,
+    but formatting it is left to the handlers on the other side.
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks can not be pickled or kept around, keep the text instead
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class LogPipeline():
+    """
+    <list> handlers => The handlers to run in the background, usually from the logging config
+    <RingHandler> ring => Where DEBUG records wait
+    """
+    def __init__(self, handlers, ring):
+        self.ring = ring
+        self.queue = queue.SimpleQueue()
+        self.queueHandler = RecordQueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, ring, respect_handler_level=True)
+        self.handlers = handlers
+        self.__lock = threading.Lock()
+        self.__running = False
+
+    def start(self):
+        with self.__lock:
+            if not self.__running:
+                self.listener.start()
+                self.__running = True
+
+    def stop(self):
+        """
+        Write out everything still in the queue, then stop the background thread
+        """
+        with self.__lock:
+            if self.__running:
+                self.listener.stop()
+                self.__running = False
+        for handler in self.handlers:
+            handler.flush()
+
+def setup(configFile, ringSize=2000, incidentFile=None, flushLevel=logging.WARNING):
+    """
+    Load the logging config, then move its root handlers behind a queue.
+    Returns the started LogPipeline.  It is stopped at exit, so nothing still
+    in the queue is lost, but stop() can be called sooner.
+    """
+    fileConfig(configFile)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    ring = RingHandler(ringSize, incidentFile, flushLevel)
+    # Write the ring the same way the config writes everything else
+    formatter = next((handler.formatter for handler in handlers if handler.formatter), None)
+    if formatter:
+        ring.setFormatter(formatter)
+
+    pipeline = LogPipeline(handlers, ring)
+    root.addHandler(pipeline.queueHandler)
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
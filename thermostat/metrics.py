@@ -0,0 +1,295 @@
+"""
+metrics.py
+
+Counters, gauges and histograms, served in the Prometheus text format.
+
+Everything registers itself in REGISTRY when it is made, so a module just does
+
+    READS = metrics.histogram("thermostat_analog_read_seconds", "How long analog_read takes", ["pin"])
+    ...
+    READS.labels(pin).observe(seconds)
+
+and serve() makes all of them available on http://host:port/metrics.
+
+Recording is one lock and a few additions, so it is cheap enough for the
+control loop.  Gauges can also be given a function that is only called when the
+metrics are read, for values that already live somewhere else.
+"""
+
+import bisect
+import http.server
+import logging
+import math
+import threading
+import time
+
+LOGGER = logging.getLogger("__main__.metrics")
+
+# Seconds, from a fast serial read up to a slow network call
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(escaped) + "}"
+
+class Metric():
+    """
+    <str> name => The Prometheus name, ie thermostat_loop_seconds
+    <str> description => The HELP text
+    <list> labelNames => The names of the labels, or nothing for a metric without labels
+    """
+    kind = "untyped"
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelNames:
+            self.children[()] = self.makeChild()
+
+    def makeChild(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Returns the metric for one set of label values, made the first time it is asked for
+        """
+        if len(values) != len(self.labelNames):
+            raise ValueError("{} needs the labels {}".format(self.name, self.labelNames))
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.makeChild())
+        return child
+
+    def samples(self):
+        """
+        Returns a list of (suffix, labelText, value)
+        """
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, labels, formatValue(value)))
+        return "\n".join(lines)
+
+class CounterChild():
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Counter(Metric):
+    kind = "counter"
+
+    def makeChild(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def samples(self):
+        return [("_total", formatLabels(self.labelNames, key), child.value) for key, child in list(self.children.items())]
+
+class GaugeChild():
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = float(value)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def setFunction(self, function):
+        """
+        Read the value from function() whenever the metrics are read
+        """
+        self.function = function
+
+    def get(self):
+        if self.function:
+            try:
+                value = self.function()
+            except Exception as e:
+                LOGGER.debug("Gauge function failed  {}".format(e))
+                return math.nan
+            return math.nan if value is None else float(value)
+        return self.value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def makeChild(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def setFunction(self, function):
+        self.children[()].setFunction(function)
+
+    def samples(self):
+        return [("", formatLabels(self.labelNames, key), child.get()) for key, child in list(self.children.items())]
+
+class Timer():
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class HistogramChild():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One more than the buckets for everything past the last one
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        with histogram.time(): ... observes how long the block took
+        """
+        return Timer(self)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, description, labelNames)
+
+    def makeChild(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return self.children[()].time()
+
+    def samples(self):
+        samples = []
+        for key, child in list(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(("_bucket", formatLabels(self.labelNames, key, ("le", formatValue(bound))), cumulative))
+            samples.append(("_sum", formatLabels(self.labelNames, key), total))
+            samples.append(("_count", formatLabels(self.labelNames, key), cumulative))
+        return samples
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Returns the metric already registered under the same name, if there is one
+        """
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) != type(metric):
+                    raise ValueError("{} is already a {}".format(metric.name, existing.kind))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, description, labelNames=()):
+    return REGISTRY.register(Counter(name, description, labelNames))
+
+def gauge(name, description, labelNames=()):
+    return REGISTRY.register(Gauge(name, description, labelNames))
+
+def histogram(name, description, labelNames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labelNames, buckets))
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host="", registry=REGISTRY):
+    """
+    Serve the metrics from a background thread.  Returns the server, call
+    shutdown() on it to stop.
+    """
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    LOGGER.info("Serving metrics on port {}".format(server.server_port))
+    return server
@@ -0,0 +1,229 @@
+"""
+neighbors.py
+
+Passive presence detection from the kernel's neighbor (ARP) table.
+
+Any phone or laptop that has talked on the network lately is already in the
+neighbor table, so one `ip neigh` says who is around without sending a single
+packet.  Only entries the kernel has confirmed lately (REACHABLE, or DELAY and
+PROBE while it checks them again) count as seen.  STALE entries can hang around
+long after a phone has left, so they get pinged like a host that is not in the
+table at all.  Every host remembers when it was last seen, and is counted as
+home for presentTTL seconds after that, which covers phones that go quiet while
+they sleep.  Only hosts whose cached answer has run out get an active ping from
+the prober, all of them at once.
+"""
+
+import ipaddress
+import logging
+import re
+import subprocess
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import prober
+except ModuleNotFoundError:
+    import thermostat.prober as prober
+
+LOGGER = logging.getLogger("__main__.neighbors")
+
+# The kernel's own table.  It is read through NEIGHBOR_COMMAND, which also gives the state of each entry.
+NEIGHBOR_TABLE = "/proc/net/arp"
+NEIGHBOR_COMMAND = ["ip", "-4", "neigh", "show"]
+# The flag the kernel sets once it has a hardware address for the entry
+ATF_COM = 0x2
+# Entries the kernel has heard from lately.  Anything else, STALE included, has to be pinged.
+SEEN_STATES = {"REACHABLE", "DELAY", "PROBE"}
+# The state of /proc/net/arp entries, which do not say how fresh they are
+UNKNOWN = "UNKNOWN"
+
+MAC = re.compile(r"^[0-9a-f]{2}([:-][0-9a-f]{2}){5}$")
+
+def normalMAC(address):
+    return address.strip().lower().replace("-", ":")
+
+def isMAC(address):
+    return bool(MAC.match(address.strip().lower()))
+
+def isIP(address):
+    try:
+        ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    return True
+
+def isAddress(address):
+    """
+    True for a MAC or IP address, False for a hostname
+    """
+    return isMAC(address) or isIP(address)
+
+def parseNeighbors(text):
+    """
+    Parse the output of `ip neigh show`, ie
+        192.168.1.20 dev wlan0 lladdr 3c:22:fb:01:02:03 REACHABLE
+    Returns {ip: (mac, state)} for every entry with a hardware address
+    """
+    neighbors = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or "lladdr" not in fields[:-1]:
+            continue
+        mac = normalMAC(fields[fields.index("lladdr") + 1])
+        if isMAC(mac) and mac != "00:00:00:00:00:00":
+            neighbors[fields[0]] = (mac, fields[-1].upper())
+    return neighbors
+
+def parseARP(text):
+    """
+    Parse the text of /proc/net/arp.
+    Returns {ip: (mac, UNKNOWN)} for every complete entry.
+    """
+    neighbors = {}
+    for line in text.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        ip, flags, mac = fields[0], fields[2], normalMAC(fields[3])
+        try:
+            complete = int(flags, 16) & ATF_COM
+        except ValueError:
+            continue
+        if complete and mac != "00:00:00:00:00:00":
+            neighbors[ip] = (mac, UNKNOWN)
+    return neighbors
+
+class NeighborTable():
+    """
+    <str> path => NEIGHBOR_TABLE for the kernel's table, or a saved copy of
+        either `ip neigh show` or /proc/net/arp to test with
+    """
+    def __init__(self, path=NEIGHBOR_TABLE):
+        self.LOGGER = logging.getLogger("__main__.neighbors.NeighborTable")
+        self.path = path
+        self.__warned = False
+
+    def command(self):
+        """
+        The kernel's table with the state of each entry, or None if `ip` did not run
+        """
+        try:
+            result = subprocess.run(NEIGHBOR_COMMAND, capture_output=True, text=True, timeout=2, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            if not self.__warned:
+                self.LOGGER.warning("Could not run {}, every host in the table will be pinged  {}".format(" ".join(NEIGHBOR_COMMAND), e))
+                self.__warned = True
+            return None
+        return parseNeighbors(result.stdout)
+
+    def read(self):
+        """
+        Returns ({ip: (mac, state)}, {mac: (ip, state)}), both empty if the table can not be read
+        """
+        byIP = self.command() if self.path == NEIGHBOR_TABLE else None
+        if byIP is None:
+            try:
+                with open(self.path, "r") as table:
+                    text = table.read()
+            except OSError as e:
+                self.LOGGER.debug("Could not read {}  {}".format(self.path, e))
+                return {}, {}
+            # /proc/net/arp starts with its column names
+            byIP = parseARP(text) if text.startswith("IP address") else parseNeighbors(text)
+        return byIP, {mac: (ip, state) for ip, (mac, state) in byIP.items()}
+
+class PresenceCache():
+    """
+    <float> presentTTL => Seconds a host counts as home after it was last seen
+    <float> absentTTL => Seconds a failed ping is trusted before trying again
+    <NeighborTable> table => Where to look first
+    <ICMPProber> activeProber => The fallback, None for the shared prober.PROBER
+    """
+    def __init__(self, presentTTL=600, absentTTL=60, table=None, activeProber=None):
+        self.LOGGER = logging.getLogger("__main__.neighbors.PresenceCache")
+        self.presentTTL = presentTTL
+        self.absentTTL = absentTTL
+        self.table = table if table else NeighborTable()
+        self.activeProber = activeProber
+
+        # host => monotonic time it was last seen, or last failed to answer
+        self.lastSeen = {}
+        self.lastAbsent = {}
+
+        self.LOGGER.debug("Created PresenceCache with TTLs {} / {}".format(presentTTL, absentTTL))
+
+    @property
+    def prober(self):
+        return self.activeProber if self.activeProber else prober.PROBER
+
+    def lookup(self, host, byIP, byMAC):
+        """
+        Returns (ip, state) for the host's entry in the table, or (None, None)
+        """
+        if isMAC(host):
+            return byMAC.get(normalMAC(host), (None, None))
+        if isIP(host):
+            ip = host.strip()
+        else:
+            # A hostname is in the table if what it resolves to is
+            ip = self.prober.resolve(host)
+        if ip is None or ip not in byIP:
+            return None, None
+        return ip, byIP[ip][1]
+
+    def present(self, hosts, now=None):
+        """
+        hosts => The MAC addresses, IP addresses or hostnames to look for
+        Returns the set of hosts that are home
+        """
+        if now is None:
+            now = clock.CLOCK.monotonic()
+        byIP, byMAC = self.table.read()
+        home = set()
+        # What to ping => the hosts it answers for
+        toProbe = {}
+        for host in hosts:
+            ip, state = self.lookup(host, byIP, byMAC)
+            if state in SEEN_STATES:
+                self.lastSeen[host] = now
+                self.lastAbsent.pop(host, None)
+                home.add(host)
+            elif now - self.lastSeen.get(host, -float("inf")) < self.presentTTL:
+                home.add(host)
+            elif now - self.lastAbsent.get(host, -float("inf")) < self.absentTTL:
+                continue
+            elif isMAC(host):
+                if ip:
+                    # A stale entry still says which address to ping
+                    toProbe.setdefault(ip, []).append(host)
+                else:
+                    # Nothing to ping for a bare MAC address
+                    self.lastAbsent[host] = now
+            else:
+                toProbe.setdefault(host, []).append(host)
+        if toProbe:
+            self.LOGGER.debug("Pinging {}, their cached state ran out".format(sorted(toProbe)))
+            answered = self.prober.probe(list(toProbe))
+            for target, targetHosts in toProbe.items():
+                for host in targetHosts:
+                    if target in answered:
+                        self.lastSeen[host] = now
+                        self.lastAbsent.pop(host, None)
+                        home.add(host)
+                    else:
+                        self.lastAbsent[host] = now
+        return home
+
+    def forget(self, host=None):
+        """
+        Drop what is known about one host, or every host
+        """
+        if host is None:
+            self.lastSeen.clear()
+            self.lastAbsent.clear()
+        else:
+            self.lastSeen.pop(host, None)
+            self.lastAbsent.pop(host, None)
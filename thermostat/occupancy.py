@@ -1,6 +1,4 @@
 import logging
-import datetime
-import subprocess
 
 try:
     import constants
@@ -10,8 +8,25 @@ try:
     import hvactools
 except ModuleNotFoundError:
     import thermostat.hvactools as hvactools
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import tracepoints
+except ModuleNotFoundError:
+    import thermostat.tracepoints as tracepoints
+try:
+    import prober
+except ModuleNotFoundError:
+    import thermostat.prober as prober
+try:
+    import neighbors
+except ModuleNotFoundError:
+    import thermostat.neighbors as neighbors
 
 LOGGER = logging.getLogger("__main__.occupancy")
+TRACE = tracepoints.tracepoint("occupancy")
 
 domainName = constants.DOMAINNAME
 
@@ -22,28 +37,36 @@ class Occupancy():
 
     @property
     def occupied(self):
-        LOGGER.debug("Getting Occupied")
+        if TRACE.enabled:
+            TRACE("occupied", occupied=self.__occupied)
         if self.__occupied == "HOME":
             return True
         return False
 
     @occupied.setter
     def occupied(self, trueFalse):
-        LOGGER.debug("Setting Occupied to {}".format(trueFalse))
+        if TRACE.enabled:
+            TRACE("occupied.set", occupied=trueFalse)
         if trueFalse:
             self.__occupied = "HOME"
         else:
             self.__occupied = "AWAY"
 
 class WiFi(Occupancy, hvactools.TimedObject):
-    """docstring for WiFi."""
+    """
+    <dict> peopleDict => {person: [hostnames, IP or MAC addresses]}
+    <int> delay => Minutes between checks
+    <PresenceCache> presence => Look in the neighbor table first and only ping
+        what it can not answer for.  None pings every host.
+    """
 
-    def __init__(self, peopleDict, delay=15):
+    def __init__(self, peopleDict, delay=15, presence=None):
+        Occupancy.__init__(self)
         self.LOGGER = logging.getLogger("__main__.occupancy.WiFi")
         hvactools.TimedObject.__init__(self, delay)
-        Occupancy().__init__()
         # self.delay = delay
         self.peopleDict = peopleDict
+        self.presence = presence
         # self.__lastCheck = None
         self.__home = None
 
@@ -64,20 +87,25 @@ class WiFi(Occupancy, hvactools.TimedObject):
     @home.setter
     def home(self, people):
         tempList = []
-        for person, hostnames in people.items():
-            for hName in hostnames:
-                try:
-                    if subprocess.check_output(["ping", "-c", "1", hName + domainName]):
-                        if person not in tempList:
-                            tempList.append(person)
-                except subprocess.CalledProcessError as e:
-                    self.LOGGER.debug("{} at {} not reachable".format(person, hName + domainName))
+        # Addresses are used as they are, hostnames get the local domain
+        hosts = {(hName if neighbors.isAddress(hName) else hName + domainName): person for person, hostnames in people.items() for hName in hostnames}
+        if self.presence:
+            reachable = self.presence.present(hosts)
+        else:
+            # Ping every hostname at once instead of one after another
+            reachable = prober.PROBER.probe(hosts)
+        for host, person in hosts.items():
+            if host in reachable:
+                if person not in tempList:
+                    tempList.append(person)
+            else:
+                self.LOGGER.debug("{} at {} not reachable".format(person, host))
         if tempList:
             self.__home = tempList
         else:
             self.__home = None
         self.LOGGER.debug(self.__home)
-        # self.lastCheck = datetime.datetime.now()
+        # self.lastCheck = clock.CLOCK.now()
 
     def update(self, wifiAddresses):
         if wifiAddresses:
@@ -86,4 +114,4 @@ class WiFi(Occupancy, hvactools.TimedObject):
             self.occupied = True
         else:
             self.occupied = False
-        self.lastCheck = datetime.datetime.now()
+        self.lastCheck = clock.CLOCK.now()
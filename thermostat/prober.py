@@ -0,0 +1,214 @@
+"""
+prober.py
+
+In process ICMP echo ("ping") for the presence detectors.
+
+Every target gets its echo request at the same time and the replies are collected
+under one shared deadline, so a sweep of the whole house costs about one round
+trip instead of a ping process and a timeout for every phone that is asleep.
+
+Linux only lets normal users open ICMP datagram sockets when their group is in
+net.ipv4.ping_group_range.  If neither that nor a raw socket is allowed, the
+prober falls back to running the ping commands, but all of them at once.
+"""
+
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import time
+
+try:
+    import metrics
+except ModuleNotFoundError:
+    import thermostat.metrics as metrics
+
+LOGGER = logging.getLogger("__main__.prober")
+
+PING_SECONDS = metrics.histogram("thermostat_ping_seconds", "Round trip of the pings that were answered", ["host"])
+PING_TIMEOUTS = metrics.counter("thermostat_ping_timeouts", "Pings that were not answered before the deadline", ["host"])
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+def checksum(data):
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def echoRequest(identifier, sequence, payload=b"thermostat"):
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    check = checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, check, identifier, sequence) + payload
+
+class ICMPProber():
+    """
+    <float> timeout => The shared deadline for a whole sweep, in seconds
+    <int> dnsTTL => How long a resolved address is trusted, in seconds
+    """
+    def __init__(self, timeout=1.0, dnsTTL=300):
+        self.LOGGER = logging.getLogger("__main__.prober.ICMPProber")
+        self.timeout = timeout
+        self.dnsTTL = dnsTTL
+        # hostname => (address or None, expires)
+        self.__dnsCache = {}
+        self.__sequence = 0
+        self.__identifier = os.getpid() & 0xffff
+
+        self.LOGGER.debug("Created ICMPProber with a timeout of {}".format(timeout))
+
+    def resolve(self, hostname):
+        """
+        Returns the IPv4 address of the hostname, or None if it can not be resolved.
+        Failed lookups are remembered for a short time too, so a missing phone
+        does not cost a DNS timeout every sweep.
+        """
+        now = time.monotonic()
+        cached = self.__dnsCache.get(hostname)
+        if cached and cached[1] > now:
+            return cached[0]
+        try:
+            address = socket.getaddrinfo(hostname, None, socket.AF_INET)[0][4][0]
+            self.__dnsCache[hostname] = (address, now + self.dnsTTL)
+        except (socket.gaierror, IndexError) as e:
+            self.LOGGER.debug("Could not resolve {}  {}".format(hostname, e))
+            address = None
+            self.__dnsCache[hostname] = (None, now + min(self.dnsTTL, 60))
+        return address
+
+    def forget(self, hostname=None):
+        """
+        Drops one hostname, or all of them, from the DNS cache
+        """
+        if hostname is None:
+            self.__dnsCache.clear()
+        else:
+            self.__dnsCache.pop(hostname, None)
+
+    def openSocket(self):
+        """
+        Returns (socket, isRaw) or (None, None) if ICMP sockets are not allowed
+        """
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+        except PermissionError:
+            pass
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+        except PermissionError:
+            self.LOGGER.debug("No ICMP socket allowed.  Falling back to the ping command")
+        return None, None
+
+    def probe(self, hostnames, timeout=None):
+        """
+        Pings every hostname at once.
+        Returns the set of hostnames that answered before the deadline.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        targets = {}
+        for hostname in hostnames:
+            address = self.resolve(hostname)
+            if address:
+                targets.setdefault(address, []).append(hostname)
+            else:
+                self.LOGGER.debug("{} has no address".format(hostname))
+        if not targets:
+            return set()
+
+        sock, isRaw = self.openSocket()
+        if sock is None:
+            return self.probeCommand(targets, timeout)
+        try:
+            answered = self.probeSocket(sock, isRaw, targets, timeout)
+        finally:
+            sock.close()
+        return {hostname for address in answered for hostname in targets[address]}
+
+    def probeSocket(self, sock, isRaw, targets, timeout):
+        """
+        targets => {address: [hostnames]}
+        """
+        sock.setblocking(False)
+        waiting = {}
+        sent = {}
+        for address in targets:
+            self.__sequence = (self.__sequence + 1) & 0xffff
+            waiting[self.__sequence] = address
+            sent[self.__sequence] = time.monotonic()
+            try:
+                sock.sendto(echoRequest(self.__identifier, self.__sequence), (address, 0))
+            except OSError as e:
+                self.LOGGER.debug("Could not send to {}  {}".format(address, e))
+                del waiting[self.__sequence]
+
+        answered = set()
+        deadline = time.monotonic() + timeout
+        while waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
+            try:
+                packet, (source, _) = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if isRaw:
+                # Raw sockets hand back the IP header too
+                packet = packet[(packet[0] & 0x0f) * 4:]
+            if len(packet) < 8:
+                continue
+            icmpType, code, check, identifier, sequence = struct.unpack("!BBHHH", packet[:8])
+            # The kernel picks the identifier for datagram sockets, so only raw
+            # sockets can check it
+            if icmpType != ICMP_ECHO_REPLY or (isRaw and identifier != self.__identifier):
+                continue
+            if waiting.get(sequence) == source:
+                answered.add(source)
+                del waiting[sequence]
+                roundTrip = time.monotonic() - sent[sequence]
+                for hostname in targets[source]:
+                    PING_SECONDS.labels(hostname).observe(roundTrip)
+        for address in waiting.values():
+            for hostname in targets[address]:
+                PING_TIMEOUTS.labels(hostname).inc()
+        return answered
+
+    def probeCommand(self, targets, timeout):
+        """
+        The fallback.  Starts every ping process at once and waits for them together.
+        """
+        wait = str(max(1, int(round(timeout))))
+        processes = {}
+        for address in targets:
+            try:
+                processes[address] = subprocess.Popen(["ping", "-c", "1", "-W", wait, address], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                self.LOGGER.error("Could not run ping for {}  {}".format(address, e))
+        answered = set()
+        started = time.monotonic()
+        deadline = started + timeout + 1
+        for address, process in processes.items():
+            try:
+                if process.wait(max(0, deadline - time.monotonic())) == 0:
+                    answered.update(targets[address])
+                    # Only as close as the wait order allows, the process may have finished earlier
+                    for hostname in targets[address]:
+                        PING_SECONDS.labels(hostname).observe(time.monotonic() - started)
+                    continue
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            for hostname in targets[address]:
+                PING_TIMEOUTS.labels(hostname).inc()
+        return answered
+
+# One prober shared by everything that needs to ping, so they share the DNS cache
+PROBER = ICMPProber()
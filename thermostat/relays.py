@@ -0,0 +1,268 @@
+"""
+relays.py
+
+Timed pulses for the latching relays.
+
+A latching relay only needs power long enough to flip, so every on/off is a
+short pulse on one pin.  Instead of sleeping through the pulse, the scheduler
+writes the rising edge right away and lets a background thread write the falling
+edge when the time is up.  Pulses on different relays run at the same time, and
+pulses that share a relay wait their turn.
+
+A latching relay stays where it was last put, even with the power off, so the
+RelayJournal keeps the last position each relay was pulsed to in a file.  That
+way a relay that is already where it is asked to be is never pulsed again, not
+even after a restart.  A position is only recorded once its pulse was written;
+a pulse that failed makes the journal forget the relay instead.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+LOGGER = logging.getLogger("__main__.relays")
+
+class PulseScheduler():
+    """
+    <board> board => Anything with a digital_write(pin, value) method
+    """
+    def __init__(self, board):
+        self.LOGGER = logging.getLogger("__main__.relays.PulseScheduler")
+        self.board = board
+
+        self.__events = []
+        self.__order = itertools.count()
+        # relay/pin => time it is free again
+        self.__busyUntil = {}
+        self.__condition = threading.Condition()
+        self.__writeLock = threading.Lock()
+        self.__running = True
+
+        self.__thread = threading.Thread(target=self.__run, name="PulseScheduler", daemon=True)
+        self.__thread.start()
+
+        self.LOGGER.debug("Created PulseScheduler")
+
+    def pulse(self, pin, hold=.25, settle=.25, group=None, callback=None):
+        """
+        Queue a pulse on the pin.
+        <float> hold => How long the pin is high
+        <float> settle => How long to leave the relay alone after the pulse
+        group => Pulses with the same group never overlap.  Use the relay's
+            controlPins so its on and off pins do not fight each other.
+        callback => Called with the future when the pulse is done
+
+        Returns a concurrent.futures.Future that is done when the relay has settled.
+        It has the exception instead if writing either edge failed.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        keys = {pin} if group is None else {pin, group}
+        with self.__condition:
+            if not self.__running:
+                future.set_exception(RuntimeError("PulseScheduler is stopped"))
+                return future
+            now = time.monotonic()
+            start = max([now] + [self.__busyUntil.get(key, now) for key in keys])
+            release = start + hold
+            done = release + settle
+            for key in keys:
+                self.__busyUntil[key] = done
+            errors = {}
+            self.__push(start, lambda: self.__writeMany([pin], 1, errors))
+            self.__push(release, lambda: self.__writeMany([pin], 0, errors))
+            self.__push(done, lambda: self.__finish(future, pin, errors))
+            self.__condition.notify()
+        self.LOGGER.debug("Queued pulse on pin {} in {:.2f}s".format(pin, start - now))
+        return future
+
+    def pulseMany(self, pulses, hold=.25):
+        """
+        Start several pulses together.  All of the rising edges are written in one
+        go, and all of the falling edges in another.
+        pulses => [(pin, settle, group)]
+
+        Returns a concurrent.futures.Future for each pulse, done when its relay has
+        settled, or with the exception if writing its pin failed
+        """
+        futures = [Future() for pulse in pulses]
+        if not pulses:
+            return futures
+        pins = [pin for pin, settle, group in pulses]
+        with self.__condition:
+            if not self.__running:
+                for future in futures:
+                    future.set_exception(RuntimeError("PulseScheduler is stopped"))
+                return futures
+            now = time.monotonic()
+            keys = [{pin} if group is None else {pin, group} for pin, settle, group in pulses]
+            start = max([now] + [self.__busyUntil.get(key, now) for pulseKeys in keys for key in pulseKeys])
+            release = start + hold
+            errors = {}
+            for (pin, settle, group), pulseKeys, future in zip(pulses, keys, futures):
+                done = release + settle
+                for key in pulseKeys:
+                    self.__busyUntil[key] = done
+                self.__push(done, lambda future=future, pin=pin: self.__finish(future, pin, errors))
+            self.__push(start, lambda: self.__writeMany(pins, 1, errors))
+            self.__push(release, lambda: self.__writeMany(pins, 0, errors))
+            self.__condition.notify()
+        self.LOGGER.debug("Queued pulses on pins {} in {:.2f}s".format(pins, start - now))
+        return futures
+
+    def pending(self):
+        with self.__condition:
+            return len(self.__events)
+
+    def stop(self):
+        """
+        Stop the scheduler.  Every pulse that is already queued is finished first,
+        so no relay is left powered.
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __push(self, when, action):
+        heapq.heappush(self.__events, (when, next(self.__order), action))
+
+    def __writeMany(self, pins, value, errors):
+        """
+        Write every pin, even if one of them fails, so no relay is left powered.
+        errors => pin => the first exception writing it raised
+        """
+        with self.__writeLock:
+            for pin in pins:
+                try:
+                    self.board.digital_write(pin, value)
+                except Exception as e:
+                    self.LOGGER.error("Relay pulse on pin {} failed  {}".format(pin, e))
+                    errors.setdefault(pin, e)
+
+    def __finish(self, future, pin, errors):
+        if pin in errors:
+            future.set_exception(errors[pin])
+        else:
+            future.set_result(pin)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    if not self.__events:
+                        if not self.__running:
+                            return
+                        self.__condition.wait()
+                        continue
+                    delay = self.__events[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.__condition.wait(delay)
+                when, order, action = heapq.heappop(self.__events)
+            try:
+                action()
+            except Exception as e:
+                self.LOGGER.error("Relay pulse failed  {}".format(e))
+
+def whenAll(futures, callback=None):
+    """
+    Returns a future that is done when all of the futures are done
+    """
+    combined = Future()
+    if callback:
+        combined.add_done_callback(callback)
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            combined.set_result([f.result() if not f.exception() else None for f in futures])
+
+    if not futures:
+        combined.set_result([])
+    for future in futures:
+        future.add_done_callback(finished)
+    return combined
+
+class RelayJournal():
+    """
+    The last position each latching relay was pulsed to.
+    <Path> path => Where it is kept between restarts, or None to only keep it in memory
+    """
+    def __init__(self, path=None):
+        self.LOGGER = logging.getLogger("__main__.relays.RelayJournal")
+        self.path = Path(path) if path else None
+        # (onPin, offPin) => "ON" | "OFF"
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.load()
+
+        self.LOGGER.debug("Created RelayJournal {}".format(self.path))
+
+    def get(self, controlPins):
+        """
+        Returns "ON", "OFF", or None if the relay has never been pulsed
+        """
+        return self.positions.get(tuple(controlPins))
+
+    def record(self, positions):
+        """
+        positions => {controlPins: "ON" | "OFF"} for the relays that were just pulsed
+        """
+        with self.lock:
+            for controlPins, position in positions.items():
+                self.positions[tuple(controlPins)] = position
+            self.save()
+
+    def forget(self, controlPins=None):
+        """
+        Forget where one relay, or every relay, is, so the next command pulses it whatever it says
+        """
+        with self.lock:
+            if controlPins is None:
+                self.positions.clear()
+            else:
+                self.positions.pop(tuple(controlPins), None)
+            self.save()
+
+    def load(self):
+        if not self.path:
+            return False
+        try:
+            with open(self.path, "r") as jFile:
+                positions = json.load(jFile)
+        except (OSError, ValueError) as e:
+            self.LOGGER.debug("No relay journal loaded from {}  {}".format(self.path, e))
+            return False
+        try:
+            self.positions = {tuple(int(pin) for pin in key.split(",")): position for key, position in positions.items() if position in ("ON", "OFF")}
+        except (AttributeError, ValueError) as e:
+            self.LOGGER.error("The relay journal {} is not readable  {}".format(self.path, e))
+            return False
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            Path.mkdir(self.path.parent, parents=True, exist_ok=True)
+            # Swap the whole file in, so a power cut never leaves half a journal
+            tempFile = self.path.with_name(self.path.name + ".tmp")
+            with open(tempFile, "w") as jFile:
+                # JSON keys have to be strings => "onPin,offPin"
+                json.dump({",".join(str(pin) for pin in pins): position for pins, position in self.positions.items()}, jFile)
+            os.replace(tempFile, self.path)
+        except OSError as e:
+            self.LOGGER.error("Could not save the relay journal {}.  {}".format(self.path, e))
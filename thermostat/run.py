@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
 import sys
+import asyncio
 import json
 from pathlib import Path
 import datetime
-import time
 import logging
-from logging.config import fileConfig
 import signal
 
 from pymata4 import pymata4
@@ -18,10 +17,21 @@ import hvac
 import sensors
 import weather
 import occupancy
+import engine
+import configwatch
+import status
+import metrics
+import zones
+import boards
+import neighbors
+import relays
+import runconfig
+import logpipe
 
-# TODO: more logging configuration
 # Setup a logger
-fileConfig(constants.LOGGERCONFIG)
+# The handlers in the config run on a background thread, so logging never waits on the disk.
+# DEBUG records are kept in memory and only written out when something goes wrong.
+LOGPIPE = logpipe.setup(constants.LOGGERCONFIG)
 LOGGER = logging.getLogger(__name__)
 
 # Check to make sure we are runing python 3.7 or greater"
@@ -50,123 +60,95 @@ else:
 	except Exception as e:
 		LOGGER.error("Could not create user config file {}.   {}".format(uSettings, e))
 
+# Check every setting now, instead of finding a typo when the loop trips over it
+try:
+	CONFIG = runconfig.compile(SETTINGS)
+except runconfig.ConfigError as e:
+	LOGGER.error("{}.  Fix {} and try again".format(e, uSettings))
+	sys.exit()
+
+# Now that USER_DIR is known, the DEBUG ring has somewhere to go
+LOGPIPE.ring.configure(CONFIG.logging.ringSize, Path(Path.home(), CONFIG.userDir, CONFIG.logging.incidentFile), CONFIG.logging.flushLevel)
+
 # Setup the HVAC system
-HVAC = hvac.setup(SETTINGS["SENSORS"], SETTINGS["SENSOR_GROUPS"], SETTINGS["HVAC"])
+# Pins on extra boards are numbered from each board's PIN_OFFSET
+BOARD = boards.openPool(SETTINGS["BOARDS"])
+HVAC = hvac.setup(SETTINGS["SENSORS"], SETTINGS["SENSOR_GROUPS"], SETTINGS["HVAC"], aggregation=SETTINGS["SENSOR_AGGREGATION"], board=BOARD)
 # Setup the weather forecast system
-WEATHER = weather.WeatherForecast(SETTINGS["WEATHER"]["URL"])
+# Start with the cached forecast, the engine refreshes it in the background
+WEATHER = weather.WeatherForecast(CONFIG.weather.url, cacheFile=Path(Path.home(), CONFIG.userDir, CONFIG.weather.saveFile))
+if WEATHER.load():
+	LOGGER.info("Cached weather forecast loaded")
 # Setup the WiFi ooccupancy detector
-WIFI = occupancy.WiFi(SETTINGS["WIFI"])
+# Who is home comes from the neighbor table, with pings only for what it can not answer
+PRESENCE = neighbors.PresenceCache(CONFIG.presence.presentTTL, CONFIG.presence.absentTTL, neighbors.NeighborTable(CONFIG.presence.neighborTable))
+WIFI = occupancy.WiFi(CONFIG.wifi.people, presence=PRESENCE)
+
+# Publishing never blocks, even if the broker is down
+MQTT = hvactools.MQTTClient(name="Thermostat", host=SETTINGS["MQTT"]["HOST"] or "localhost", port=int(SETTINGS["MQTT"]["PORT"] or 1883), user=SETTINGS["MQTT"]["USER"] or None, password=SETTINGS["MQTT"]["PASSWORD"] or None)
+MQTT.start()
+
+# The UI reads the thermostat's status from here instead of opening the board itself
+STATUS = status.StatusWriter(Path(Path.home(), CONFIG.userDir, CONFIG.statusFile))
 
-MQTT = hvactools.MQTTClient(name="Thermostat")
-# MQTT.start()
+# Prometheus can scrape http://host:PORT/metrics
+if CONFIG.metrics.port:
+	try:
+		METRICS = metrics.serve(CONFIG.metrics.port, CONFIG.metrics.host)
+	except OSError as e:
+		LOGGER.error("Could not serve metrics on port {}  {}".format(CONFIG.metrics.port, e))
 
 # Give the thermostat a default temp to work with
-HVAC.thermostat.defaultTemp = SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]
-HVAC.turnOff("ALL")
+HVAC.thermostat.defaultTemp = CONFIG.tempSettings.defaultTemp
+# Where every relay was last pulsed to, so repeated commands are not pulsed again
+HVAC.journal = relays.RelayJournal(Path(Path.home(), CONFIG.userDir, CONFIG.relayJournal))
+# Every zone shares the board, the relay journal and the sensor readings of HVAC
+ZONES = zones.setup(SETTINGS, HVAC)
+for zone in ZONES:
+	# The journal may not match the relays after a crash, a power cut or a manual
+	# flip, so every relay is pulsed off once to put them back in step
+	zone.hvac.turnOff("ALL", force=True)
+	# Pick up what the zone's thermal model learned before the restart
+	zone.model.saveFile = Path(Path.home(), CONFIG.userDir, CONFIG.model.saveDir, "{}.json".format(zone.name.lower()))
+	if zone.model.load():
+		LOGGER.info("Thermal model for {} loaded with {} samples".format(zone.name, zone.model.samples))
+
+def loadSettings():
+	"""
+	Load the default and user settings fresh, for the config watcher
+	"""
+	settings = hvactools.updateSettings(None, constants.DEFAULTCONFIG)
+	if settings and uSettings.exists():
+		settings = hvactools.updateSettings(settings, uSettings)
+	return settings
+
+# All of the sensor reading, weather, occupancy and relay work happens in the engine
+ENGINE = engine.ControlEngine(HVAC, WEATHER, WIFI, SETTINGS, mqtt=MQTT, status=STATUS, zones=ZONES, config=CONFIG)
 
 def shutdown(sig, frame):
 	print(sig, frame)
-	if HVAC.board:
-		HVAC.board.shutdown()
-	# MQTT.stop()
-	sys.exit()
+	# The engine finishes its tasks and returns from ENGINE.run()
+	ENGINE.stop()
 
+# Only once there is an ENGINE to stop
 signal.signal(signal.SIGTERM, shutdown)
 signal.signal(signal.SIGINT, shutdown)
 
-while True:
-	####################################################
-	# This happens when the thermostat is in AUTO mode
-	####################################################
-	while HVAC.thermostat.mode == "AUTO":
-		# Update the sensors
-		HVAC.thermostat.updateSensors(HVAC.board)
-		# Since this hvac supplies the house, the HOUSE group is the default
-		# group that the thermostat will monitor
-		houseTemp = round(HVAC.thermostat.getTemp("HOUSE"))
-		LOGGER.debug("House temp is {}".format(houseTemp))
-		# MQTT.publish("ziggy/climate/temp/house", houseTemp)
-
-		# Check the weather every "delay" minutes
-		# We need the weather to set the state of the thermostat
-		if WEATHER.shouldUpdate():
-			# print("Weather needs a break")
-			WEATHER.update(WEATHER.url)
-			LOGGER.info("Temp outside is {}".format(WEATHER.forecast["currently"]["temperature"]))
-			# MQTT.publish("ziggy/climate/temp/outside", WEATHER.forecast["currently"]["temperature"])
-		# Set the state of the thermostat every "delay" minutes default => 1440 (one day)
-		if HVAC.thermostat.shouldUpdate():
-			try:
-				HVAC.thermostat.update((WEATHER.forecast["daily"]["data"][0]["temperatureHigh"], WEATHER.forecast["daily"]["data"][0]["temperatureLow"], hvactools.checkTimeOfYear()))
-			except TypeError as e:
-				LOGGER.error("Error updating thermostat  {}".format(e))
-				 # BUG:  Hack for if the weather fails
-				HVAC.thermostat.update((HVAC.thermostat.maxTemp, HVAC.thermostat.minTemp, hvactools.checkTimeOfYear()))
-			LOGGER.info("Thermostat mode updated to {}".format(HVAC.thermostat.state))
-		# See if there is anybody home
-		# Only check every so often => WIFI.delay
-		if WIFI.shouldUpdate():
-			WIFI.update(SETTINGS["WIFI"])
-			LOGGER.info("People home {}".format(WIFI.home))
-			# MQTT.publish("ziggy/occupancy/people", str(WIFI.home))
-
-		# Set the desired temperature of the house
-		if HVAC.thermostat.state != "OFF":
-			HVAC.thermostat.tempModifier = {"TIMEMODS": SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["TIME_SETTINGS"], "OCCUPIED": [WIFI.occupied, SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["OCCUPIED_SETTINGS"]]}
-			HVAC.thermostat.desiredTemp = SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["DEFAULT_TEMP"] + HVAC.thermostat.tempModifier
-		else:
-			HVAC.thermostat.desiredTemp = SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]
-
-		# Check if the HVAC should turn on or off
-		# House is hot
-		if houseTemp > HVAC.thermostat.desiredTemp:
-			LOGGER.debug("House is HOT")
-
-			if HVAC.thermostat.state == "HEAT" and HVAC.heater.state == "ON":
-				LOGGER.debug("Heater is on")
-				# I put the heater/vent/ac on a timer so it does not go on and off
-				# if there is a glitch in the temp sensors
-				if HVAC.heater.shouldUpdate():
-					# Do this to make sure it wasnt a rogue reading
-					if round(HVAC.thermostat.getTemp("HOUSE")) <= HVAC.thermostat.desiredTemp:
-						continue
-					else:
-						LOGGER.debug("Been on for a while")
-						HVAC.heater.update()
-
-						HVAC.turnOff("HEAT")
-						LOGGER.info("House temp is {}".format(houseTemp))
-
-			elif HVAC.thermostat.state == "COOL" and HVAC.ac.state == "OFF":
-				HVAC.turnOn("COOL")
-
-			else:
-				LOGGER.debug("House is hot, but to early to update, so, WE GOOD")
-		# House is cold
-		elif houseTemp < HVAC.thermostat.desiredTemp:
-			LOGGER.debug("House is cold")
-			if HVAC.thermostat.state == "HEAT" and HVAC.heater.state == "OFF": # and HVAC.heater.shouldUpdate():
-				# HVAC.heater.update()
-				LOGGER.debug("Heater is off")
-				if HVAC.heater.shouldUpdate():
-					if round(HVAC.thermostat.getTemp("HOUSE")) >= HVAC.thermostat.desiredTemp:
-						continue
-					else:
-						LOGGER.debug("been off for a while")
-						HVAC.heater.update()
-
-						HVAC.turnOn("HEAT")
-						LOGGER.info("House temp is {}".format(houseTemp))
-
-			elif HVAC.thermostat.state == "COOL" and HVAC.ac.state == "ON":
-				HVAC.turnOff("COOL")
-
-			else:
-				LOGGER.debug("House is cold, but too early to update, so, WE GOOD IN CHILL")
-
-		else:
-			LOGGER.debug("House temp is the same. Heater state is {}".format(HVAC.heater.state))
-		time.sleep(1)
-
-	while HVAC.thermostat.mode == "MANUAL":
-		HVAC.turnOff("ALL")
+# Edits to the settings files are applied while running, without touching the relays
+WATCHER = configwatch.ConfigWatcher([constants.DEFAULTCONFIG, uSettings], loadSettings, ENGINE.reloadSettings, settings=loadSettings())
+WATCHER.start()
+
+asyncio.run(ENGINE.run())
+
+WATCHER.stop()
+for zone in ZONES:
+	zone.model.save()
+
+if HVAC.pulser:
+	# Let any relay that is mid pulse finish before the board goes away
+	HVAC.pulser.stop()
+if HVAC.board:
+	HVAC.board.shutdown()
+MQTT.stop()
+STATUS.close()
+LOGPIPE.stop()
@@ -0,0 +1,384 @@
+"""
+runconfig.py
+
+Checks the merged SETTINGS once and turns them into read only config objects.
+
+hvactools.updateSettings only merges JSON, so a typo in a nested key or a bad
+time only shows up when the control loop trips over it, maybe hours later.
+compile() goes through everything up front and raises one ConfigError that
+lists every problem it found, with the path to each one:
+
+    TEMP_SETTINGS.HEAT.TIME_SETTINGS.TIME_ONE: 2500 is not a valid HHMM time
+
+What comes back is a Config made of small __slots__ objects that can not be
+changed, so the running code reads plain attributes instead of digging through
+nested dicts, and a reload is a new Config swapped in whole.
+"""
+
+import logging
+import numbers
+from types import MappingProxyType
+
+try:
+    import schedule
+except ModuleNotFoundError:
+    import thermostat.schedule as schedule
+try:
+    import zones as zonesModule
+except ModuleNotFoundError:
+    import thermostat.zones as zonesModule
+
+LOGGER = logging.getLogger("__main__.runconfig")
+
+STATES = ("HEAT", "COOL", "VENT", "OFF")
+SENSOR_MODELS = ("LM35",)
+RELAY_KEYS = ("HEAT_PINS", "VENT_PINS", "AC_PINS")
+
+class ConfigError(ValueError):
+    """
+    <list> errors => Every problem found, as "PATH: what is wrong"
+    """
+    def __init__(self, errors):
+        self.errors = list(errors)
+        ValueError.__init__(self, "{} problem(s) in the settings\n    {}".format(len(self.errors), "\n    ".join(self.errors)))
+
+class Frozen():
+    """
+    A record with __slots__ that can not be changed once it is made
+    """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is read only".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is read only".format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) == type(other) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+class RelayPins(Frozen):
+    __slots__ = ("on", "off")
+
+    def __iter__(self):
+        return iter((self.on, self.off))
+
+class HVACPins(Frozen):
+    __slots__ = ("heat", "vent", "ac")
+
+    def pins(self):
+        return {pin for relay in (self.heat, self.vent, self.ac) for pin in relay}
+
+class SensorSpec(Frozen):
+    __slots__ = ("name", "model", "pin")
+
+class TimeWindow(Frozen):
+    """
+    start, end => Minute of the day.  days => Day numbers, Monday is 0
+    """
+    __slots__ = ("name", "start", "end", "modifier", "days")
+
+class TempProfile(Frozen):
+    """
+    The settings for one thermostat state
+    """
+    __slots__ = ("state", "defaultTemp", "windows", "home", "away")
+
+class TempSettings(Frozen):
+    """
+    profiles => {state: TempProfile}
+    """
+    __slots__ = ("defaultTemp", "minTemp", "maxTemp", "profiles")
+
+class ZoneConfig(Frozen):
+    """
+    hvac => HVACPins, None for the default zone.  tempSettings => None to use the top level ones
+    """
+    __slots__ = ("name", "group", "hvac", "tempSettings")
+
+class Occupancy(Frozen):
+    """
+    people => {person: (hostnames, IP or MAC addresses)}
+    """
+    __slots__ = ("people",)
+
+class PresenceConfig(Frozen):
+    __slots__ = ("neighborTable", "presentTTL", "absentTTL")
+
+class WeatherConfig(Frozen):
+    __slots__ = ("url", "saveFile")
+
+class SensorHealthConfig(Frozen):
+    """
+    The limits sensorhealth.SensorHealth checks every sensor against
+    """
+    __slots__ = ("window", "minSuccess", "stuckMinutes", "stuckPasses", "maxVariance", "maxRate", "probeEvery", "recoverAfter")
+
+    def settings(self):
+        """
+        As keyword arguments for SensorHealth
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class ModelConfig(Frozen):
+    """
+    minCycleMinutes => None keeps the delay each relay was made with
+    """
+    __slots__ = ("lookaheadMinutes", "minCycleMinutes", "saveDir")
+
+class MetricsConfig(Frozen):
+    __slots__ = ("host", "port")
+
+class LoggingConfig(Frozen):
+    """
+    flushLevel => The logging level number, ie logging.WARNING
+    """
+    __slots__ = ("ringSize", "incidentFile", "flushLevel")
+
+class Config(Frozen):
+    __slots__ = ("userDir", "statusFile", "relayJournal", "hvac", "sensors", "sensorGroups", "zones", "tempSettings", "sensorHealth", "wifi", "presence", "weather", "model", "metrics", "logging")
+
+class Checker():
+    """
+    Collects the problems so they can all be reported at once
+    """
+    def __init__(self):
+        self.errors = []
+
+    def error(self, path, message):
+        self.errors.append("{}: {}".format(path, message))
+
+    def section(self, settings, path, required=(), optional=()):
+        """
+        Returns the dict at path, or an empty one if it is missing or not a dict.
+        Reports missing and unknown keys.
+        """
+        if not isinstance(settings, dict):
+            self.error(path, "should be an object, not {!r}".format(settings))
+            return {}
+        for key in required:
+            if key not in settings:
+                self.error(path, "{} is missing".format(key))
+        if required or optional:
+            for key in settings:
+                if key not in required and key not in optional:
+                    self.error("{}.{}".format(path, key), "is not a setting")
+        return settings
+
+    def number(self, value, path, minimum=None, optional=False):
+        if value is None and optional:
+            return None
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            self.error(path, "{!r} is not a number".format(value))
+            return None
+        if minimum is not None and value < minimum:
+            self.error(path, "{} is less than {}".format(value, minimum))
+        return value
+
+    def text(self, value, path, optional=False):
+        if value is None and optional:
+            return None
+        if not isinstance(value, str):
+            self.error(path, "{!r} is not a string".format(value))
+            return None
+        return value
+
+    def relayPins(self, value, path):
+        if not isinstance(value, list) or len(value) != 2 or not all(isinstance(pin, int) and not isinstance(pin, bool) and pin >= 0 for pin in value):
+            self.error(path, "{!r} should be [onPin, offPin]".format(value))
+            return None
+        if value[0] == value[1]:
+            self.error(path, "the on and off pins are both {}".format(value[0]))
+        return RelayPins(on=value[0], off=value[1])
+
+    def hvacPins(self, value, path):
+        value = self.section(value, path, RELAY_KEYS)
+        relays = {key: self.relayPins(value[key], "{}.{}".format(path, key)) for key in RELAY_KEYS if key in value}
+        if len(relays) != len(RELAY_KEYS) or None in relays.values():
+            return None
+        pins = HVACPins(heat=relays["HEAT_PINS"], vent=relays["VENT_PINS"], ac=relays["AC_PINS"])
+        if len(pins.pins()) != 6:
+            self.error(path, "the relays share pins")
+        return pins
+
+    def window(self, name, entry, path):
+        if not isinstance(entry, list) or len(entry) not in (3, 4):
+            self.error(path, "{!r} should be [start, end, modifier] or [start, end, modifier, days]".format(entry))
+            return None
+        try:
+            start, end = schedule.minuteOfDay(entry[0]), schedule.minuteOfDay(entry[1])
+            days = tuple(schedule.dayNumbers(entry[3] if len(entry) == 4 else None))
+        except (TypeError, ValueError) as e:
+            self.error(path, e)
+            return None
+        modifier = self.number(entry[2], "{}[2]".format(path))
+        if modifier is None:
+            return None
+        return TimeWindow(name=name, start=start, end=end, modifier=modifier, days=days)
+
+    def profile(self, state, settings, path):
+        settings = self.section(settings, path, ("DEFAULT_TEMP",), ("TIME_SETTINGS", "OCCUPIED_SETTINGS"))
+        defaultTemp = self.number(settings.get("DEFAULT_TEMP"), "{}.DEFAULT_TEMP".format(path))
+        windows = []
+        timeSettings = self.section(settings.get("TIME_SETTINGS", {}), "{}.TIME_SETTINGS".format(path))
+        for name, entry in timeSettings.items():
+            window = self.window(name, entry, "{}.TIME_SETTINGS.{}".format(path, name))
+            if window:
+                windows.append(window)
+        occupied = self.section(settings.get("OCCUPIED_SETTINGS", {}), "{}.OCCUPIED_SETTINGS".format(path), optional=("HOME", "AWAY"))
+        modifiers = {}
+        for key in ("HOME", "AWAY"):
+            entry = occupied.get(key, [0, 0, 0])
+            if not isinstance(entry, list) or len(entry) != 3:
+                self.error("{}.OCCUPIED_SETTINGS.{}".format(path, key), "{!r} should be [start, end, modifier]".format(entry))
+                modifiers[key] = 0
+            else:
+                modifiers[key] = self.number(entry[2], "{}.OCCUPIED_SETTINGS.{}[2]".format(path, key)) or 0
+        return TempProfile(state=state, defaultTemp=defaultTemp, windows=tuple(windows), home=modifiers["HOME"], away=modifiers["AWAY"])
+
+    def tempSettings(self, settings, path):
+        settings = self.section(settings, path, ("DEFAULT_TEMP",), ("MIN_TEMP", "MAX_TEMP") + STATES)
+        defaultTemp = self.number(settings.get("DEFAULT_TEMP"), "{}.DEFAULT_TEMP".format(path))
+        minTemp = self.number(settings.get("MIN_TEMP"), "{}.MIN_TEMP".format(path), optional=True)
+        maxTemp = self.number(settings.get("MAX_TEMP"), "{}.MAX_TEMP".format(path), optional=True)
+        if minTemp is not None and maxTemp is not None and minTemp > maxTemp:
+            self.error(path, "MIN_TEMP {} is above MAX_TEMP {}".format(minTemp, maxTemp))
+        profiles = {state: self.profile(state, settings[state], "{}.{}".format(path, state)) for state in STATES if state in settings}
+        return TempSettings(defaultTemp=defaultTemp, minTemp=minTemp, maxTemp=maxTemp, profiles=MappingProxyType(profiles))
+
+def compile(settings):
+    """
+    settings => The merged default and user SETTINGS
+    Returns a Config, or raises ConfigError with every problem found
+    """
+    check = Checker()
+    if not isinstance(settings, dict):
+        raise ConfigError(["SETTINGS: did not load"])
+
+    userDir = check.text(settings.get("USER_DIR"), "USER_DIR")
+    statusFile = check.text(settings.get("STATUS_FILE"), "STATUS_FILE")
+    relayJournal = check.text(settings.get("RELAY_JOURNAL"), "RELAY_JOURNAL")
+
+    hvac = check.hvacPins(settings.get("HVAC"), "HVAC")
+
+    sensors = []
+    for name, spec in check.section(settings.get("SENSORS"), "SENSORS").items():
+        path = "SENSORS.{}".format(name)
+        if not isinstance(spec, list) or len(spec) != 2:
+            check.error(path, "{!r} should be [model, pin]".format(spec))
+        elif spec[0] not in SENSOR_MODELS:
+            check.error(path, "{!r} is not a sensor model.  Use one of {}".format(spec[0], ", ".join(SENSOR_MODELS)))
+        elif not isinstance(spec[1], int) or isinstance(spec[1], bool) or spec[1] < 0:
+            check.error(path, "{!r} is not an analog pin".format(spec[1]))
+        else:
+            sensors.append(SensorSpec(name=name, model=spec[0], pin=spec[1]))
+    sensorNames = {sensor.name for sensor in sensors}
+
+    groups = {}
+    for name, members in check.section(settings.get("SENSOR_GROUPS"), "SENSOR_GROUPS").items():
+        path = "SENSOR_GROUPS.{}".format(name)
+        if not isinstance(members, list):
+            check.error(path, "{!r} should be a list of sensors".format(members))
+            continue
+        for member in members:
+            if member not in sensorNames:
+                check.error(path, "{!r} is not in SENSORS".format(member))
+        groups[name] = tuple(members)
+
+    tempSettings = check.tempSettings(settings.get("TEMP_SETTINGS"), "TEMP_SETTINGS")
+
+    zones = []
+    for name, zone in check.section(settings.get("ZONES") or {}, "ZONES").items():
+        path = "ZONES.{}".format(name)
+        zone = check.section(zone or {}, path, optional=("GROUP", "HVAC", "TEMP_SETTINGS"))
+        group = check.text(zone.get("GROUP", name), "{}.GROUP".format(path))
+        if group is not None and group not in groups:
+            check.error("{}.GROUP".format(path), "{!r} is not in SENSOR_GROUPS".format(group))
+        zonePins = check.hvacPins(zone["HVAC"], "{}.HVAC".format(path)) if "HVAC" in zone else None
+        if name != zonesModule.DEFAULT_ZONE:
+            if "HVAC" not in zone:
+                check.error(path, "HVAC is missing.  Every zone but {} needs its own relay pins".format(zonesModule.DEFAULT_ZONE))
+            elif zonePins and hvac and zonePins.pins() & hvac.pins():
+                check.error("{}.HVAC".format(path), "pins {} are already used by HVAC".format(sorted(zonePins.pins() & hvac.pins())))
+        zoneTemps = check.tempSettings(zone["TEMP_SETTINGS"], "{}.TEMP_SETTINGS".format(path)) if zone.get("TEMP_SETTINGS") else None
+        zones.append(ZoneConfig(name=name, group=group, hvac=zonePins, tempSettings=zoneTemps))
+
+    people = {}
+    for person, hosts in check.section(settings.get("WIFI") or {}, "WIFI").items():
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        if not isinstance(hosts, list) or not all(isinstance(host, str) and host for host in hosts):
+            check.error("WIFI.{}".format(person), "{!r} should be a list of hostnames or addresses".format(hosts))
+            continue
+        people[person] = tuple(hosts)
+
+    presence = check.section(settings.get("PRESENCE"), "PRESENCE", ("NEIGHBOR_TABLE", "PRESENT_TTL", "ABSENT_TTL"))
+    weather = check.section(settings.get("WEATHER"), "WEATHER", ("SAVE_FILE",), ("URL",))
+    model = check.section(settings.get("MODEL"), "MODEL", ("LOOKAHEAD_MINUTES", "MIN_CYCLE_MINUTES", "SAVE_DIR"))
+    health = check.section(settings.get("SENSOR_HEALTH"), "SENSOR_HEALTH", ("WINDOW", "MIN_SUCCESS", "STUCK_MINUTES", "STUCK_PASSES", "MAX_VARIANCE", "MAX_RATE", "PROBE_EVERY", "RECOVER_AFTER"))
+    for key in ("WINDOW", "STUCK_PASSES", "PROBE_EVERY", "RECOVER_AFTER"):
+        value = health.get(key)
+        if key in health and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            check.error("SENSOR_HEALTH.{}".format(key), "{!r} should be a whole number above 0".format(value))
+    minSuccess = check.number(health.get("MIN_SUCCESS"), "SENSOR_HEALTH.MIN_SUCCESS", 0)
+    if minSuccess is not None and minSuccess > 1:
+        check.error("SENSOR_HEALTH.MIN_SUCCESS", "{} should be a share between 0 and 1".format(minSuccess))
+    metrics = check.section(settings.get("METRICS"), "METRICS", ("HOST", "PORT"))
+    metricsPort = metrics.get("PORT")
+    if metricsPort not in (None, "") and (not isinstance(metricsPort, int) or not 0 <= metricsPort < 65536):
+        check.error("METRICS.PORT", "{!r} is not a port".format(metricsPort))
+    logSettings = check.section(settings.get("LOGGING"), "LOGGING", ("RING_SIZE", "INCIDENT_FILE", "FLUSH_LEVEL"))
+    ringSize = logSettings.get("RING_SIZE")
+    if not isinstance(ringSize, int) or isinstance(ringSize, bool) or ringSize < 1:
+        check.error("LOGGING.RING_SIZE", "{!r} should be a whole number above 0".format(ringSize))
+    flushLevel = logging.getLevelName(str(logSettings.get("FLUSH_LEVEL")).upper())
+    if not isinstance(flushLevel, int):
+        check.error("LOGGING.FLUSH_LEVEL", "{!r} is not a logging level".format(logSettings.get("FLUSH_LEVEL")))
+
+    config = Config(
+        userDir=userDir,
+        statusFile=statusFile,
+        relayJournal=relayJournal,
+        hvac=hvac,
+        sensors=tuple(sensors),
+        sensorGroups=MappingProxyType(groups),
+        zones=tuple(zones),
+        tempSettings=tempSettings,
+        sensorHealth=SensorHealthConfig(
+            window=health.get("WINDOW"),
+            minSuccess=minSuccess,
+            stuckMinutes=check.number(health.get("STUCK_MINUTES"), "SENSOR_HEALTH.STUCK_MINUTES", 0),
+            stuckPasses=health.get("STUCK_PASSES"),
+            maxVariance=check.number(health.get("MAX_VARIANCE"), "SENSOR_HEALTH.MAX_VARIANCE", 0),
+            maxRate=check.number(health.get("MAX_RATE"), "SENSOR_HEALTH.MAX_RATE", 0),
+            probeEvery=health.get("PROBE_EVERY"),
+            recoverAfter=health.get("RECOVER_AFTER")
+            ),
+        wifi=Occupancy(people=MappingProxyType(people)),
+        presence=PresenceConfig(
+            neighborTable=check.text(presence.get("NEIGHBOR_TABLE"), "PRESENCE.NEIGHBOR_TABLE"),
+            presentTTL=check.number(presence.get("PRESENT_TTL"), "PRESENCE.PRESENT_TTL", 0),
+            absentTTL=check.number(presence.get("ABSENT_TTL"), "PRESENCE.ABSENT_TTL", 0)
+            ),
+        weather=WeatherConfig(
+            url=check.text(weather.get("URL"), "WEATHER.URL", optional=True),
+            saveFile=check.text(weather.get("SAVE_FILE"), "WEATHER.SAVE_FILE")
+            ),
+        model=ModelConfig(
+            lookaheadMinutes=check.number(model.get("LOOKAHEAD_MINUTES"), "MODEL.LOOKAHEAD_MINUTES", 0),
+            minCycleMinutes=check.number(model.get("MIN_CYCLE_MINUTES"), "MODEL.MIN_CYCLE_MINUTES", 0, optional=True),
+            saveDir=check.text(model.get("SAVE_DIR"), "MODEL.SAVE_DIR")
+            ),
+        metrics=MetricsConfig(host=check.text(metrics.get("HOST"), "METRICS.HOST", optional=True) or "", port=metricsPort or None),
+        logging=LoggingConfig(ringSize=ringSize, incidentFile=check.text(logSettings.get("INCIDENT_FILE"), "LOGGING.INCIDENT_FILE"), flushLevel=flushLevel)
+        )
+    if check.errors:
+        raise ConfigError(check.errors)
+    return config
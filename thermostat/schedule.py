@@ -0,0 +1,120 @@
+"""
+schedule.py
+
+Turns the TEMP_SETTINGS for a thermostat state into a lookup table.
+
+Every minute of the week gets its TIME_SETTINGS offset worked out once, so
+finding the current modifier is one index into an array instead of walking the
+settings and comparing strings.
+
+A TIME_SETTINGS entry is [start, end, modifier] or [start, end, modifier, days]
+    start, end => "HHMM".  The window includes start and stops just before end.
+        If end is before start the window runs past midnight into the next day.
+        If they are the same the window is the whole day.
+    days => Optional list of the days the window starts on, "MON" .. "SUN"
+        (or 0 .. 6).  Leave it out for every day.
+"""
+
+import logging
+from array import array
+
+import numpy
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.schedule")
+
+DAYS = ["MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN"]
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+def minuteOfDay(hhmm):
+    """
+    "0630" => 390
+    """
+    hhmm = str(hhmm).zfill(4)
+    hours, minutes = int(hhmm[:-2]), int(hhmm[-2:])
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        raise ValueError("{} is not a valid HHMM time".format(hhmm))
+    return min(hours * 60 + minutes, MINUTES_PER_DAY)
+
+def minuteOfWeek(now):
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+def dayNumbers(days):
+    if days is None:
+        return range(7)
+    numbers = []
+    for day in days:
+        if isinstance(day, int):
+            numbers.append(day % 7)
+        elif str(day).upper()[:3] in DAYS:
+            numbers.append(DAYS.index(str(day).upper()[:3]))
+        else:
+            raise ValueError("{} is not a day of the week".format(day))
+    return numbers
+
+class CompiledSchedule():
+    """
+    <dict> stateSettings => One state from TEMP_SETTINGS, ie SETTINGS["TEMP_SETTINGS"]["HEAT"]
+    """
+    def __init__(self, stateSettings):
+        self.LOGGER = logging.getLogger("__main__.schedule.CompiledSchedule")
+        self.defaultTemp = stateSettings.get("DEFAULT_TEMP")
+        self.offsets = array("d", bytes(8 * MINUTES_PER_WEEK))
+
+        for name, entry in stateSettings.get("TIME_SETTINGS", {}).items():
+            try:
+                self.addWindow(*entry)
+            except (TypeError, ValueError) as e:
+                self.LOGGER.error("Time setting {} {} is not valid.  {}".format(name, entry, e))
+
+        occupied = stateSettings.get("OCCUPIED_SETTINGS", {})
+        self.home = occupied.get("HOME", [0, 0, 0])[2]
+        self.away = occupied.get("AWAY", [0, 0, 0])[2]
+
+    def addWindow(self, start, end, modifier, days=None):
+        start, end = minuteOfDay(start), minuteOfDay(end)
+        length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        for day in dayNumbers(days):
+            first = day * MINUTES_PER_DAY + start
+            for minute in range(first, first + length):
+                # Past midnight on Sunday is Monday morning
+                self.offsets[minute % MINUTES_PER_WEEK] += modifier
+
+    def timeModifier(self, now=None):
+        if now is None:
+            now = clock.CLOCK.now()
+        return self.offsets[minuteOfWeek(now)]
+
+    def modifier(self, occupied, now=None):
+        """
+        The full temp modifier for the time and whether anybody is home
+        """
+        mod = self.timeModifier(now) + (self.home if occupied else self.away)
+        # Keep whole degrees as ints, like they are written in the settings
+        return int(mod) if mod == int(mod) else mod
+
+    def upcoming(self, occupied, now=None, minutes=180):
+        """
+        The target temp for each of the next minutes, as a numpy array.
+        Index 0 is the current minute.  Occupancy is assumed to stay as it is.
+        """
+        if now is None:
+            now = clock.CLOCK.now()
+        offsets = numpy.frombuffer(self.offsets, dtype=float)
+        ahead = numpy.take(offsets, numpy.arange(minuteOfWeek(now), minuteOfWeek(now) + minutes), mode="wrap")
+        return ahead + (self.defaultTemp + (self.home if occupied else self.away))
+
+def compileSchedules(tempSettings):
+    """
+    Compile every state in TEMP_SETTINGS.  Returns {state: CompiledSchedule}
+    """
+    schedules = {}
+    for state, stateSettings in tempSettings.items():
+        if isinstance(stateSettings, dict):
+            schedules[state] = CompiledSchedule(stateSettings)
+    return schedules
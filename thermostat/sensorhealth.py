@@ -0,0 +1,198 @@
+"""
+sensorhealth.py
+
+Keeps track of how well each temp sensor is doing.
+
+Every pass the raw samples of a sensor are checked.  The read counts as bad if
+there are none, the average is out of range, the samples jump around too much,
+or the average moved faster than a house can.  A sensor that returns exactly
+the same samples pass after pass for hours is stuck.  When too many reads in the window are
+bad, or the sensor is stuck, it is quarantined: its temp is left out of its
+group, and it is only read every so often to see if it came back.  After a few
+good reads in a row it is used again.
+"""
+
+import logging
+from collections import deque
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.sensorhealth")
+
+OK = "OK"
+QUARANTINED = "QUARANTINED"
+
+# The raw analog values a working LM35 gives indoors
+RAW_RANGE = (30, 60)
+# A change this small is just ADC noise, however soon after the last read it comes
+NOISE = 2
+
+class SensorHealth():
+    """
+    <str> name => The sensor's name
+    <int> window => How many reads the success rate is worked out over
+    <float> minSuccess => The share of good reads below which the sensor is quarantined
+    <float> stuckMinutes => How long a sensor can return exactly the same samples before it is stuck
+    <int> stuckPasses => How many passes in a row the samples also have to come back the same
+    <float> maxVariance => The most the raw samples of one read can vary and still be good
+    <float> maxRate => The most the raw average can change per second from the last good read
+    <int> probeEvery => A quarantined sensor is only read every this many passes
+    <int> recoverAfter => Good reads in a row before a quarantined sensor is used again
+    """
+    def __init__(self, name, window=20, minSuccess=.5, stuckMinutes=120, stuckPasses=3, maxVariance=25, maxRate=1.0, probeEvery=30, recoverAfter=3):
+        self.LOGGER = logging.getLogger("__main__.sensorhealth.SensorHealth")
+        self.name = name
+        self.window = window
+        self.minSuccess = minSuccess
+        self.stuckMinutes = stuckMinutes
+        self.stuckPasses = stuckPasses
+        self.maxVariance = maxVariance
+        self.maxRate = maxRate
+        self.probeEvery = probeEvery
+        self.recoverAfter = recoverAfter
+
+        self.state = OK
+        # Why the last bad read was bad, or why the sensor is quarantined
+        self.reason = None
+        self.results = deque(maxlen=window)
+        self.lastGood = None
+        self.lastGoodAt = None
+        self.quarantinedAt = None
+
+        self.__lastSamples = None
+        self.__lastSamplesAt = None
+        # When the samples stopped changing
+        self.__sameSince = None
+        self.__stuckFor = 0
+        # Passes in a row the samples came back the same
+        self.__flatPasses = 0
+        self.__skipped = 0
+        self.__goodProbes = 0
+
+    @property
+    def healthy(self):
+        return self.state == OK
+
+    @property
+    def stuck(self):
+        return self.__sameSince is not None and self.__stuckFor >= self.stuckMinutes * 60 and self.__flatPasses >= self.stuckPasses
+
+    @property
+    def successRate(self):
+        if not self.results:
+            return 1.0
+        return sum(self.results) / len(self.results)
+
+    def configure(self, **settings):
+        """
+        Change the limits, ie configure(window=30, maxRate=.5)
+        """
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError("SensorHealth has no setting {}".format(name))
+            setattr(self, name, value)
+        if self.results.maxlen != self.window:
+            self.results = deque(self.results, maxlen=self.window)
+
+    def due(self):
+        """
+        True if the sensor should be read this pass.  A healthy sensor always
+        is, a quarantined one only every probeEvery passes.
+        """
+        if self.healthy:
+            return True
+        self.__skipped += 1
+        if self.__skipped >= self.probeEvery:
+            self.__skipped = 0
+            return True
+        return False
+
+    def check(self, samples, now, checkStuck):
+        """
+        Returns (average, None) for a good read, or (average, reason) for a bad one
+        """
+        if not samples:
+            return None, "no reading"
+        average = sum(samples) / len(samples)
+        if not RAW_RANGE[0] < average < RAW_RANGE[1]:
+            return average, "{:.1f} is out of range".format(average)
+        if len(samples) > 1:
+            variance = sum((value - average) ** 2 for value in samples) / len(samples)
+            if variance > self.maxVariance:
+                return average, "the samples vary by {:.1f}".format(variance)
+        if self.lastGoodAt is not None:
+            change = abs(average - self.lastGood)
+            elapsed = now - self.lastGoodAt
+            if change > NOISE and change > self.maxRate * elapsed:
+                return average, "it moved {:.1f} in {:.1f} seconds".format(change, elapsed)
+        if checkStuck:
+            samples = tuple(samples)
+            if samples == self.__lastSamples and len(set(samples)) == 1:
+                if self.__sameSince is None:
+                    self.__sameSince = self.__lastSamplesAt
+                self.__stuckFor = now - self.__sameSince
+                self.__flatPasses += 1
+            else:
+                self.__sameSince = None
+                self.__flatPasses = 0
+            self.__lastSamples = samples
+            self.__lastSamplesAt = now
+            if self.stuck:
+                return average, "stuck at {}".format(samples[0])
+        return average, None
+
+    def record(self, samples, now=None, checkStuck=True):
+        """
+        Check the raw samples from one pass.
+        checkStuck => False when the samples only change when the sensor does (streaming)
+
+        Returns the average to use, or None if the read was bad or the sensor is quarantined
+        """
+        if now is None:
+            now = clock.CLOCK.monotonic()
+        average, reason = self.check(samples, now, checkStuck)
+        good = reason is None
+        if good:
+            self.lastGood = average
+            self.lastGoodAt = now
+        else:
+            if self.reason is None or self.healthy:
+                self.LOGGER.debug("Bad read from {}  {}".format(self.name, reason))
+            self.reason = reason
+        self.results.append(good)
+
+        if self.healthy:
+            failing = len(self.results) >= self.window // 2 and self.successRate < self.minSuccess
+            if failing or self.stuck:
+                self.quarantine(reason)
+                return None
+            if good:
+                self.reason = None
+            return average if good else None
+
+        if good:
+            self.__goodProbes += 1
+            if self.__goodProbes >= self.recoverAfter:
+                self.recover()
+                return average
+        else:
+            self.__goodProbes = 0
+        return None
+
+    def quarantine(self, reason):
+        self.state = QUARANTINED
+        self.reason = reason
+        self.quarantinedAt = clock.CLOCK.monotonic()
+        self.__skipped = 0
+        self.__goodProbes = 0
+        self.LOGGER.warning("Sensor {} is having an error and is left out until it recovers.  {}".format(self.name, reason))
+
+    def recover(self):
+        self.state = OK
+        self.reason = None
+        self.results.clear()
+        self.__goodProbes = 0
+        self.LOGGER.info("Sensor {} recovered".format(self.name))
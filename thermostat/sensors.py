@@ -7,10 +7,18 @@ __author__ = "builderjer"
 __version__ = "0.1.4"
 
 import logging
-import subprocess
-import sys
+
+try:
+	import prober
+except ModuleNotFoundError:
+	import thermostat.prober as prober
+try:
+	import tracepoints
+except ModuleNotFoundError:
+	import thermostat.tracepoints as tracepoints
 
 LOGGER = logging.getLogger("__main__.sensors.py")
+TRACE = tracepoints.tracepoint("sensors")
 
 class Sensor:
 	"""
@@ -85,7 +93,8 @@ class TempSensor(Sensor):
 		"""
 		rawValue => The raw sensor value before any conversions
 		"""
-		self.LOGGER.debug("Setting tempC with rawValue {}".format(rawValue))
+		if TRACE.enabled:
+			TRACE("tempSensor.tempC.set", sensor=self._name, rawValue=rawValue)
 		# Do all of the conversions here.  It uses the moduleType to determine what conversion to use.
 		try:
 			if self.moduleType == "LM35":
@@ -104,7 +113,8 @@ class TempSensor(Sensor):
 		# LM35 uses centigrade as its base temp.  Use that for the conversion
 		if self.tempC:
 			tF = (self.tempC * 1.8) + 32
-			self.LOGGER.debug("tempC: {}  tempF: {}".format(self.tempC, tF))
+			if TRACE.enabled:
+				TRACE("tempSensor.tempF", sensor=self._name, tempC=self._tempC, tempF=tF)
 			return tF
 		else:
 			self.LOGGER.error("No tempC to convert sensor {}".format(self.name))
@@ -130,12 +140,11 @@ class PresenceDetector:
 	@homeList.setter
 	def homeList(self, addressList):
 		tempList = []
+		reachable = prober.PROBER.probe(self.addresses.values())
 		for name in self.addresses:
-			try:
-				# NOTE: This only works on Linux...For now
-				if subprocess.check_output(["ping", "-c", "1", self.addresses[name]]):
-					tempList.append(name)
-			except subprocess.CalledProcessError as e:
+			if self.addresses[name] in reachable:
+				tempList.append(name)
+			else:
 				self.LOGGER.info("{} at {} not reachable".format(name, self.addresses[name]))
 		self._homeList = tempList
 
@@ -177,17 +186,10 @@ class WiFiDetector(Sensor):
 		self.LOGGER.debug("Removed address {} from {}".format(address, name))
 
 	def pingAddress(self, address):
-		if sys.platform == "linux":
-			try:
-				subprocess.check_output(["ping", "-c", "1", address])
-				return True
-			except subprocess.CalledProcessError as e:
-				self.LOGGER.error("{} unreachable".format(address))
-				return False
-		else:
-			# do other os here
-			self.LOGGER.error("{} is not yes supported. Please create a pull request".format(sys.platform))
-			return False
+		if prober.PROBER.probe([address]):
+			return True
+		self.LOGGER.error("{} unreachable".format(address))
+		return False
 
 
 #class PhotoSensor:
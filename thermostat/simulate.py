@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+simulate.py
+
+Run the thermostat against a simulated house on a virtual clock.
+
+The real hvac, engine, schedule and TimedObject code runs, only the board,
+weather and WiFi are stand ins.  A day of control at the default 60 second step
+takes well under a second.  At the engine's 1 second period it is 60 times the
+passes, and takes about 60 times as long.
+
+    ./simulate.py [hours] [step seconds]
+"""
+
+import datetime
+import json
+import logging
+import sys
+import time
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import constants
+except ModuleNotFoundError:
+    import thermostat.constants as constants
+try:
+    import boards
+except ModuleNotFoundError:
+    import thermostat.boards as boards
+try:
+    import engine
+except ModuleNotFoundError:
+    import thermostat.engine as engine
+try:
+    import hvac as hvacModule
+except ModuleNotFoundError:
+    import thermostat.hvac as hvacModule
+try:
+    import hvactools
+except ModuleNotFoundError:
+    import thermostat.hvactools as hvactools
+try:
+    import occupancy
+except ModuleNotFoundError:
+    import thermostat.occupancy as occupancy
+try:
+    import weather
+except ModuleNotFoundError:
+    import thermostat.weather as weather
+
+LOGGER = logging.getLogger("__main__.simulate")
+
+def cToF(tempC):
+    return tempC * 1.8 + 32
+
+class SimulatedWeather(weather.WeatherForecast):
+    """
+    A forecast made from the simulated board's outdoor temps
+    """
+    def __init__(self, board, delay=20):
+        weather.WeatherForecast.__init__(self, "simulated", delay)
+        self.board = board
+
+    def update(self, jsonFile):
+        self.forecast = {
+            "currently": {"temperature": round(cToF(self.board.outdoorC), 1)},
+            "daily": {"data": [{
+                "temperatureHigh": round(cToF(self.board.outdoorMeanC + self.board.outdoorSwingC), 1),
+                "temperatureLow": round(cToF(self.board.outdoorMeanC - self.board.outdoorSwingC), 1)
+                }]}
+            }
+        self.lastCheck = clock.CLOCK.now()
+
+class SimulatedOccupancy(occupancy.WiFi):
+    """
+    <function> schedule => Called with the current datetime, returns True if somebody is home
+    """
+    def __init__(self, schedule=None, delay=15):
+        occupancy.WiFi.__init__(self, {}, delay)
+        self.schedule = schedule if schedule else lambda now: not (8 <= now.hour < 17)
+
+    def update(self, wifiAddresses):
+        self.occupied = self.schedule(clock.CLOCK.now())
+        self.lastCheck = clock.CLOCK.now()
+
+class Simulation():
+    def __init__(self, settings, start=None, occupiedSchedule=None, **houseOptions):
+        self.LOGGER = logging.getLogger("__main__.simulate.Simulation")
+        self.settings = settings
+        self.clock = clock.VirtualClock(start if start else datetime.datetime(2026, 1, 15))
+        self.houseOptions = houseOptions
+        self.occupiedSchedule = occupiedSchedule
+        # (datetime, indoorF, outdoorF, desiredTemp, heater, ac)
+        self.samples = []
+        self.hvac = None
+        self.board = None
+        self.engine = None
+
+    def setup(self):
+        hvacPins = self.settings["HVAC"]
+        relayPins = {"HEAT": tuple(hvacPins["HEAT_PINS"]), "COOL": tuple(hvacPins["AC_PINS"]), "VENT": tuple(hvacPins["VENT_PINS"])}
+        self.board = boards.SimulatedBoard(relayPins, **self.houseOptions)
+        self.hvac = hvacModule.setup(self.settings["SENSORS"], self.settings["SENSOR_GROUPS"], self.settings["HVAC"], aggregation=self.settings.get("SENSOR_AGGREGATION"), board=self.board, pulser=False)
+        self.weather = SimulatedWeather(self.board)
+        self.wifi = SimulatedOccupancy(self.occupiedSchedule)
+        self.engine = engine.ControlEngine(self.hvac, self.weather, self.wifi, self.settings)
+        self.engine.prepare()
+        self.hvac.thermostat.defaultTemp = self.settings["TEMP_SETTINGS"]["DEFAULT_TEMP"]
+        self.hvac.turnOff("ALL")
+
+    def step(self, seconds):
+        """
+        One pass of the control loop, seconds after the last one
+        """
+        self.clock.advance(seconds)
+        self.board.tick()
+        if self.weather.shouldUpdate():
+            self.weather.update(self.weather.url)
+            self.engine.forecast.set(self.weather.forecast)
+        if self.wifi.shouldUpdate():
+            self.wifi.update(self.settings["WIFI"])
+            self.engine.occupied.set(self.wifi.occupied)
+        self.hvac.thermostat.updateSensors(self.board)
+        houseTemp = self.hvac.thermostat.getTemp("HOUSE")
+        if houseTemp is not None:
+            self.engine.houseTemp.set(round(houseTemp))
+            self.engine.decide()
+            self.engine.drain()
+        self.samples.append((self.clock.now(), cToF(self.board.indoorC), cToF(self.board.outdoorC), self.hvac.thermostat.desiredTemp, self.hvac.heater.state, self.hvac.ac.state))
+
+    def run(self, hours=24, step=60):
+        """
+        Run the thermostat for hours of virtual time, one control pass every step seconds
+        """
+        oldClock = clock.setClock(self.clock)
+        try:
+            if self.hvac is None:
+                self.setup()
+            end = self.clock.elapsed + hours * 3600
+            while self.clock.elapsed < end:
+                self.step(step)
+        finally:
+            clock.setClock(oldClock)
+        return self.summary()
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        indoor = [s[1] for s in self.samples]
+        heating = sum(1 for s in self.samples if s[4] == "ON")
+        cooling = sum(1 for s in self.samples if s[5] == "ON")
+        return {
+            "passes": len(self.samples),
+            "indoorMinF": round(min(indoor), 1),
+            "indoorMaxF": round(max(indoor), 1),
+            "heatingShare": round(heating / len(self.samples), 3),
+            "coolingShare": round(cooling / len(self.samples), 3),
+            "relayActuations": self.board.actuations
+            }
+
+def loadSettings():
+    return hvactools.updateSettings(None, constants.DEFAULTCONFIG)
+
+if __name__ == "__main__":
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    step = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    simulation = Simulation(loadSettings())
+    started = time.perf_counter()
+    summary = simulation.run(hours, step)
+    summary["wallSeconds"] = round(time.perf_counter() - started, 3)
+    print(json.dumps(summary, indent=4))
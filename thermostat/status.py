@@ -0,0 +1,203 @@
+"""
+status.py
+
+A fixed layout status record in a memory mapped file.
+
+The control daemon is the only writer.  Readers (the web UI, scripts) map the
+same file and copy the record out, so they never open the board, ping anybody
+or fetch the weather themselves.
+
+The record is guarded by a sequence counter, the way a seqlock works.  The
+writer makes the counter odd, writes the record, then makes it even again.  A
+reader copies the record between two reads of the counter and tries again if
+the counter was odd or moved, so it always gets one whole snapshot without any
+locking between the processes.
+"""
+
+import collections
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger("__main__.status")
+
+MAGIC = b"THST"
+LAYOUT_VERSION = 2
+
+# magic, layout version, sequence counter
+HEADER = struct.Struct("<4sI Q")
+RECORD = struct.Struct(
+    "<"
+    "d"     # updated           time.time() of the last write
+    "d"     # houseTemp         nan when unknown
+    "d"     # outsideTemp
+    "d"     # forecastHigh
+    "d"     # forecastLow
+    "d"     # desiredTemp
+    "d"     # tempModifier
+    "d"     # weatherUpdated    time.time(), 0 when never
+    "d"     # occupancyUpdated
+    "8s"    # state             OFF / HEAT / COOL
+    "8s"    # mode              AUTO / MANUAL
+    "B"     # heater            1 when on
+    "B"     # ac
+    "B"     # vent
+    "b"     # occupied          1 / 0, -1 when unknown
+    "H"     # peopleHome
+    "I"     # pid of the writer
+    )
+# Then the temp of each sensor group, up to GROUPS of them
+GROUPS = 8
+GROUP = struct.Struct("<16sd")
+SIZE = HEADER.size + RECORD.size + GROUPS * GROUP.size
+
+FIELDS = ["updated", "houseTemp", "outsideTemp", "forecastHigh", "forecastLow", "desiredTemp", "tempModifier",
+    "weatherUpdated", "occupancyUpdated", "state", "mode", "heater", "ac", "vent", "occupied", "peopleHome", "pid", "groups"]
+
+Status = collections.namedtuple("Status", FIELDS)
+
+def number(value):
+    return float("nan") if value is None else float(value)
+
+def timestamp(value):
+    """
+    datetime => seconds since the epoch, None => 0
+    """
+    if value is None:
+        return 0.0
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    return float(value)
+
+def optional(value):
+    """
+    nan => None for the reader
+    """
+    return None if math.isnan(value) else value
+
+class StatusWriter():
+    """
+    <str> path => The status file.  Somewhere in /dev/shm keeps it off the disk.
+    """
+    def __init__(self, path):
+        self.LOGGER = logging.getLogger("__main__.status.StatusWriter")
+        self.path = Path(path)
+        Path.mkdir(self.path.parent, parents=True, exist_ok=True)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, self.sequence)
+
+        self.LOGGER.debug("Created StatusWriter at {}".format(self.path))
+
+    def write(self, **fields):
+        """
+        Write one whole record.  Any field left out is written as unknown.
+        groups => {groupName: temp}, only the first GROUPS are kept
+        """
+        values = (
+            time.time(),
+            number(fields.get("houseTemp")),
+            number(fields.get("outsideTemp")),
+            number(fields.get("forecastHigh")),
+            number(fields.get("forecastLow")),
+            number(fields.get("desiredTemp")),
+            number(fields.get("tempModifier")),
+            timestamp(fields.get("weatherUpdated")),
+            timestamp(fields.get("occupancyUpdated")),
+            str(fields.get("state") or "").encode()[:8],
+            str(fields.get("mode") or "").encode()[:8],
+            1 if fields.get("heater") == "ON" else 0,
+            1 if fields.get("ac") == "ON" else 0,
+            1 if fields.get("vent") == "ON" else 0,
+            -1 if fields.get("occupied") is None else int(bool(fields.get("occupied"))),
+            min(int(fields.get("peopleHome") or 0), 0xFFFF),
+            os.getpid()
+            )
+        groups = list((fields.get("groups") or {}).items())[:GROUPS]
+        groups += [("", None)] * (GROUPS - len(groups))
+        # Odd while writing, even when the record is whole again
+        self.sequence += 1
+        struct.pack_into("<Q", self.map, 8, self.sequence)
+        RECORD.pack_into(self.map, HEADER.size, *values)
+        for i, (name, temp) in enumerate(groups):
+            GROUP.pack_into(self.map, HEADER.size + RECORD.size + i * GROUP.size, name.encode()[:16], number(temp))
+        self.sequence += 1
+        struct.pack_into("<Q", self.map, 8, self.sequence)
+
+    def close(self):
+        self.map.close()
+
+class StatusReader():
+    """
+    <str> path => The status file the daemon writes
+    <int> retries => How many times to try for a whole record before giving up
+    """
+    def __init__(self, path, retries=100):
+        self.LOGGER = logging.getLogger("__main__.status.StatusReader")
+        self.path = Path(path)
+        self.retries = retries
+        self.map = None
+
+    def open(self):
+        try:
+            with open(self.path, "rb") as sFile:
+                if os.fstat(sFile.fileno()).st_size < SIZE:
+                    return False
+                self.map = mmap.mmap(sFile.fileno(), SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+        except OSError as e:
+            self.LOGGER.debug("No status at {}  {}".format(self.path, e))
+            return False
+        magic, version, sequence = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            self.LOGGER.error("{} is not a status file this version can read".format(self.path))
+            self.close()
+            return False
+        return True
+
+    def read(self):
+        """
+        Returns a Status, or None if the daemon has not written one yet
+        """
+        if self.map is None and not self.open():
+            return None
+        for attempt in range(self.retries):
+            before = struct.unpack_from("<Q", self.map, 8)[0]
+            if before == 0:
+                return None
+            if before % 2 == 0:
+                raw = self.map[HEADER.size:SIZE]
+                if struct.unpack_from("<Q", self.map, 8)[0] == before:
+                    break
+            # The writer is part way through, let it finish
+            time.sleep(0)
+        else:
+            self.LOGGER.error("Could not get a whole status record from {}".format(self.path))
+            return None
+        values = list(RECORD.unpack_from(raw))
+        for i in (1, 2, 3, 4, 5, 6):
+            values[i] = optional(values[i])
+        values[9] = values[9].rstrip(b"\x00").decode()
+        values[10] = values[10].rstrip(b"\x00").decode()
+        values[11:14] = ["ON" if v else "OFF" for v in values[11:14]]
+        values[14] = None if values[14] < 0 else bool(values[14])
+        groups = {}
+        for name, temp in GROUP.iter_unpack(raw[RECORD.size:]):
+            if name.strip(b"\x00"):
+                groups[name.rstrip(b"\x00").decode()] = optional(temp)
+        values.append(groups)
+        return Status(*values)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,131 @@
+"""
+MQTTClient against a stand in for paho's client
+"""
+
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import hvactools
+
+class Result():
+    def __init__(self, rc):
+        self.rc = rc
+
+class FakeClient():
+    """
+    Takes the place of paho's Client.  The broker is up while "up" is set, and
+    every message it gets is kept in "published" as (time, topic, message).
+    """
+    def __init__(self, up=True):
+        self.up = up
+        self.published = []
+        self.lock = threading.Lock()
+        self.on_connect = None
+        self.on_disconnect = None
+
+    def reconnect_delay_set(self, minDelay, maxDelay):
+        pass
+
+    def username_pw_set(self, user, password):
+        pass
+
+    def connect_async(self, host, port, keepalive, bind_address):
+        if self.up:
+            self.on_connect(self, None, {}, 0)
+
+    def connect(self):
+        """
+        The broker came back
+        """
+        self.up = True
+        self.on_connect(self, None, {}, 0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, message, qos, retain):
+        with self.lock:
+            self.published.append((time.monotonic(), topic, message))
+        return Result(0)
+
+    def messages(self, topic=None):
+        with self.lock:
+            return [message for sent, sentTopic, message in self.published if topic is None or sentTopic == topic]
+
+def waitFor(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(.01)
+    return True
+
+class MQTTClientTest(unittest.TestCase):
+    def client(self, up=True, **options):
+        self.fake = FakeClient(up)
+        client = hvactools.MQTTClient("test", client=self.fake, **options)
+        client.start()
+        self.addCleanup(client.stop)
+        return client
+
+    def test_last_value_wins(self):
+        client = self.client(up=False)
+        for temp in (70, 71, 72):
+            client.publish("ziggy/climate/temp/house", temp)
+        self.assertEqual(client.pending(), 1)
+        self.fake.connect()
+        self.assertTrue(waitFor(lambda: client.pending() == 0))
+        self.assertEqual(self.fake.messages(), [72])
+
+    def test_retained_value_is_not_sent_twice(self):
+        client = self.client(minInterval=0)
+        self.assertTrue(client.publish("ziggy/climate/state", "HEAT"))
+        self.assertTrue(waitFor(lambda: self.fake.messages() == ["HEAT"]))
+        # The broker already holds it
+        self.assertFalse(client.publish("ziggy/climate/state", "HEAT"))
+        self.assertTrue(client.publish("ziggy/climate/state", "OFF"))
+        self.assertTrue(waitFor(lambda: self.fake.messages() == ["HEAT", "OFF"]))
+        # Not retained, so it always goes
+        self.assertTrue(client.publish("ziggy/climate/state", "OFF", retain=False))
+        self.assertTrue(waitFor(lambda: self.fake.messages() == ["HEAT", "OFF", "OFF"]))
+
+    def test_each_topic_is_rate_limited(self):
+        client = self.client(minInterval=.3)
+        client.publish("ziggy/climate/temp/house", 70)
+        self.assertTrue(waitFor(lambda: len(self.fake.messages()) == 1))
+        client.publish("ziggy/climate/temp/house", 71)
+        # Another topic is not held up by the first one
+        client.publish("ziggy/climate/temp/outside", 30)
+        self.assertTrue(waitFor(lambda: len(self.fake.messages()) == 3))
+        sent = {(topic, message): at for at, topic, message in self.fake.published}
+        self.assertGreaterEqual(sent[("ziggy/climate/temp/house", 71)] - sent[("ziggy/climate/temp/house", 70)], .29)
+        self.assertLess(sent[("ziggy/climate/temp/outside", 30)] - sent[("ziggy/climate/temp/house", 70)], .29)
+
+    def test_queue_is_bounded_while_the_broker_is_down(self):
+        client = self.client(up=False, queueSize=10)
+        started = time.perf_counter()
+        with self.assertLogs("__main__.tools.MQTTClient", "ERROR"):
+            for i in range(1000):
+                client.publish("ziggy/test/{}".format(i), i)
+        # Never waits on the broker
+        self.assertLess(time.perf_counter() - started, .5)
+        self.assertEqual(client.pending(), 10)
+        self.assertEqual(client.dropped, 990)
+        self.fake.connect()
+        self.assertTrue(waitFor(lambda: client.pending() == 0))
+        # The newest ones are the ones kept
+        self.assertEqual(sorted(self.fake.messages()), list(range(990, 1000)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+neighbors against saved copies of the neighbor table in fixtures/
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import neighbors
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+class FakeProber():
+    """
+    Resolves the names in "addresses" and answers for the hosts in "home"
+    """
+    def __init__(self, home=(), addresses=None):
+        self.home = set(home)
+        self.addresses = addresses or {}
+        self.probed = []
+
+    def resolve(self, hostname):
+        if neighbors.isIP(hostname):
+            return hostname
+        return self.addresses.get(hostname)
+
+    def probe(self, hostnames):
+        self.probed.append(sorted(hostnames))
+        return {hostname for hostname in hostnames if hostname in self.home}
+
+class ParseTest(unittest.TestCase):
+    def test_ip_neigh(self):
+        table = neighbors.parseNeighbors((FIXTURES / "neigh.txt").read_text())
+        self.assertEqual(table["192.168.1.1"], ("00:11:22:33:44:55", "REACHABLE"))
+        self.assertEqual(table["192.168.1.21"], ("3c:22:fb:01:02:04", "STALE"))
+        self.assertEqual(table["192.168.1.22"], ("3c:22:fb:01:02:05", "DELAY"))
+        # No hardware address, no entry
+        self.assertNotIn("192.168.1.24", table)
+        self.assertNotIn("192.168.1.25", table)
+
+    def test_proc_arp(self):
+        table = neighbors.parseARP((FIXTURES / "arp.txt").read_text())
+        self.assertEqual(table, {
+            "192.168.1.1": ("00:11:22:33:44:55", neighbors.UNKNOWN),
+            "192.168.1.20": ("3c:22:fb:01:02:03", neighbors.UNKNOWN)
+            })
+
+    def test_table_reads_either_copy(self):
+        byIP, byMAC = neighbors.NeighborTable(str(FIXTURES / "neigh.txt")).read()
+        self.assertEqual(byMAC["3c:22:fb:01:02:03"], ("192.168.1.20", "REACHABLE"))
+        byIP, byMAC = neighbors.NeighborTable(str(FIXTURES / "arp.txt")).read()
+        self.assertEqual(byMAC["3c:22:fb:01:02:03"], ("192.168.1.20", neighbors.UNKNOWN))
+        self.assertEqual(neighbors.NeighborTable(str(FIXTURES / "missing.txt")).read(), ({}, {}))
+
+class PresenceCacheTest(unittest.TestCase):
+    def cache(self, fixture="neigh.txt", **prober):
+        self.prober = FakeProber(**prober)
+        return neighbors.PresenceCache(600, 60, neighbors.NeighborTable(str(FIXTURES / fixture)), self.prober)
+
+    def test_reachable_hosts_are_home_without_a_ping(self):
+        cache = self.cache(addresses={"phone.lan": "192.168.1.20"})
+        hosts = ["phone.lan", "3C:22:FB:01:02:05", "192.168.1.23"]
+        self.assertEqual(cache.present(hosts, now=0), set(hosts))
+        self.assertEqual(self.prober.probed, [])
+
+    def test_stale_hosts_are_pinged(self):
+        cache = self.cache(home={"192.168.1.21"})
+        self.assertEqual(cache.present(["192.168.1.21"], now=0), {"192.168.1.21"})
+        self.assertEqual(self.prober.probed, [["192.168.1.21"]])
+
+    def test_stale_host_that_left_goes_away(self):
+        cache = self.cache()
+        self.assertEqual(cache.present(["192.168.1.21"], now=0), set())
+        # The failed ping is trusted for absentTTL, then it is pinged again
+        self.assertEqual(cache.present(["192.168.1.21"], now=30), set())
+        self.assertEqual(cache.present(["192.168.1.21"], now=61), set())
+        self.assertEqual(len(self.prober.probed), 2)
+
+    def test_stale_mac_pings_its_address(self):
+        cache = self.cache(home={"192.168.1.21"})
+        self.assertEqual(cache.present(["3c:22:fb:01:02:04"], now=0), {"3c:22:fb:01:02:04"})
+        self.assertEqual(self.prober.probed, [["192.168.1.21"]])
+
+    def test_seen_hosts_stay_home_for_present_ttl(self):
+        cache = self.cache(addresses={"phone.lan": "192.168.1.20"})
+        cache.present(["phone.lan"], now=0)
+        # The phone dropped out of the table
+        cache.table = neighbors.NeighborTable(str(FIXTURES / "missing.txt"))
+        self.assertEqual(cache.present(["phone.lan"], now=599), {"phone.lan"})
+        self.assertEqual(self.prober.probed, [])
+        self.assertEqual(cache.present(["phone.lan"], now=601), set())
+        self.assertEqual(self.prober.probed, [["phone.lan"]])
+
+    def test_unknown_mac_is_not_pinged(self):
+        cache = self.cache()
+        self.assertEqual(cache.present(["aa:bb:cc:dd:ee:ff"], now=0), set())
+        self.assertEqual(self.prober.probed, [])
+
+    def test_proc_arp_entries_are_pinged(self):
+        # /proc/net/arp does not say how fresh an entry is
+        cache = self.cache("arp.txt", home={"192.168.1.20"})
+        self.assertEqual(cache.present(["192.168.1.20", "192.168.1.1"], now=0), {"192.168.1.20"})
+        self.assertEqual(self.prober.probed, [["192.168.1.1", "192.168.1.20"]])
+
+if __name__ == "__main__":
+    unittest.main()
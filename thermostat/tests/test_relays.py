@@ -0,0 +1,144 @@
+"""
+HVAC.actuate and the relay journal against a stand in for the board
+"""
+
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import hvac
+import relays
+
+class FakeBoard():
+    """
+    Keeps every write as (pin, value).  Writing a pin in "dead" raises.
+    """
+    def __init__(self):
+        self.dead = set()
+        self.writes = []
+
+    def digital_write(self, pin, value):
+        if pin in self.dead:
+            raise IOError("pin {} is dead".format(pin))
+        self.writes.append((pin, value))
+
+class CountingScheduler(relays.PulseScheduler):
+    """
+    A PulseScheduler that keeps the pins of each batch it was asked for
+    """
+    def __init__(self, board):
+        relays.PulseScheduler.__init__(self, board)
+        self.batches = []
+
+    def pulse(self, pin, *args, **kwargs):
+        self.batches.append([pin])
+        return relays.PulseScheduler.pulse(self, pin, *args, **kwargs)
+
+    def pulseMany(self, pulses, *args, **kwargs):
+        self.batches.append([pin for pin, settle, group in pulses])
+        return relays.PulseScheduler.pulseMany(self, pulses, *args, **kwargs)
+
+class ActuateTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.journalFile = Path(self.folder.name) / "relays.json"
+        self.board = FakeBoard()
+        self.pulser = CountingScheduler(self.board)
+        self.addCleanup(self.pulser.stop)
+        self.hvac = self.makeHVAC()
+
+    def makeHVAC(self):
+        system = hvac.HVAC()
+        system.heater = hvac.Heater()
+        system.heater.controlPins = [2, 3]
+        system.vent = hvac.Vent()
+        system.vent.controlPins = [4, 5]
+        system.ac = hvac.AirConditioner()
+        system.ac.controlPins = [6, 7]
+        system.board = self.board
+        system.pulser = self.pulser
+        system.journal = relays.RelayJournal(self.journalFile)
+        return system
+
+    def actuate(self, changes, system=None, force=False):
+        """
+        Returns what actuate did and the future its callback got, once the relays settled
+        """
+        done = threading.Event()
+        result = []
+
+        def callback(future):
+            result.append(future)
+            done.set()
+
+        pulsed = (system or self.hvac).actuate(changes, callback, force)
+        self.assertTrue(done.wait(5))
+        return pulsed, result[0]
+
+    def test_repeated_command_is_skipped(self):
+        self.assertEqual(self.actuate([("HEAT", "ON")])[0], ["HEAT"])
+        writes = len(self.board.writes)
+        self.assertEqual(self.actuate([("HEAT", "ON")]), ([], None))
+        self.assertEqual(len(self.board.writes), writes)
+        self.assertEqual(self.hvac.heater.state, "ON")
+        # Unless it is forced
+        self.assertEqual(self.actuate([("HEAT", "ON")], force=True)[0], ["HEAT"])
+        self.assertEqual(len(self.board.writes), writes + 2)
+
+    def test_turn_off_all_is_one_batch(self):
+        done = threading.Event()
+        self.hvac.turnOff("ALL", lambda future: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.pulser.batches, [[3, 7, 5]])
+        # Every relay gets power, then every one loses it
+        self.assertEqual(self.board.writes, [(3, 1), (7, 1), (5, 1), (3, 0), (7, 0), (5, 0)])
+        self.assertEqual([self.hvac.heater.state, self.hvac.ac.state, self.hvac.vent.state], ["OFF"] * 3)
+
+    def test_failed_write_is_forgotten(self):
+        self.actuate([("HEAT", "ON"), ("VENT", "ON")])
+        self.board.dead = {3}
+        with self.assertLogs("__main__.hvac.HVAC", "ERROR"), self.assertLogs("__main__.relays.PulseScheduler", "ERROR"):
+            self.actuate([("HEAT", "OFF"), ("VENT", "OFF")])
+        # The heater may be anywhere, the vent went off
+        self.assertIsNone(self.hvac.journal.get([2, 3]))
+        self.assertEqual(self.hvac.journal.get([4, 5]), "OFF")
+        self.assertEqual(self.hvac.heater.state, "ON")
+        # So the next command pulses it again
+        self.board.dead = set()
+        self.assertEqual(self.actuate([("HEAT", "OFF"), ("VENT", "OFF")])[0], ["HEAT"])
+        self.assertEqual(self.hvac.journal.get([2, 3]), "OFF")
+
+    def test_failed_direct_write_is_forgotten(self):
+        self.hvac.pulser = None
+        self.actuate([("COOL", "ON")])
+        self.assertEqual(self.hvac.journal.get([6, 7]), "ON")
+        self.board.dead = {7}
+        with self.assertRaises(IOError):
+            self.hvac.actuate([("COOL", "OFF")])
+        self.assertIsNone(self.hvac.journal.get([6, 7]))
+
+    def test_journal_survives_a_restart(self):
+        self.actuate([("HEAT", "ON"), ("COOL", "OFF")])
+        restarted = self.makeHVAC()
+        self.assertEqual(restarted.journal.get([2, 3]), "ON")
+        self.assertEqual(restarted.journal.get([6, 7]), "OFF")
+        self.assertIsNone(restarted.journal.get([4, 5]))
+        writes = len(self.board.writes)
+        self.assertEqual(self.actuate([("HEAT", "ON"), ("COOL", "OFF"), ("VENT", "OFF")], restarted)[0], ["VENT"])
+        self.assertEqual(self.board.writes[writes:], [(5, 1), (5, 0)])
+
+class RelayJournalTest(unittest.TestCase):
+    def test_unreadable_journal_is_ignored(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "relays.json"
+            for broken in ("not json", "[1, 2]", '{"a,b": "ON"}'):
+                path.write_text(broken)
+                self.assertEqual(relays.RelayJournal(path).positions, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+SensorHealth fed raw samples at set times
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sensorhealth
+
+LOGGER = "__main__.sensorhealth.SensorHealth"
+
+class SensorHealthTest(unittest.TestCase):
+    def health(self, **settings):
+        return sensorhealth.SensorHealth("test", **settings)
+
+    def failUntilQuarantined(self, health, now=0):
+        with self.assertLogs(LOGGER, "WARNING"):
+            for i in range(health.window):
+                health.record([], now=now + i)
+                if not health.healthy:
+                    return now + i
+        self.fail("{} was never quarantined".format(health.name))
+
+    def test_good_read(self):
+        health = self.health()
+        self.assertEqual(health.record([44, 46, 45, 45], now=0), 45)
+        self.assertIsNone(health.reason)
+        self.assertEqual((health.lastGood, health.lastGoodAt), (45, 0))
+
+    def test_bad_reads(self):
+        health = self.health()
+        health.record([45], now=0)
+        for samples, now, reason in (
+                ([], 10, "no reading"),
+                ([10, 10], 20, "10.0 is out of range"),
+                ([70, 70], 30, "70.0 is out of range"),
+                ([32, 48, 32, 48], 40, "the samples vary by 64.0"),
+                # 5 in one second is faster than a house can change
+                ([50], 1, "it moved 5.0 in 1.0 seconds")):
+            self.assertIsNone(health.record(samples, now=now))
+            self.assertEqual(health.reason, reason)
+        self.assertTrue(health.healthy)
+        # The same change spread over a minute is fine
+        self.assertEqual(health.record([50], now=60), 50)
+        self.assertIsNone(health.reason)
+
+    def test_noise_is_never_too_fast(self):
+        health = self.health()
+        health.record([45], now=0)
+        self.assertEqual(health.record([47], now=.001), 47)
+
+    def test_quarantined_when_too_many_reads_fail(self):
+        health = self.health(window=20, minSuccess=.5)
+        for i in range(10):
+            health.record([45], now=i)
+        # 10 bad out of 20 is still a success rate of .5
+        for i in range(10, 20):
+            health.record([], now=i)
+        self.assertTrue(health.healthy)
+        with self.assertLogs(LOGGER, "WARNING"):
+            self.assertIsNone(health.record([], now=20))
+        self.assertFalse(health.healthy)
+        self.assertEqual(health.reason, "no reading")
+        # Good reads do not count until it has recovered
+        self.assertIsNone(health.record([45], now=21))
+
+    def test_quarantined_sensor_is_probed_every_so_often(self):
+        health = self.health(probeEvery=5)
+        self.assertTrue(all(health.due() for i in range(10)))
+        self.failUntilQuarantined(health)
+        self.assertEqual([health.due() for i in range(15)], [False, False, False, False, True] * 3)
+
+    def test_recovers_after_good_probes_in_a_row(self):
+        health = self.health(recoverAfter=3)
+        now = self.failUntilQuarantined(health)
+        self.assertIsNone(health.record([45], now=now + 1))
+        self.assertIsNone(health.record([45], now=now + 2))
+        # A bad probe starts the count again
+        self.assertIsNone(health.record([], now=now + 3))
+        self.assertIsNone(health.record([45], now=now + 4))
+        self.assertIsNone(health.record([45], now=now + 5))
+        with self.assertLogs(LOGGER, "INFO"):
+            self.assertEqual(health.record([45], now=now + 6), 45)
+        self.assertTrue(health.healthy)
+        self.assertIsNone(health.reason)
+        self.assertEqual(health.successRate, 1.0)
+        self.assertTrue(health.due())
+
+    def test_stuck(self):
+        health = self.health(stuckMinutes=120)
+        with self.assertLogs(LOGGER, "WARNING"):
+            for minute in range(121):
+                average = health.record([45, 45, 45, 45], now=minute * 60)
+        self.assertIsNone(average)
+        self.assertTrue(health.stuck)
+        self.assertFalse(health.healthy)
+        self.assertEqual(health.reason, "stuck at 45")
+
+    def test_stuck_needs_passes_in_a_row(self):
+        health = self.health(stuckMinutes=120, stuckPasses=3)
+        # Two reads hours apart that happen to match
+        health.record([45, 45], now=0)
+        self.assertEqual(health.record([45, 45], now=4 * 3600), 45)
+        self.assertFalse(health.stuck)
+        self.assertEqual(health.record([45, 45], now=4 * 3600 + 60), 45)
+        self.assertFalse(health.stuck)
+        with self.assertLogs(LOGGER, "WARNING"):
+            self.assertIsNone(health.record([45, 45], now=4 * 3600 + 120))
+        self.assertTrue(health.stuck)
+
+    def test_quiet_sensor_is_healthy(self):
+        # A steady room, the ADC only wobbling by a count now and then
+        health = self.health(stuckMinutes=120)
+        for minute in range(24 * 60):
+            samples = [45, 45, 45, 46] if minute % 7 == 0 else [45, 45, 45, 45]
+            self.assertIsNotNone(health.record(samples, now=minute * 60))
+        self.assertTrue(health.healthy)
+        self.assertFalse(health.stuck)
+
+    def test_streaming_sensor_is_never_stuck(self):
+        health = self.health(stuckMinutes=1)
+        for minute in range(10):
+            self.assertEqual(health.record([45], now=minute * 60, checkStuck=False), 45)
+        self.assertFalse(health.stuck)
+
+    def test_configure(self):
+        health = self.health(window=20)
+        health.configure(window=4, maxRate=.5)
+        self.assertEqual((health.results.maxlen, health.maxRate), (4, .5))
+        with self.assertRaises(AttributeError):
+            health.configure(speed=1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+A simulated day, on a virtual clock
+"""
+
+import logging
+import sys
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import hvactools
+import simulate
+
+DEFAULTCONFIG = Path(__file__).resolve().parent.parent / "config" / "default.json"
+
+class SimulationTest(unittest.TestCase):
+    def test_one_day_at_60_second_steps(self):
+        logging.disable(logging.CRITICAL)
+        try:
+            simulation = simulate.Simulation(hvactools.updateSettings(None, DEFAULTCONFIG))
+            started = time.perf_counter()
+            summary = simulation.run(24, 60)
+            wallSeconds = time.perf_counter() - started
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(summary["passes"], 24 * 60)
+        # A January day: the heater runs and holds the house near the schedule
+        self.assertGreater(summary["heatingShare"], 0)
+        self.assertEqual(summary["coolingShare"], 0)
+        self.assertGreater(summary["indoorMinF"], 60)
+        self.assertLess(summary["indoorMaxF"], 78)
+        self.assertGreater(summary["relayActuations"], 0)
+        self.assertLess(wallSeconds, 1.0)
+
+if __name__ == "__main__":
+    unittest.main()
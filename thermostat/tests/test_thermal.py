@@ -0,0 +1,129 @@
+"""
+The thermal model against a synthetic house
+"""
+
+import math
+import sys
+import unittest
+from pathlib import Path
+
+import numpy
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import thermal
+
+def runHouse(model, leak=.2, heat=8.0, hours=48, start=0):
+    """
+    Run a one mass house for hours, the heater two hours on and two off,
+    telling the model every 5 minutes.  Returns the time it stopped at.
+    """
+    tIn = 60.0
+    step = 5 * 60
+    now = start
+    for i in range(int(hours * 3600 / step)):
+        heater = (i // 24) % 2 == 0
+        tOut = 30 + 10 * math.sin(2 * math.pi * now / 86400)
+        # Integrate the 5 minutes in small steps
+        for j in range(30):
+            tIn += (leak * (tOut - tIn) + heat * heater) * (step / 30) / 3600
+        now += step
+        model.observe(tIn, tOut, heater, False, now=now)
+    return now
+
+def exactModel(leak, heat, cool, drift):
+    """
+    A model fit on rows that follow the coefficients exactly
+    """
+    model = thermal.ThermalModel(ridge=1e-9, minSamples=1)
+    generator = numpy.random.default_rng(1)
+    x = thermal.features(generator.uniform(55, 75, 200), generator.uniform(0, 90, 200), generator.integers(0, 2, 200), generator.integers(0, 2, 200))
+    model.addSamples(x, x @ numpy.array([leak, heat, cool, drift]))
+    return model
+
+class Schedule():
+    def __init__(self, targets):
+        self.targets = numpy.asarray(targets, dtype=float)
+
+    def upcoming(self, occupied, now=None, minutes=180):
+        return self.targets[:minutes]
+
+class ThermalModelTest(unittest.TestCase):
+    def test_fits_the_house_from_observe(self):
+        model = thermal.ThermalModel()
+        runHouse(model)
+        leak, heat, cool, drift = model.coefficients
+        self.assertAlmostEqual(leak, .2, delta=.02)
+        self.assertAlmostEqual(heat, 8.0, delta=.3)
+        self.assertAlmostEqual(drift, 0, delta=.5)
+        # Nothing was learned about the AC
+        self.assertAlmostEqual(cool, 0, delta=.01)
+        self.assertTrue(model.ready)
+
+    def test_not_ready_until_min_samples(self):
+        model = thermal.ThermalModel(minSamples=24)
+        self.assertFalse(model.ready)
+        runHouse(model, hours=1)
+        self.assertLess(model.samples, 24)
+        self.assertFalse(model.ready)
+        runHouse(model, hours=4, start=3600)
+        self.assertGreaterEqual(model.samples, 24)
+        self.assertTrue(model.ready)
+
+    def test_a_relay_change_starts_a_new_sample(self):
+        model = thermal.ThermalModel()
+        self.assertFalse(model.observe(60, 30, False, False, now=0))
+        self.assertFalse(model.observe(60, 30, True, False, now=300))
+        self.assertFalse(model.observe(60.5, 30, True, False, now=500))
+        self.assertTrue(model.observe(61, 30, True, False, now=600))
+
+    def test_forgets_old_samples(self):
+        model = thermal.ThermalModel(forgetting=.99)
+        now = runHouse(model, heat=8.0)
+        # A new furnace
+        runHouse(model, heat=4.0, start=now)
+        self.assertAlmostEqual(model.coefficients[1], 4.0, delta=.3)
+
+    def test_hours_to_reach(self):
+        model = exactModel(.2, 8.0, -6.0, 0)
+        # Heating settles at 30 + 8 / .2 = 70
+        self.assertAlmostEqual(float(model.hoursToReach(60, 65, 30, heater=True)), math.log(2) / .2, places=3)
+        self.assertEqual(float(model.hoursToReach(60, 75, 30, heater=True)), math.inf)
+        # Without the heater the house only cools down to 30
+        self.assertEqual(float(model.hoursToReach(60, 65, 30)), math.inf)
+        self.assertEqual(float(model.hoursToReach(60, 55, 30, heater=True)), math.inf)
+        hours = model.hoursToReach(60, numpy.array([62, 70, 80]), 30, heater=True)
+        self.assertTrue(numpy.isfinite(hours[0]))
+        self.assertTrue(numpy.isinf(hours[1:]).all())
+
+class RecoveryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.model = exactModel(.2, 8.0, -6.0, 0)
+
+    def test_picks_the_furthest_target_that_needs_a_head_start(self):
+        # 66 at an hour and 68 at two hours both take longer than that to reach
+        schedule = Schedule([60] * 60 + [66] * 60 + [68] * 60)
+        self.assertEqual(thermal.recoveryPlan(self.model, schedule, 60, 30, True, True), (68.0, 120))
+
+    def test_nothing_to_start_early_for(self):
+        # 61 takes about half an hour, and is wanted in almost three
+        schedule = Schedule([60] * 170 + [61] * 10)
+        self.assertIsNone(thermal.recoveryPlan(self.model, schedule, 60, 30, True, True))
+        # Already warmer than anything coming up
+        self.assertIsNone(thermal.recoveryPlan(self.model, Schedule([58] * 180), 60, 30, True, True))
+
+    def test_cooling(self):
+        # Cooling settles at 90 - 6 / .2 = 60
+        schedule = Schedule([80] * 30 + [70] * 150)
+        self.assertEqual(thermal.recoveryPlan(self.model, schedule, 80, 90, True, False), (70.0, 30))
+
+    def test_needs_a_learned_model(self):
+        schedule = Schedule([60] * 60 + [68] * 120)
+        self.assertIsNone(thermal.recoveryPlan(thermal.ThermalModel(), schedule, 60, 30, True, True))
+        # Never saw the AC run
+        heatOnly = thermal.ThermalModel()
+        runHouse(heatOnly)
+        self.assertIsNone(thermal.recoveryPlan(heatOnly, Schedule([80] * 30 + [70] * 150), 80, 90, True, False))
+
+if __name__ == "__main__":
+    unittest.main()
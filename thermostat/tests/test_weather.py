@@ -0,0 +1,157 @@
+"""
+WeatherForecast against a weather server on localhost
+"""
+
+import datetime
+import http.server
+import json
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import clock
+import weather
+
+FORECAST = {
+    "currently": {"temperature": 41.2},
+    "daily": {"data": [{"temperatureHigh": 48.0, "temperatureLow": 22.5}]}
+    }
+ETAG = '"forecast-1"'
+
+class WeatherHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers with FORECAST, or 304 when the client already has it.  Set fail to
+    answer every request with a 500.
+    """
+    fail = False
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.fail:
+            self.send_error(500)
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(FORECAST).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class WeatherForecastTest(unittest.TestCase):
+    def setUp(self):
+        WeatherHandler.fail = False
+        WeatherHandler.requests = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), WeatherHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/forecast".format(self.server.server_address[1])
+        self.folder = tempfile.TemporaryDirectory()
+        self.cacheFile = Path(self.folder.name) / "weather" / "forecast.json"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def forecast(self, url=None):
+        return weather.WeatherForecast(url or self.url, cacheFile=self.cacheFile, timeout=2)
+
+    def test_download_is_cached(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        self.assertEqual(forecast.forecast, FORECAST)
+        self.assertFalse(forecast.stale)
+
+        restarted = self.forecast()
+        self.assertTrue(restarted.load())
+        self.assertEqual(restarted.forecast, FORECAST)
+        self.assertFalse(restarted.shouldUpdate())
+        self.assertEqual(len(WeatherHandler.requests), 1)
+
+    def test_cache_for_another_url_is_ignored(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        other = self.forecast(self.url + "?lat=1")
+        self.assertFalse(other.load())
+        self.assertIsNone(other.forecast)
+
+    def test_unchanged_forecast_is_not_downloaded_again(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        forecast.lastCheck -= datetime.timedelta(minutes=forecast.delay + 1)
+        self.assertTrue(forecast.stale)
+
+        forecast.update(forecast.url)
+        self.assertEqual(WeatherHandler.requests[-1].get("If-None-Match"), ETAG)
+        self.assertEqual(forecast.forecast, FORECAST)
+        self.assertFalse(forecast.stale)
+
+    def test_restart_sends_the_cached_etag(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        restarted = self.forecast()
+        restarted.load()
+        restarted.update(restarted.url)
+        self.assertEqual(WeatherHandler.requests[-1].get("If-None-Match"), ETAG)
+        self.assertEqual(restarted.forecast, FORECAST)
+
+    def test_failed_download_serves_the_last_forecast(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        forecast.lastCheck -= datetime.timedelta(minutes=forecast.delay + 1)
+        WeatherHandler.fail = True
+
+        with self.assertLogs("__main__.tools.WeatherForecast", "ERROR"):
+            forecast.update(forecast.url)
+        self.assertEqual(forecast.forecast, FORECAST)
+        self.assertTrue(forecast.stale)
+        # Not tried again until retryDelay is up
+        self.assertFalse(forecast.shouldUpdate())
+        self.assertGreater(forecast.secondsLeft(), 0)
+
+    def test_cache_age_follows_the_clock(self):
+        forecast = self.forecast()
+        forecast.update(forecast.url)
+        oldClock = clock.setClock(clock.VirtualClock(datetime.datetime.now()))
+        try:
+            restarted = self.forecast()
+            self.assertTrue(restarted.load())
+            self.assertFalse(restarted.stale)
+            clock.CLOCK.advance((restarted.delay + 1) * 60)
+            self.assertTrue(restarted.stale)
+        finally:
+            clock.setClock(oldClock)
+
+    def test_broken_cache_files_are_ignored(self):
+        self.cacheFile.parent.mkdir(parents=True)
+        for broken in ("not json", "[1, 2]", json.dumps({"url": self.url, "forecast": FORECAST}), json.dumps({"url": self.url, "forecast": FORECAST, "fetched": None})):
+            self.cacheFile.write_text(broken)
+            forecast = self.forecast()
+            with self.assertLogs("__main__.tools.WeatherForecast", "ERROR"):
+                self.assertFalse(forecast.load())
+            self.assertIsNone(forecast.forecast)
+
+    def test_no_server_and_no_cache(self):
+        self.server.shutdown()
+        self.server.server_close()
+        forecast = self.forecast()
+        self.assertFalse(forecast.load())
+        with self.assertLogs("__main__.tools.WeatherForecast", "ERROR"):
+            forecast.update(forecast.url)
+        self.assertIsNone(forecast.forecast)
+        self.assertFalse(self.cacheFile.exists())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+thermal.py
+
+A model of how the house heats and cools, learned while the thermostat runs.
+
+The house is treated as one thermal mass:
+
+    dT/dt = leak * (outdoor - T) + heat * heaterOn + cool * acOn + drift
+
+in degrees per hour.  The four coefficients are fit by least squares.  Only the
+normal equations (a 4x4 matrix and a 4 vector) are kept, so adding samples and
+refitting cost the same no matter how much history has gone in, and older
+samples slowly fade out so the model follows the seasons.
+
+The engine uses the model to start heating or cooling early enough to reach the
+next scheduled temp on time, instead of only reacting once the schedule has
+already changed.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.thermal")
+
+FEATURES = 4
+
+def features(tIn, tOut, heater, ac):
+    """
+    The rows of the design matrix.  Works on numbers or numpy arrays.
+    """
+    tIn, tOut = numpy.asarray(tIn, dtype=float), numpy.asarray(tOut, dtype=float)
+    return numpy.stack(numpy.broadcast_arrays(tOut - tIn, numpy.asarray(heater, dtype=float), numpy.asarray(ac, dtype=float), numpy.ones_like(tIn)), axis=-1)
+
+class ThermalModel():
+    """
+    <float> forgetting => How much each older sample counts compared to the next one
+    <float> ridge => Keeps the fit steady before there is enough data
+    <float> sampleMinutes => The shortest stretch a rate is measured over
+    <int> minSamples => How many samples before the model is trusted
+    <Path> saveFile => Where the model is kept between restarts, or None
+    """
+    def __init__(self, forgetting=.999, ridge=.01, sampleMinutes=5, minSamples=24, saveFile=None):
+        self.LOGGER = logging.getLogger("__main__.thermal.ThermalModel")
+        self.forgetting = forgetting
+        self.ridge = ridge
+        self.sampleMinutes = sampleMinutes
+        self.minSamples = minSamples
+        self.saveFile = Path(saveFile) if saveFile else None
+
+        self.xtx = numpy.zeros((FEATURES, FEATURES))
+        self.xty = numpy.zeros(FEATURES)
+        self.samples = 0
+
+        self.__coefficients = None
+        self.__anchor = None
+
+        self.LOGGER.debug("Created ThermalModel")
+
+    @property
+    def ready(self):
+        """
+        True once there is enough data and the heating and leak look physical
+        """
+        if self.samples < self.minSamples:
+            return False
+        leak, heat, cool, drift = self.coefficients
+        return leak > 0 and (heat > 0 or cool < 0)
+
+    @property
+    def coefficients(self):
+        """
+        (leak, heat, cool, drift), refit only when samples were added
+        """
+        if self.__coefficients is None:
+            self.__coefficients = numpy.linalg.solve(self.xtx + self.ridge * numpy.eye(FEATURES), self.xty)
+        return self.__coefficients
+
+    def addSamples(self, x, y):
+        """
+        x => rows from features(), y => the measured rates in degrees per hour.
+        The rows are taken as oldest first.
+        """
+        x = numpy.atleast_2d(x)
+        y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
+        n = len(y)
+        if not n:
+            return
+        # The newest row counts fully, each older one a little less
+        weights = self.forgetting ** numpy.arange(n - 1, -1, -1)
+        decay = self.forgetting ** n
+        self.xtx = decay * self.xtx + (x * weights[:, None]).T @ x
+        self.xty = decay * self.xty + (x * weights[:, None]).T @ y
+        self.samples += n
+        self.__coefficients = None
+
+    def observe(self, tIn, tOut, heater, ac, now=None):
+        """
+        Called every control pass.  A sample is made once sampleMinutes have gone
+        by with the relays staying the same.  Returns True if one was.
+        """
+        if tIn is None or tOut is None:
+            return False
+        if now is None:
+            now = clock.CLOCK.monotonic()
+        relays = (bool(heater), bool(ac))
+        anchor = self.__anchor
+        if anchor is None or anchor[3] != relays or now - anchor[0] > 4 * self.sampleMinutes * 60:
+            # The relays changed (or there was a gap), start measuring again from here
+            self.__anchor = (now, tIn, tOut, relays)
+            return False
+        hours = (now - anchor[0]) / 3600
+        if hours * 60 < self.sampleMinutes:
+            return False
+        rate = (tIn - anchor[1]) / hours
+        self.addSamples(features((tIn + anchor[1]) / 2, (tOut + anchor[2]) / 2, relays[0], relays[1]), rate)
+        self.__anchor = (now, tIn, tOut, relays)
+        return True
+
+    def rate(self, tIn, tOut, heater=False, ac=False):
+        """
+        Degrees per hour the house is changing by
+        """
+        return features(tIn, tOut, heater, ac) @ self.coefficients
+
+    def hoursToReach(self, tIn, target, tOut, heater=False, ac=False):
+        """
+        How long until the house gets from tIn to target, numpy.inf if it never
+        will.  target may be a numpy array.
+        """
+        leak, heat, cool, drift = self.coefficients
+        target = numpy.asarray(target, dtype=float)
+        push = heat * bool(heater) + cool * bool(ac) + drift
+        if leak <= 0:
+            rate = push
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                hours = (target - tIn) / rate
+            return numpy.where((hours >= 0) & numpy.isfinite(hours), hours, numpy.inf)
+        # Exponential approach to where the house would settle with these relays
+        settle = tOut + push / leak
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            remaining = (settle - target) / (settle - tIn)
+            hours = -numpy.log(remaining) / leak
+        return numpy.where((remaining > 0) & (remaining <= 1) & numpy.isfinite(hours), hours, numpy.inf)
+
+    def save(self):
+        if not self.saveFile:
+            return
+        data = {"xtx": self.xtx.tolist(), "xty": self.xty.tolist(), "samples": self.samples}
+        try:
+            Path.mkdir(self.saveFile.parent, parents=True, exist_ok=True)
+            tempFile = self.saveFile.with_name(self.saveFile.name + ".tmp")
+            with open(tempFile, "w") as mFile:
+                json.dump(data, mFile)
+            os.replace(tempFile, self.saveFile)
+        except OSError as e:
+            self.LOGGER.error("Could not save the thermal model {}.  {}".format(self.saveFile, e))
+
+    def load(self):
+        """
+        Load what was learned before the last restart.  Returns True if there was something.
+        """
+        if not self.saveFile:
+            return False
+        try:
+            with open(self.saveFile, "r") as mFile:
+                data = json.load(mFile)
+            xtx = numpy.array(data["xtx"], dtype=float).reshape(FEATURES, FEATURES)
+            xty = numpy.array(data["xty"], dtype=float).reshape(FEATURES)
+            samples = int(data["samples"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.LOGGER.debug("No thermal model loaded from {}  {}".format(self.saveFile, e))
+            return False
+        self.xtx, self.xty, self.samples = xtx, xty, samples
+        self.__coefficients = None
+        return True
+
+def recoveryPlan(model, schedule, tIn, tOut, occupied, heating, now=None, lookahead=180):
+    """
+    Work out if the house has to start heating (or cooling) now to reach a temp
+    the schedule asks for later.
+    Returns (target, minutesAhead) for the furthest temp that needs the head
+    start, or None if there is nothing to get ready for.
+    """
+    if not model.ready or tIn is None or tOut is None:
+        return None
+    leak, heat, cool, drift = model.coefficients
+    # Nothing learned yet about the relay that would do the work
+    if (heating and heat <= 0) or (not heating and cool >= 0):
+        return None
+    targets = schedule.upcoming(occupied, now, lookahead)
+    minutes = numpy.arange(len(targets))
+    needed = targets > tIn if heating else targets < tIn
+    if not needed.any():
+        return None
+    targets, minutes = targets[needed], minutes[needed]
+    hours = model.hoursToReach(tIn, targets, tOut, heater=heating, ac=not heating)
+    # Waiting any longer would get there after the schedule wants it
+    late = hours * 60 >= minutes
+    if not late.any():
+        return None
+    targets, minutes = targets[late], minutes[late]
+    first = numpy.argmax(targets) if heating else numpy.argmin(targets)
+    return float(targets[first]), int(minutes[first])
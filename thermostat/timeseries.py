@@ -0,0 +1,203 @@
+"""
+timeseries.py
+
+A fixed size history of the sensor readings.
+
+Every sensor (and sensor group) gets a ring buffer of raw readings plus a set of
+rollups at coarser resolutions.  Everything lives in compact arrays that are
+allocated once, so memory stays the same no matter how long the thermostat runs,
+and adding a reading is O(1).
+"""
+
+import logging
+from array import array
+
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+
+LOGGER = logging.getLogger("__main__.timeseries")
+
+# resolution in seconds => how many buckets to keep
+DEFAULT_ROLLUPS = {
+    1: 3600,     # one hour of seconds
+    60: 1440,    # one day of minutes
+    3600: 720    # thirty days of hours
+    }
+
+class RingBuffer():
+    """
+    Raw (timestamp, value) pairs.  Values are stored as int16, which is plenty
+    for the 10 bit ADC on the Arduino.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("h", bytes(2 * capacity))
+        self.__next = 0
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, timeStamp, value):
+        self.times[self.__next] = timeStamp
+        self.values[self.__next] = value
+        self.__next = (self.__next + 1) % self.capacity
+        if self.__count < self.capacity:
+            self.__count += 1
+
+    def latest(self):
+        if not self.__count:
+            return None
+        last = (self.__next - 1) % self.capacity
+        return self.times[last], self.values[last]
+
+    def items(self, since=None):
+        """
+        Returns [(timestamp, value), ...] oldest first
+        """
+        start = (self.__next - self.__count) % self.capacity
+        result = []
+        for i in range(self.__count):
+            slot = (start + i) % self.capacity
+            if since is None or self.times[slot] >= since:
+                result.append((self.times[slot], self.values[slot]))
+        return result
+
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + self.values.itemsize * len(self.values)
+
+class Rollup():
+    """
+    Readings summed into fixed width time buckets.
+    Each bucket keeps start, count, sum, min and max.
+    """
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.starts = array("d", bytes(8 * capacity))
+        self.counts = array("l", bytes(array("l").itemsize * capacity))
+        self.sums = array("d", bytes(8 * capacity))
+        self.minimums = array("h", bytes(2 * capacity))
+        self.maximums = array("h", bytes(2 * capacity))
+        self.__current = -1
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, timeStamp, value):
+        bucket = timeStamp - (timeStamp % self.resolution)
+        slot = self.__current
+        if slot < 0 or bucket > self.starts[slot]:
+            # Start a new bucket, writing over the oldest one
+            slot = (slot + 1) % self.capacity
+            self.__current = slot
+            self.starts[slot] = bucket
+            self.counts[slot] = 1
+            self.sums[slot] = value
+            self.minimums[slot] = value
+            self.maximums[slot] = value
+            if self.__count < self.capacity:
+                self.__count += 1
+        elif bucket == self.starts[slot]:
+            self.counts[slot] += 1
+            self.sums[slot] += value
+            if value < self.minimums[slot]:
+                self.minimums[slot] = value
+            if value > self.maximums[slot]:
+                self.maximums[slot] = value
+        # Anything older than the current bucket is too late to count
+
+    def items(self, since=None):
+        """
+        Returns [(bucketStart, count, mean, min, max), ...] oldest first
+        """
+        start = (self.__current - self.__count + 1) % self.capacity
+        result = []
+        for i in range(self.__count):
+            slot = (start + i) % self.capacity
+            if since is None or self.starts[slot] >= since:
+                result.append((self.starts[slot], self.counts[slot], self.sums[slot] / self.counts[slot], self.minimums[slot], self.maximums[slot]))
+        return result
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.starts, self.counts, self.sums, self.minimums, self.maximums))
+
+class Series():
+    def __init__(self, rawCapacity=3600, rollups=None):
+        self.raw = RingBuffer(rawCapacity)
+        if rollups is None:
+            rollups = DEFAULT_ROLLUPS
+        self.rollups = {resolution: Rollup(resolution, capacity) for resolution, capacity in rollups.items()}
+
+    def append(self, timeStamp, value):
+        self.raw.append(timeStamp, value)
+        for rollup in self.rollups.values():
+            rollup.append(timeStamp, value)
+
+    def nbytes(self):
+        return self.raw.nbytes() + sum(r.nbytes() for r in self.rollups.values())
+
+class TimeSeriesStore():
+    """
+    History for every sensor and sensor group, by name.
+
+    <int> rawCapacity => How many raw readings to keep for each name
+    <dict> rollups => {resolutionSeconds: bucketsToKeep}
+    """
+    def __init__(self, rawCapacity=3600, rollups=None):
+        self.LOGGER = logging.getLogger("__main__.timeseries.TimeSeriesStore")
+        self.rawCapacity = rawCapacity
+        self.rollups = rollups if rollups is not None else DEFAULT_ROLLUPS
+        self.__series = {}
+
+        self.LOGGER.debug("Created TimeSeriesStore")
+
+    @property
+    def names(self):
+        return list(self.__series)
+
+    def series(self, name):
+        name = name.upper()
+        if name not in self.__series:
+            self.__series[name] = Series(self.rawCapacity, self.rollups)
+        return self.__series[name]
+
+    def record(self, name, value, timeStamp=None):
+        """
+        <int> value => The raw ADC value
+        """
+        if value is None:
+            return
+        if timeStamp is None:
+            timeStamp = clock.CLOCK.time()
+        self.series(name).append(timeStamp, int(round(value)))
+
+    def latest(self, name):
+        if name.upper() not in self.__series:
+            return None
+        return self.__series[name.upper()].raw.latest()
+
+    def query(self, name, resolution=None, since=None):
+        """
+        resolution => None for the raw readings, or one of the rollup resolutions
+        since => Only return readings at or after this timestamp
+        """
+        if name.upper() not in self.__series:
+            return []
+        series = self.__series[name.upper()]
+        if resolution is None:
+            return series.raw.items(since)
+        if resolution not in series.rollups:
+            self.LOGGER.error("There is no {} second rollup".format(resolution))
+            return []
+        return series.rollups[resolution].items(since)
+
+    def nbytes(self):
+        """
+        The memory used by all of the buffers.  It only grows when a new name is added.
+        """
+        return sum(s.nbytes() for s in self.__series.values())
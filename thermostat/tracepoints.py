@@ -0,0 +1,109 @@
+"""
+tracepoints.py
+
+Trace points for the hot paths (property getters and the like).
+
+A trace point is switched off by default and costs one attribute check when it
+is off.  Switch a subsystem on at runtime with tracepoints.enable("hvac"), or before
+starting with the THERMOSTAT_TRACE environment variable ("hvac,sensors" or "all").
+
+When a trace point is on it sends a TraceRecord (subsystem, event, fields,
+monotonic ns) to every sink.  By default the records go to a bounded in memory
+ring (tracepoints.recent()) and to the "__main__.trace" logger at DEBUG.
+
+Usage:
+    TRACE = tracepoints.tracepoint("hvac")
+
+    if TRACE.enabled:
+        TRACE("thermostat.state", state=self.__state)
+"""
+
+import collections
+import logging
+import os
+import time
+
+LOGGER = logging.getLogger("__main__.trace")
+
+TraceRecord = collections.namedtuple("TraceRecord", ["subsystem", "event", "fields", "ns"])
+
+class TracePoint():
+    __slots__ = ("subsystem", "enabled")
+
+    def __init__(self, subsystem):
+        self.subsystem = subsystem
+        self.enabled = False
+
+    def __call__(self, event, **fields):
+        record = TraceRecord(self.subsystem, event, fields, time.monotonic_ns())
+        for sink in SINKS:
+            try:
+                sink(record)
+            except Exception as e:
+                LOGGER.error("Trace sink {} failed  {}".format(sink, e))
+
+# subsystem => TracePoint
+POINTS = {}
+SINKS = []
+RING = collections.deque(maxlen=1000)
+# Subsystems switched on before their trace point was created
+ENABLED = set()
+
+def tracepoint(subsystem):
+    """
+    Returns the shared TracePoint for the subsystem
+    """
+    if subsystem not in POINTS:
+        POINTS[subsystem] = TracePoint(subsystem)
+        POINTS[subsystem].enabled = subsystem in ENABLED or "all" in ENABLED
+    return POINTS[subsystem]
+
+def enable(*subsystems):
+    """
+    Switch tracing on for the subsystems, or for everything if none are given
+    """
+    if not subsystems:
+        subsystems = ("all",)
+    for subsystem in subsystems:
+        ENABLED.add(subsystem)
+    for subsystem, point in POINTS.items():
+        point.enabled = subsystem in ENABLED or "all" in ENABLED
+
+def disable(*subsystems):
+    """
+    Switch tracing off for the subsystems, or for everything if none are given
+    """
+    if not subsystems:
+        ENABLED.clear()
+    else:
+        for subsystem in subsystems:
+            ENABLED.discard(subsystem)
+    for subsystem, point in POINTS.items():
+        point.enabled = subsystem in ENABLED or "all" in ENABLED
+
+def addSink(sink):
+    """
+    sink => Called with every TraceRecord
+    """
+    if sink not in SINKS:
+        SINKS.append(sink)
+
+def removeSink(sink):
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+def recent(subsystem=None):
+    """
+    Returns the most recent records, oldest first
+    """
+    return [r for r in RING if subsystem is None or r.subsystem == subsystem]
+
+def logSink(record):
+    # Lazy formatting, the logger only builds the string if it is going to be used
+    LOGGER.debug("%s %s %s", record.subsystem, record.event, record.fields)
+
+addSink(RING.append)
+addSink(logSink)
+
+if os.environ.get("THERMOSTAT_TRACE"):
+    enable(*[s.strip() for s in os.environ["THERMOSTAT_TRACE"].split(",") if s.strip()])
@@ -0,0 +1,145 @@
+"""
+events.py
+
+Pushes status changes to the browsers with Server-Sent Events.
+
+One producer thread reads the status snapshot and works out what changed.  The
+change is turned into an event once, and that same event is handed to every
+subscriber's queue, so a room full of open dashboards costs no more per update
+than one.
+"""
+
+import json
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger("__main__.ui.events")
+
+def flatten(current):
+    """
+    The parts of a status.Status the dashboard shows, as one flat dictionary
+    """
+    values = {
+        "houseTemp": current.houseTemp,
+        "outsideTemp": current.outsideTemp,
+        "forecastHigh": current.forecastHigh,
+        "forecastLow": current.forecastLow,
+        "desiredTemp": current.desiredTemp,
+        "state": current.state,
+        "mode": current.mode,
+        "heater": current.heater,
+        "ac": current.ac,
+        "vent": current.vent,
+        "occupied": current.occupied,
+        "peopleHome": current.peopleHome
+        }
+    for group, temp in current.groups.items():
+        values["group." + group] = None if temp is None else round(temp, 1)
+    return values
+
+def message(eventId, values):
+    return "id: {}\nevent: status\ndata: {}\n\n".format(eventId, json.dumps(values))
+
+class EventHub():
+    """
+    <StatusReader> reader => Where the status comes from
+    <float> interval => How often, in seconds, to look for changes
+    <int> backlog => How many events a slow subscriber can fall behind before it is
+        sent the whole status again instead
+    """
+    def __init__(self, reader, interval=.5, backlog=20):
+        self.LOGGER = logging.getLogger("__main__.ui.events.EventHub")
+        self.reader = reader
+        self.interval = interval
+        self.backlog = backlog
+
+        self.values = {}
+        self.eventId = 0
+        self.__subscribers = set()
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__thread = None
+
+    @property
+    def subscribers(self):
+        return len(self.__subscribers)
+
+    def subscribe(self):
+        """
+        Returns a queue of ready to send events, starting with the whole status
+        """
+        subscriber = queue.Queue(maxsize=self.backlog)
+        with self.__lock:
+            if self.values:
+                subscriber.put_nowait(message(self.eventId, self.values))
+            self.__subscribers.add(subscriber)
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="EventHub", daemon=True)
+                self.__thread.start()
+        self.__wake.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.__lock:
+            self.__subscribers.discard(subscriber)
+
+    def poll(self):
+        """
+        Read the status once and send what changed to every subscriber
+        """
+        current = self.reader.read()
+        if current is None:
+            return
+        values = flatten(current)
+        with self.__lock:
+            delta = {key: value for key, value in values.items() if key not in self.values or self.values[key] != value}
+            if not delta:
+                return
+            self.values = values
+            self.eventId += 1
+            event = message(self.eventId, delta)
+            for subscriber in self.__subscribers:
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    # Too far behind for the deltas to mean anything, start it over
+                    self.resync(subscriber)
+
+    def resync(self, subscriber):
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.put_nowait(message(self.eventId, self.values))
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                if not self.__subscribers:
+                    # Nobody is watching, stop until somebody subscribes again
+                    self.__thread = None
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                self.LOGGER.error("Could not read the status  {}".format(e))
+            self.__wake.wait(self.interval)
+            self.__wake.clear()
+
+    def stream(self, heartbeat=15):
+        """
+        A generator of event text for one client, for a streaming response
+        """
+        subscriber = self.subscribe()
+        try:
+            while True:
+                try:
+                    yield subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    # A comment keeps proxies from closing the connection, and
+                    # finds out when the browser has gone away
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
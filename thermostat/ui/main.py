@@ -1,35 +1,40 @@
-from flask import Flask, render_template
+from pathlib import Path
+
+from flask import Flask, Response, jsonify, render_template
 
-import thermostat.hvac as hvac
-import thermostat.weather as weather
 import thermostat.hvactools as hvactools
 import thermostat.constants as constants
-import thermostat.occupancy as occupancy
+import thermostat.status as status
+import thermostat.ui.events as events
 
 app = Flask(__name__)
 
 SETTINGS = hvactools.updateSettings(None, constants.DEFAULTCONFIG)
 
-HVAC = hvac.setup(SETTINGS["SENSORS"], SETTINGS["SENSOR_GROUPS"], SETTINGS["HVAC"])
-WIFI = occupancy.WiFi(SETTINGS["WIFI"])
-WIFI.update(SETTINGS["WIFI"])
-
-WEATHER = weather.WeatherForecast(SETTINGS["WEATHER"]["URL"])
-WEATHER.update(WEATHER.url)
-
-HVAC.thermostat.defaultTemp = SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]
-
-HVAC.thermostat.updateSensors(HVAC.board)
-# Since this hvac supplies the house, the HOUSE group is the default
-# group that the thermostat will monitor
-houseTemp = round(HVAC.thermostat.getTemp("HOUSE"))
-
-HVAC.thermostat.update((WEATHER.forecast["daily"]["data"][0]["temperatureHigh"], WEATHER.forecast["daily"]["data"][0]["temperatureLow"], hvactools.checkTimeOfYear()))
+# The control daemon (run.py) owns the board.  All the UI does is read the
+# status snapshot it writes, so it starts at once and never touches the hardware.
+STATUS = status.StatusReader(Path(Path.home(), SETTINGS["USER_DIR"], SETTINGS["STATUS_FILE"]))
+# One reader of the status for every open dashboard
+EVENTS = events.EventHub(status.StatusReader(STATUS.path))
 
-HVAC.thermostat.tempModifier = {"TIMEMODS": SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["TIME_SETTINGS"], "OCCUPIED": [WIFI.occupied, SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["OCCUPIED_SETTINGS"]]}
-HVAC.thermostat.desiredTemp = SETTINGS["TEMP_SETTINGS"][HVAC.thermostat.state]["DEFAULT_TEMP"] + HVAC.thermostat.tempModifier
+def rounded(value):
+    return None if value is None else round(value)
 
-cTemp = WEATHER.forecast["currently"]["temperature"]
 @app.route('/')
 def index():
-    return render_template("index.html", dTemp=HVAC.thermostat.desiredTemp, hTemp=houseTemp, cTemp=cTemp)
+    current = STATUS.read()
+    if current is None:
+        return render_template("index.html", dTemp="--", hTemp="--", cTemp="--")
+    return render_template("index.html", dTemp=rounded(current.desiredTemp), hTemp=rounded(current.houseTemp), cTemp=current.outsideTemp)
+
+@app.route('/status')
+def currentStatus():
+    current = STATUS.read()
+    if current is None:
+        return jsonify({"error": "The thermostat has not written a status yet"}), 503
+    return jsonify(current._asdict())
+
+@app.route('/events')
+def statusEvents():
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(EVENTS.stream(), mimetype="text/event-stream", headers=headers)
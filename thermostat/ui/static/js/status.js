@@ -0,0 +1,53 @@
+// Live thermostat status from the /events stream.
+// The server only sends what changed, so keep the last of everything here.
+
+var thermostatStatus = {};
+
+function showTemp(id, temp) {
+	var element = document.getElementById(id);
+	if (element && temp !== null && temp !== undefined) {
+		element.innerHTML = Math.round(Number(temp))+"&degF";
+	}
+}
+
+function showStatus() {
+	showTemp("indoor-temp", thermostatStatus.houseTemp);
+	showTemp("currentTemp", thermostatStatus.outsideTemp);
+	showTemp("tempHigh", thermostatStatus.forecastHigh);
+	showTemp("tempLow", thermostatStatus.forecastLow);
+
+	var desiredTemp = document.getElementById("desired-temp");
+	if (desiredTemp && thermostatStatus.desiredTemp !== null && thermostatStatus.desiredTemp !== undefined) {
+		desiredTemp.innerHTML = Math.round(Number(thermostatStatus.desiredTemp)).toString();
+	}
+
+	var hvacState = document.getElementById("hvac-state");
+	if (hvacState) {
+		var running = [];
+		if (thermostatStatus.heater == "ON") { running.push("heater"); }
+		if (thermostatStatus.ac == "ON") { running.push("ac"); }
+		if (thermostatStatus.vent == "ON") { running.push("vent"); }
+		hvacState.innerHTML = (thermostatStatus.mode || "") + " " + (thermostatStatus.state || "") + (running.length ? " : " + running.join(", ") + " on" : "");
+	}
+}
+
+function onStatus(event) {
+	var changes = JSON.parse(event.data);
+	for (var key in changes) {
+		thermostatStatus[key] = changes[key];
+	}
+	showStatus();
+}
+
+if (window.EventSource) {
+	// EventSource reconnects by itself and the server starts each connection
+	// with the whole status
+	var statusEvents = new EventSource("/events");
+	statusEvents.addEventListener("status", onStatus);
+}
+else {
+	console.log("No EventSource in this browser, the status will not update");
+}
+
+// Anything that came in before the page was ready
+document.addEventListener("DOMContentLoaded", showStatus);
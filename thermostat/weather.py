@@ -1,19 +1,47 @@
 import logging
 import urllib.request
+import urllib.error
 import json
 import datetime
+import os
+import time
+from pathlib import Path
 
 try:
     import hvactools
 except ModuleNotFoundError:
     import thermostat.hvactools as hvactools
+try:
+    import clock
+except ModuleNotFoundError:
+    import thermostat.clock as clock
+try:
+    import metrics
+except ModuleNotFoundError:
+    import thermostat.metrics as metrics
+
+FETCH_SECONDS = metrics.histogram("thermostat_weather_fetch_seconds", "How long a forecast download takes", ["result"])
+FETCH_FAILURES = metrics.counter("thermostat_weather_fetch_failures", "Forecast downloads that failed")
 
 class WeatherForecast(hvactools.TimedObject):
-    def __init__(self, url, delay=20):
+    """
+    <string> url => Where to download the forecast from
+    <int> delay => Minutes a forecast is fresh for
+    cacheFile => Where the last good forecast is kept between runs.  None for no cache.
+    <int> retryDelay => Minutes to wait after a failed download before trying again
+    <int> timeout => Seconds to wait on the weather server
+    """
+    def __init__(self, url, delay=20, cacheFile=None, retryDelay=1, timeout=10):
         self.LOGGER = logging.getLogger("__main__.tools.WeatherForecast")
         hvactools.TimedObject.__init__(self, delay)
         self.url = url
+        self.cacheFile = Path(cacheFile) if cacheFile else None
+        self.retryDelay = retryDelay
+        self.timeout = timeout
         self.__forecast = None
+        self.__etag = None
+        self.__lastModified = None
+        self.__failedAt = None
 
     @property
     def forecast(self):
@@ -23,14 +51,110 @@ class WeatherForecast(hvactools.TimedObject):
     def forecast(self, data):
         self.__forecast = data
 
+    @property
+    def stale(self):
+        """
+        True when the forecast we have is older than delay.  It is still served
+        until a new one comes in.
+        """
+        return self.forecast is None or hvactools.TimedObject.shouldUpdate(self)
+
+    def shouldUpdate(self):
+        if self.__failedAt and clock.CLOCK.now() < self.__failedAt + datetime.timedelta(minutes=self.retryDelay):
+            return False
+        return hvactools.TimedObject.shouldUpdate(self)
+
+    def secondsLeft(self, now=None):
+        if now is None:
+            now = clock.CLOCK.now()
+        left = hvactools.TimedObject.secondsLeft(self, now)
+        if self.__failedAt:
+            left = max(left, (self.__failedAt + datetime.timedelta(minutes=self.retryDelay) - now).total_seconds())
+        return left
+
+    def load(self):
+        """
+        Load the last good forecast from the cache file.  Returns True if there was one.
+        """
+        if not self.cacheFile:
+            return False
+        try:
+            with open(self.cacheFile, "r") as cFile:
+                cache = json.load(cFile)
+            if cache.get("url") != self.url or not cache.get("forecast"):
+                self.LOGGER.debug("Weather cache is for a different url.  Ignoring it")
+                return False
+            # The age of the cache decides when it needs to be refreshed
+            age = clock.CLOCK.time() - float(cache["fetched"])
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.LOGGER.error("Weather cache {} did not load.  {}".format(self.cacheFile, e))
+            return False
+        self.forecast = cache["forecast"]
+        self.__etag = cache.get("etag")
+        self.__lastModified = cache.get("lastModified")
+        self.lastCheck = clock.CLOCK.now() - datetime.timedelta(seconds=age)
+        self.LOGGER.debug("Weather forecast loaded from {}".format(self.cacheFile))
+        return True
+
+    def save(self):
+        if not self.cacheFile:
+            return
+        cache = {
+            "url": self.url,
+            "fetched": self.lastCheck.timestamp(),
+            "etag": self.__etag,
+            "lastModified": self.__lastModified,
+            "forecast": self.forecast
+            }
+        try:
+            Path.mkdir(self.cacheFile.parent, parents=True, exist_ok=True)
+            # Write it next to the real file and swap it in, so a crash never leaves half a cache
+            tempFile = self.cacheFile.with_name(self.cacheFile.name + ".tmp")
+            with open(tempFile, "w") as cFile:
+                json.dump(cache, cFile)
+            os.replace(tempFile, self.cacheFile)
+        except OSError as e:
+            self.LOGGER.error("Could not save the weather cache {}.  {}".format(self.cacheFile, e))
+
     def update(self, jsonFile):
+        request = urllib.request.Request(jsonFile)
+        # Only ask for the forecast if it changed since the one we have
+        if self.forecast and jsonFile == self.url:
+            if self.__etag:
+                request.add_header("If-None-Match", self.__etag)
+            if self.__lastModified:
+                request.add_header("If-Modified-Since", self.__lastModified)
+        started = time.perf_counter()
         try:
-            with urllib.request.urlopen(jsonFile) as url:
+            with urllib.request.urlopen(request, timeout=self.timeout) as url:
                 data = json.loads(url.read().decode())
                 self.LOGGER.debug("Weather forecast downloaded from darksky")
                 self.forecast = data
-                self.lastCheck = datetime.datetime.now()
+                self.__etag = url.headers.get("ETag")
+                self.__lastModified = url.headers.get("Last-Modified")
+            FETCH_SECONDS.labels("downloaded").observe(time.perf_counter() - started)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                FETCH_SECONDS.labels("failed").observe(time.perf_counter() - started)
+                self.updateFailed(e)
+                return
+            FETCH_SECONDS.labels("unchanged").observe(time.perf_counter() - started)
+            self.LOGGER.debug("Weather forecast has not changed")
         except Exception as e:
-            self.LOGGER.error("Could not download weather.  Error code {}".format(e))
-            data = None
-    #         return data
+            FETCH_SECONDS.labels("failed").observe(time.perf_counter() - started)
+            self.updateFailed(e)
+            return
+        self.__failedAt = None
+        self.lastCheck = clock.CLOCK.now()
+        self.save()
+
+    def updateFailed(self, error):
+        FETCH_FAILURES.inc()
+        self.__failedAt = clock.CLOCK.now()
+        if self.forecast:
+            self.LOGGER.error("Could not download weather.  Using the last good forecast.  Error code {}".format(error))
+        else:
+            self.LOGGER.error("Could not download weather.  Error code {}".format(error))
+
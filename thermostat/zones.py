@@ -0,0 +1,117 @@
+"""
+zones.py
+
+Independently ducted zones run from one thermostat process.
+
+Every zone has its own relays, schedule, setpoint and Thermostat state.  The
+sensors all stay on the primary HVAC, so one acquisition pass reads them for
+every zone, and each zone just looks up the temp of its own sensor group.
+"""
+
+import logging
+
+try:
+    import hvac as hvacModule
+except ModuleNotFoundError:
+    import thermostat.hvac as hvacModule
+try:
+    import thermal
+except ModuleNotFoundError:
+    import thermostat.thermal as thermal
+
+LOGGER = logging.getLogger("__main__.zones")
+
+DEFAULT_ZONE = "HOUSE"
+
+class Zone():
+    """
+    <str> name => ie "UPSTAIRS"
+    <str> group => The sensor group the zone controls to
+    <HVAC> hvac => The zone's relays and Thermostat
+    <Thermostat> sensors => The thermostat that reads the sensors for every zone
+    <dict> tempSettings => The zone's TEMP_SETTINGS
+    """
+    def __init__(self, name, group, hvac, sensors=None, tempSettings=None):
+        self.LOGGER = logging.getLogger("__main__.zones.Zone")
+        self.name = name
+        self.group = group
+        self.hvac = hvac
+        self.sensors = sensors if sensors else hvac.thermostat
+        self.tempSettings = tempSettings
+
+        # The engine's channel for this zone's temp
+        self.houseTemp = None
+        # How fast this zone heats and cools, learned as it runs
+        self.model = thermal.ThermalModel()
+
+        if tempSettings and not hvac.thermostat.schedules:
+            self.compile(tempSettings)
+
+        self.LOGGER.debug("Created Zone {} on group {}".format(name, group))
+
+    @property
+    def thermostat(self):
+        return self.hvac.thermostat
+
+    @property
+    def topic(self):
+        """
+        Where the zone's temp is published.  The default zone keeps the old topic.
+        """
+        if self.name == DEFAULT_ZONE:
+            return "ziggy/climate/temp/house"
+        return "ziggy/climate/temp/{}".format(self.name.lower())
+
+    def compile(self, tempSettings):
+        """
+        Compile the schedule and apply the limits from the zone's TEMP_SETTINGS
+        """
+        self.tempSettings = tempSettings
+        thermostat = self.thermostat
+        thermostat.compileSchedules(tempSettings)
+        if tempSettings.get("MIN_TEMP") is not None:
+            thermostat.minTemp = tempSettings["MIN_TEMP"]
+        if tempSettings.get("MAX_TEMP") is not None:
+            thermostat.maxTemp = tempSettings["MAX_TEMP"]
+        if tempSettings.get("DEFAULT_TEMP") is not None:
+            thermostat.defaultTemp = tempSettings["DEFAULT_TEMP"]
+
+    def temp(self):
+        """
+        The zone's temp from the last acquisition pass, or None
+        """
+        return self.sensors.getTemp(self.group)
+
+def setup(settings, primary):
+    """
+    Returns the zones in SETTINGS["ZONES"], default zone first.
+
+    The default zone uses the primary HVAC, with the top level HVAC pins and
+    TEMP_SETTINGS.  Every other zone needs its own HVAC pins, and can have its own
+    TEMP_SETTINGS (the top level ones are used if it does not).
+    """
+    zoneSettings = dict(settings.get("ZONES") or {})
+    default = zoneSettings.pop(DEFAULT_ZONE, {}) or {}
+    zones = [Zone(DEFAULT_ZONE, default.get("GROUP", DEFAULT_ZONE), primary, tempSettings=settings["TEMP_SETTINGS"])]
+
+    usedPins = set()
+    for relay in (primary.heater, primary.vent, primary.ac):
+        usedPins.update(relay.controlPins)
+    for name, zone in zoneSettings.items():
+        group = zone.get("GROUP", name)
+        if group not in primary.thermostat.sensorGroups:
+            LOGGER.error("Zone {} has no sensor group {}.  Skipping it".format(name, group))
+            continue
+        pins = zone.get("HVAC")
+        if not pins:
+            LOGGER.error("Zone {} has no HVAC pins.  Skipping it".format(name))
+            continue
+        zonePins = {pin for key in ("HEAT_PINS", "VENT_PINS", "AC_PINS") for pin in pins[key]}
+        if zonePins & usedPins:
+            LOGGER.error("Zone {} uses pins {} that are already taken.  Skipping it".format(name, sorted(zonePins & usedPins)))
+            continue
+        usedPins.update(zonePins)
+        zoneHVAC = hvacModule.setupZone(pins, primary)
+        zones.append(Zone(name, group, zoneHVAC, primary.thermostat, zone.get("TEMP_SETTINGS") or settings["TEMP_SETTINGS"]))
+        LOGGER.info("Added zone {}".format(name))
+    return zones